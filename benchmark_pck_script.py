@@ -0,0 +1,135 @@
+import sys
+import time
+import numpy as np
+import torch
+from scipy.io import loadmat
+
+from stacked_hourglass.pose.utils.evaluation import get_preds, final_preds, accuracy_PCK, accuracy_PCKh, PCKhAccuracy
+
+
+# Tell people how to use this
+if len(sys.argv) > 2:
+    print("Usage: 'python benchmark_pck_script [<num_trials>]'.")
+    print("Times accuracy_PCK against the (previous) per joint, per sample loop implementation, and the on-device "
+          "PCKhAccuracy against the numpy accuracy_PCKh (on the MPII validation headboxes). Checks that the results "
+          "are the same, exiting with an error if they aren't.")
+    quit()
+
+
+# Unpack args
+num_trials = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+batch_sizes = [6, 16, 32, 64]
+num_joints = 16
+res = 64
+idxs = [1, 2, 3, 4, 5, 6, 11, 12, 15, 16]
+
+
+# The loop implementation, as a reference (for timing and to check the results are the same)
+def reference_accuracy_PCK(output, target, idxs, thr=0.5):
+    preds = get_preds(output).cpu()
+    gts = get_preds(target).cpu()
+    norm = torch.ones(preds.size(0)) * output.size(3) / 10
+    dists = torch.zeros(preds.size(1), preds.size(0))
+    for n in range(preds.size(0)):
+        for c in range(preds.size(1)):
+            if gts[n, c, 0] > 1 and gts[n, c, 1] > 1:
+                dists[c, n] = torch.dist(preds[n, c, :], gts[n, c, :]) / norm[n]
+            else:
+                dists[c, n] = -1
+
+    acc = torch.zeros(len(idxs) + 1)
+    avg_acc = 0
+    cnt = 0
+    for i in range(len(idxs)):
+        joint_dists = dists[idxs[i] - 1]
+        if joint_dists.ne(-1).sum() > 0:
+            acc[i + 1] = joint_dists.le(thr).eq(joint_dists.ne(-1)).sum() * 1.0 / joint_dists.ne(-1).sum()
+        else:
+            acc[i + 1] = -1
+        if acc[i + 1] >= 0:
+            avg_acc = avg_acc + acc[i + 1]
+            cnt += 1
+    if cnt != 0:
+        acc[0] = avg_acc / cnt
+    return acc
+
+
+# Time a function (synchronizing with the gpu if necessary), returning the average time in ms
+def time_fn(fn, device):
+    fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(num_trials):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.time() - start) * 1000.0 / num_trials
+
+
+# Benchmark on every device available, for each batch size
+num_mismatches = 0
+devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+for device in devices:
+    for batch_size in batch_sizes:
+        output = torch.rand(batch_size, num_joints, res, res, device=device)
+        target = torch.rand(batch_size, num_joints, res, res, device=device)
+        target[:, :2] = 0
+
+        acc = accuracy_PCK(output, target, idxs).cpu()
+        reference_acc = reference_accuracy_PCK(output, target, idxs)
+        if (acc - reference_acc).abs().max() > 1.0e-6:
+            print("Results differ from the reference implementation: {a} vs {r}".format(a=acc, r=reference_acc))
+            num_mismatches += 1
+
+        batched_ms = time_fn(lambda: accuracy_PCK(output, target, idxs), device)
+        reference_ms = time_fn(lambda: reference_accuracy_PCK(output, target, idxs), device)
+        print("device: {d:4s} | batch size: {b:3d} | loops: {r:8.3f}ms | batched: {t:8.3f}ms | speedup: {s:6.1f}x".format(
+            d=device, b=batch_size, r=reference_ms, t=batched_ms, s=reference_ms / batched_ms))
+
+
+# The MPII validation headboxes and joint names, for PCKh
+detections = loadmat('stacked_hourglass/evaluation/data/detections_our_format.mat')
+headboxes = np.transpose(detections['headboxes_src'], [2, 0, 1])
+joint_name_to_idx = dict((name, np.where(detections['dataset_joints'] == name)[1][0])
+                         for name in ['head', 'lsho', 'lelb', 'lwri', 'lhip', 'lkne', 'lank',
+                                      'rsho', 'relb', 'rwri', 'rkne', 'rank', 'rhip'])
+
+
+# Random score maps, and ground truths near to the predictions (so that about half of the joints are correct)
+def make_pckh_batch(batch_size, device):
+    output = torch.rand(batch_size, num_joints, res, res, device=device)
+    index = torch.from_numpy(np.random.choice(len(headboxes), batch_size, replace=False))
+    center = torch.rand(batch_size, 2) * 500 + 100
+    scale = torch.rand(batch_size) * 2 + 1
+    preds = final_preds(output.clone(), center, scale, [res, res]).cpu()
+    pts = torch.cat([preds + torch.randn(batch_size, num_joints, 2) * 30, torch.ones(batch_size, num_joints, 1)], 2)
+    visible = torch.rand(batch_size, num_joints).gt(0.2).float()
+    meta = {'index': index, 'center': center, 'scale': scale, 'pts': pts, 'visible': visible,
+            'headbox': torch.from_numpy(headboxes[index.numpy()])}
+    return output, meta
+
+
+# Check PCKhAccuracy against accuracy_PCKh (they differ only by float32 rounding), and time them
+for device in devices:
+    pckh = PCKhAccuracy(headboxes, joint_name_to_idx, torch.device(device))
+    for batch_size in batch_sizes:
+        output, meta = make_pckh_batch(batch_size, device)
+        acc, acc_per_joint = pckh(output, meta)
+        reference_acc, reference_acc_per_joint = accuracy_PCKh(output.cpu(), None, meta, None, joint_name_to_idx)
+        diff = max([abs(acc - reference_acc)] + [abs(acc_per_joint[key][i] - reference_acc_per_joint[key][i])
+                                                 for key in reference_acc_per_joint for i in range(2)])
+        if diff > 1.0e-4:
+            print("PCKh differs from the reference implementation by {d}: {a} vs {r}".format(
+                d=diff, a=(acc, acc_per_joint), r=(reference_acc, reference_acc_per_joint)))
+            num_mismatches += 1
+
+        batched_ms = time_fn(lambda: pckh(output, meta), device)
+        reference_ms = time_fn(lambda: accuracy_PCKh(output.cpu(), None, meta, None, joint_name_to_idx), device)
+        print("PCKh | device: {d:4s} | batch size: {b:3d} | numpy: {r:8.3f}ms | on device: {t:8.3f}ms | speedup: "
+              "{s:6.1f}x".format(d=device, b=batch_size, r=reference_ms, t=batched_ms, s=reference_ms / batched_ms))
+
+
+if num_mismatches > 0:
+    print("{n} results differ from the reference implementations".format(n=num_mismatches))
+    sys.exit(1)
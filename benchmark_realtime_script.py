@@ -0,0 +1,35 @@
+import sys
+import numpy as np
+import torch
+
+from stitched.realtime import RealtimeStitchedNetwork, SyntheticFrameSource, run_realtime_loop
+from stitched.stitched_network import StitchedNetwork
+from utils.transform import mpii_to_h36m_joints
+
+
+# Tell people how to use this
+if len(sys.argv) > 4:
+    print("Usage: 'python benchmark_realtime_script [<num_frames> [<fps> [<device>]]]'.")
+    print("Runs the real-time mode of the stitched network (with random weights) on a synthetic 640x480 camera, and "
+          "reports the latency (p50/p99), fps and number of dropped frames.")
+    quit()
+
+
+# Unpack args
+num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+fps = float(sys.argv[2]) if len(sys.argv) > 2 else 30.0
+device = torch.device(sys.argv[3] if len(sys.argv) > 3 else "cpu")
+
+
+# Make a stitched network (with the default architecture, but random weights, so no checkpoints are needed)
+model = StitchedNetwork(hg_stacks=8, hg_blocks=1, hg_num_classes=16, hg_batch_norm_momentum=0.5,
+                        hg_use_layer_norm=False, hg_mean=np.array([0.46, 0.44, 0.40]) * 255.0,
+                        hg_std=np.array([0.25, 0.25, 0.25]) * 255.0, width=256, height=256,
+                        transformer_fn=mpii_to_h36m_joints)
+model = model.to(device)
+
+
+# Run it on the synthetic camera
+estimator = RealtimeStitchedNetwork(model)
+source = SyntheticFrameSource(height=480, width=640, fps=fps, num_frames=num_frames * 100)
+run_realtime_loop(estimator, source, max_frames=num_frames, bgr=False)
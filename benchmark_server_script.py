@@ -0,0 +1,74 @@
+import sys
+import json
+import threading
+import time
+import numpy as np
+import torch
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from stitched.server import PoseInferenceServer, request_pose
+from stitched.stitched_network import StitchedNetwork
+from utils.transform import mpii_to_h36m_joints
+
+
+# Tell people how to use this
+if len(sys.argv) > 4:
+    print("Usage: 'python benchmark_server_script [<num_clients> [<requests_per_client> [<device>]]]'.")
+    print("Starts the inference server (with a stitched network with random weights) on a local port, sends it "
+          "concurrent requests from several clients, checks the responses against running the network directly, "
+          "and prints the server's metrics.")
+    quit()
+
+
+# Unpack args
+num_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+requests_per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+device = torch.device(sys.argv[3] if len(sys.argv) > 3 else "cpu")
+
+
+# Make a (small) stitched network with random weights (so no checkpoints are needed), and serve it on any free port
+model = StitchedNetwork(hg_stacks=2, hg_blocks=1, hg_num_classes=16, hg_batch_norm_momentum=0.5,
+                        hg_use_layer_norm=False, hg_mean=np.array([0.46, 0.44, 0.40]) * 255.0,
+                        hg_std=np.array([0.25, 0.25, 0.25]) * 255.0, width=256, height=256,
+                        transformer_fn=mpii_to_h36m_joints)
+model = model.to(device).eval()
+server = PoseInferenceServer(model, port=0, max_batch_size=num_clients, max_latency=0.02)
+server.start()
+url = "http://{h}:{p}".format(h=server.address[0], p=server.address[1])
+print(json.loads(urlopen(url + "/health").read().decode('utf-8')))
+
+
+# The poses from running the network directly (on one image at a time), to check the responses against
+frames = [np.random.RandomState(i).randint(0, 256, (480, 640, 3)).astype(np.uint8) for i in range(num_clients)]
+expected = []
+for frame in frames:
+    expected.append(server.predict(frame))
+
+
+# Each client sends its frame over and over (alternating JSON and binary responses)
+errors = []
+def client(i):
+    for r in range(requests_per_client):
+        pose_2d, pose_3d = request_pose(url, frames[i], binary=(r % 2 == 1))
+        if np.abs(pose_2d - expected[i][0]).max() > 1.0e-3 or np.abs(pose_3d - expected[i][1]).max() > 1.0e-3:
+            errors.append(i)
+
+start = time.time()
+threads = [threading.Thread(target=client, args=(i,)) for i in range(num_clients)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+elapsed = time.time() - start
+
+
+# Report
+print("{n} requests from {c} clients in {t:.2f}s ({r:.1f} requests/s), {e} mismatched responses".format(
+    n=num_clients * requests_per_client, c=num_clients, t=elapsed, r=num_clients * requests_per_client / elapsed,
+    e=len(errors)))
+print(json.dumps(server.metrics(), indent=4))
+server.shutdown()
@@ -0,0 +1,105 @@
+import sys
+import time
+import torch
+
+from stitched.soft_argmax import SoftArgmax2D, _parzen_torch
+
+
+# Tell people how to use this
+if len(sys.argv) > 2:
+    print("Usage: 'python benchmark_soft_argmax_script [<num_trials>]'.")
+    print("Times (and measures the peak memory of) SoftArgmax2D, with a Parzen window, against the previous "
+          "implementation, which built full (B*C, H, W) windows.")
+    quit()
+
+
+# Unpack args
+num_trials = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+batch_sizes = [1, 8, 32, 64]
+num_joints = 16
+res = 64
+
+
+# The previous implementation, as a reference (for timing and to check the results are the same). The only change is
+# that it's moved to the input's device, rather than always using cuda
+def reference_radial_window(width, height, cx, cy, fn, window_width, device):
+    channels = cx.size(0)
+    cx = cx.repeat(height, width, 1).permute(2, 0, 1)
+    cy = cy.repeat(height, width, 1).permute(2, 0, 1)
+    xs = torch.arange(width).view((1, width)).repeat(channels, height, 1).float().to(device)
+    ys = torch.arange(height).view((height, 1)).repeat(channels, 1, width).float().to(device)
+    dists = torch.sqrt(((ys - cy) ** 2) + ((xs - cx) ** 2))
+    return fn(dists, window_width)
+
+
+def reference_soft_argmax(x, window_width=10, softmax_temp=1.0):
+    batch_size, channels, height, width = x.size()
+    device = x.device
+    smax = torch.softmax(x.view(batch_size, channels, -1) / softmax_temp, dim=2).view(x.size())
+
+    x_flat = x.view((batch_size * channels, -1))
+    _, argmax = torch.max(x_flat, dim=1)
+    argmax_x = argmax.float() - width * torch.floor(argmax.float() / width)
+    argmax_y = torch.floor(argmax.float() / width)
+    windows = reference_radial_window(width, height, argmax_x, argmax_y, _parzen_torch, window_width, device)
+    windows = windows.view(x.size()).to(device)
+    smax = smax * windows
+    smax = smax / torch.sum(torch.sum(smax, dim=2, keepdim=True), dim=3, keepdim=True)
+
+    x_indices = torch.arange(0, width).float().to(device)
+    y_indices = torch.arange(0, height).float().to(device)
+    x_coords = torch.sum(torch.sum(smax, 2) * x_indices, 2)
+    y_coords = torch.sum(torch.sum(smax, 3) * y_indices, 2)
+    return torch.cat([torch.unsqueeze(x_coords, 2), torch.unsqueeze(y_coords, 2)], dim=2)
+
+
+# Time a function (synchronizing with the gpu if necessary), returning the average time in ms
+def time_fn(fn, device):
+    fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(num_trials):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.time() - start) * 1000.0 / num_trials
+
+
+# Measure the memory allocated by a function, in MB. On the gpu this is the peak memory allocated (above what's
+# allocated already), on the cpu (where there's no allocator statistics) it's the total allocated by the operators
+def memory_fn(fn, device):
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_max_memory_allocated()
+        baseline = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - baseline) / 2.0 ** 20
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        fn()
+    return sum(max(event.cpu_memory_usage, 0) for event in prof.function_events) / 2.0 ** 20
+
+
+# Benchmark on every device available, for each batch size, forward only (inference) and forward + backward (training)
+soft_argmax = SoftArgmax2D(window_fn="Parzen")
+devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+for device in devices:
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, num_joints, res, res, device=device, requires_grad=True)
+
+        out = soft_argmax(x)
+        reference_out = reference_soft_argmax(x)
+        if (out - reference_out).abs().max() > 1.0e-4:
+            print("Results differ from the reference implementation by {d}".format(
+                d=(out - reference_out).abs().max().item()))
+
+        forward_fns = [lambda: reference_soft_argmax(x.detach()), lambda: soft_argmax(x.detach())]
+        backward_fns = [lambda: reference_soft_argmax(x).sum().backward(), lambda: soft_argmax(x).sum().backward()]
+        for name, fns in [("forward", forward_fns), ("forward+backward", backward_fns)]:
+            reference_ms, new_ms = [time_fn(fn, device) for fn in fns]
+            reference_mb, new_mb = [memory_fn(fn, device) for fn in fns]
+            print("device: {d:4s} | batch size: {b:3d} | {n:16s} | previous: {r:8.3f}ms {rm:8.2f}MB | "
+                  "new: {t:8.3f}ms {tm:8.2f}MB | speedup: {s:6.1f}x".format(
+                      d=device, b=batch_size, n=name, r=reference_ms, rm=reference_mb, t=new_ms, tm=new_mb,
+                      s=reference_ms / new_ms))
@@ -8,8 +8,9 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 # Relative imports
-from stacked_hourglass.evaluation.eval_PCKh import compute_PCKh_curve
+from stacked_hourglass.evaluation.eval_PCKh import PCKhEvaluator, print_PCKh_scores
 from utils.osutils import mkdir_p, isdir
+from utils.eval_utils import print_avg_joint_err
 
 # Absolute imports
 import sys
@@ -40,14 +41,16 @@ def graph_PCKh_scores(options):
     if not isdir(options.output_dir):
         mkdir_p(options.output_dir)
 
-    curves = {}
-    for i in range(len(model_names)):
-        curves[model_names[i]] = compute_PCKh_curve(pred_files[i], model_names[i])
+    # Compute the curves for every model at once (loading the ground truth once)
+    evaluator = PCKhEvaluator()
+    results = evaluator.evaluate_files(pred_files, model_names)
+    print_PCKh_scores(results, model_names)
+    curves = dict((model, results[model]['curves']) for model in model_names)
 
     for key in curves[model_names[0]]:
         fig = plt.figure(figsize=(10.0, 10.0))
         for model in model_names:
-            plt.plot(np.arange(0.0, 0.5, 0.01), curves[model][key], label=model)
+            plt.plot(evaluator.thresholds, curves[model][key], label=model)
         plt.legend()
         plt.xlabel("Threshold")
         plt.ylabel("% joints correct")
@@ -82,5 +85,7 @@ if __name__ == "__main__":
     # run the appropriate 'script'
     if script == "mpii_PCKh":
         graph_PCKh_scores(options)
+    elif script == "h36m_mpjpe":
+        print_avg_joint_err(options)
     else:
         raise NotImplementedError()
@@ -1,73 +1,111 @@
-import sys
+import argparse
 import os
 import cv2
-from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from multiprocessing import Pool
 
-
-# Tell people how to use this
-if len(sys.argv) != 4:
-    print("Usage: 'python extract_video_frames_script <human_36m_videos_base_dir> <output_dir> <num_workers>'.")
-    quit()
+from utils.frame_shards import FrameShardWriter, shard_group_complete, img_crop_params, FRAME_RES, FRAMES_PER_SHARD
+import stacked_hourglass.pose.utils.transforms as hg_transforms
 
 
-# Unpack args
-base_dir = sys.argv[1]
-output_dir = os.path.join(sys.argv[2], "VideoFrames")
-num_workers = int(sys.argv[3])
+# Tell people how to use this
+parser = argparse.ArgumentParser(description="Unpacks the Human3.6m videos, either to a JPEG per frame (in "
+                                             "<output_dir>/VideoFrames), or streamed into frame shards (in "
+                                             "<output_dir>/FrameShards, see utils/frame_shards.py).")
+parser.add_argument('base_dir', type=str, metavar='human_36m_videos_base_dir', help='Human3.6m videos base dir')
+parser.add_argument('output_dir', type=str, help='Directory to output to')
+parser.add_argument('num_workers', type=int, help='Number of processes to decode videos with')
+parser.add_argument('--subjects', type=int, nargs='+', default=[1, 5, 6, 7, 8, 9, 11], help='Subjects to unpack')
+parser.add_argument('--shards', action='store_true', help='Stream the frames into frame shards, rather than JPEGs')
+parser.add_argument('--crop', action='store_true', help='(With --shards) crop and resize the frames to the '
+                                                        'hourglass input resolution, rather than storing full frames')
+parser.add_argument('--frames_per_shard', type=int, default=FRAMES_PER_SHARD, help='(With --shards) frames per '
+                                                                                    'shard file')
+args = parser.parse_args()
 
 
 # Make our output directory
+output_dir = os.path.join(args.output_dir, "FrameShards" if args.shards else "VideoFrames")
 if not os.path.isdir(output_dir):
     os.makedirs(output_dir)
 
 
-# Function to take a video filen, and then output all of the frames to the output directory
-def process_video(subject, action, camera, video_filename, video_output_dir):
-    # Print progress
-    print("Starting unpacking subject '{s}', action '{a}', camera '{c}':".format(s=subject, a=action, c=camera))
-
-    # Open the video, and iterate through the frames
+# Generator over the (RGB) frames of a video
+def video_frames(video_filename):
     vid = cv2.VideoCapture(video_filename)
-    frame = 0
     success, img = vid.read()
     while success:
-        # Make our output filename <output_dir>/subject.action.camera.frame.jpg
-        out_filename = os.path.join(video_output_dir, "{f}.jpg".format(f=frame))
-        cv2.imwrite(out_filename, img)
-
-        # Get the next frame
-        frame += 1
+        yield cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         success, img = vid.read()
+    vid.release()
+
+
+# Function to take a video file, and then output all of the frames to the output directory as JPEGs
+def unpack_video_to_jpegs(subject, action, camera, video_filename):
+    # Compute and make the video specific output dir
+    vid_output_dir = os.path.join(output_dir, "{s}/{a}/{c}".format(s=subject, a=action, c=camera))
+    if not os.path.isdir(vid_output_dir):
+        os.makedirs(vid_output_dir)
+
+    for frame, img in enumerate(video_frames(video_filename)):
+        # Make our output filename <output_dir>/subject/action/camera/frame.jpg
+        out_filename = os.path.join(vid_output_dir, "{f}.jpg".format(f=frame))
+        cv2.imwrite(out_filename, cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
 
         # Progress
-        if frame % 100 == 0:
-            print("At frame {f}".format(f=frame))
+        if (frame+1) % 100 == 0:
+            print("At frame {f}".format(f=frame+1))
+
+
+# Function to take a video file, and stream its frames into a shard group (S<subject>.<action>.<camera>). The group's
+# index is only written once every frame has been, so an interrupted group is just rewritten when resuming
+def unpack_video_to_shards(subject, action, camera, video_filename):
+    name = "S{s}.{a}.{c}".format(s=subject, a=action, c=camera)
+    writer = FrameShardWriter(output_dir, name, res=FRAME_RES if args.crop else None,
+                              frames_per_shard=args.frames_per_shard)
+    for frame, img in enumerate(video_frames(video_filename)):
+        center, scale = img_crop_params(img.shape[0], img.shape[1])
+        if args.crop:
+            img = hg_transforms.crop_numpy(img, center, scale, [FRAME_RES, FRAME_RES], rot=0)
+        writer.add(subject, action, camera, frame, np.asarray(img, dtype=np.uint8), center, scale)
 
-    # Print progress
-    print("Finished unpacking subject '{s}', action '{a}', camera '{c}':".format(s=subject, a=action, c=camera))
+        # Progress
+        if (frame+1) % 1000 == 0:
+            print("At frame {f} of subject '{s}', action '{a}', camera '{c}'".format(f=frame+1, s=subject, a=action,
+                                                                                     c=camera))
+    writer.close()
 
 
-# Iterate through all of the files (adding all of the videos to be unpacked by a threadpool)
-#subjects = [1, 5, 6, 7, 8, 9, 11]
-subjects = [11]
-with ThreadPoolExecutor(max_workers=num_workers) as pool:
-    for subject in subjects:
-        subject_dir = os.path.join(base_dir, "S{subject}/Videos/".format(subject=subject))
-        for filename in os.listdir(subject_dir):
-            # Get the action and camera from filename. File format: action_name.camera_name.mp4
-            action, camera, _ = filename.split(".")
+# Function to unpack a single video (run in the process pool)
+def process_video(job):
+    subject, action, camera, video_filename = job
+    if args.shards and shard_group_complete(output_dir, "S{s}.{a}.{c}".format(s=subject, a=action, c=camera)):
+        print("Already unpacked subject '{s}', action '{a}', camera '{c}'".format(s=subject, a=action, c=camera))
+        return
+
+    print("Starting unpacking subject '{s}', action '{a}', camera '{c}':".format(s=subject, a=action, c=camera))
+    if args.shards:
+        unpack_video_to_shards(subject, action, camera, video_filename)
+    else:
+        unpack_video_to_jpegs(subject, action, camera, video_filename)
+    print("Finished unpacking subject '{s}', action '{a}', camera '{c}':".format(s=subject, a=action, c=camera))
 
-            # Skip the video that collects all of them together
-            if action == "_ALL" or action == "_ALL 1":
-                continue
 
-            # Compute and make the video specific output dir
-            vid_output_dir = os.path.join(output_dir, "{s}/{a}/{c}".format(s=subject, a=action, c=camera))
-            if not os.path.isdir(vid_output_dir):
-                os.makedirs(vid_output_dir)
+# Iterate through all of the files (adding all of the videos to be unpacked by a process pool, as decoding is cpu bound)
+jobs = []
+for subject in args.subjects:
+    subject_dir = os.path.join(args.base_dir, "S{subject}/Videos/".format(subject=subject))
+    for filename in sorted(os.listdir(subject_dir)):
+        # Get the action and camera from filename. File format: action_name.camera_name.mp4
+        action, camera, _ = filename.split(".")
 
-            # Add job to pool
-            full_filename = os.path.join(subject_dir, filename)
-            pool.submit(process_video, subject, action, camera, full_filename, vid_output_dir)
+        # Skip the video that collects all of them together
+        if action == "_ALL" or action == "_ALL 1":
+            continue
 
+        jobs.append((subject, action, camera, os.path.join(subject_dir, filename)))
 
+pool = Pool(args.num_workers)
+pool.map(process_video, jobs, chunksize=1)
+pool.close()
+pool.join()
@@ -3,6 +3,7 @@ import torch.nn as nn
 
 from base_network import TinyMultiTaskResNet
 from utils import parameter_magnitude, gradient_magnitude, update_magnitude, update_ratio
+from utils.device import module_device
 
 
 
@@ -70,7 +71,7 @@ class FullyConnectedGan(nn.Module):
         :return: The samples, returned as a batch with shape (n, self.data_size)
         """
         shape = torch.Size((n, self.latent_size))
-        latents = torch.autograd.Variable(torch.rand(shape) * 2.0 - 1.0, requires_grad=True).cuda() # uni[-1,1]
+        latents = torch.autograd.Variable(torch.rand(shape, device=module_device(self.gen)) * 2.0 - 1.0, requires_grad=True) # uni[-1,1]
         return self.gen(latents)
 
 
@@ -6,6 +6,7 @@ from twod_threed.src.datasets.human36m import Human36M
 import twod_threed.src.misc as misc
 
 from utils import train_loop
+from utils.device import get_device, module_device, load_checkpoint
 from utils import parameter_magnitude, gradient_magnitude, update_magnitude, update_ratio
 
 
@@ -59,7 +60,7 @@ def _load_fn(model, optimizer, load_file):
     discriminator_optimizer, generator_optimizer = optimizer
 
     # Load state dict, and update the model and
-    checkpoint = torch.load(load_file)
+    checkpoint = load_checkpoint(load_file)
     cur_epoch = checkpoint['next_epoch']
     best_val_loss = checkpoint['best_val_loss']
     model.load_state_dict(checkpoint['model_state_dict'])
@@ -130,7 +131,7 @@ def _update_op(model, optimizer, minibatch, iter, args):
     discriminator_optimizer, generator_optimizer = optimizer
 
     # If minibatch is of shape (N,D), then we should sample N random samples from the generator
-    data = minibatch.cuda()
+    data = minibatch.to(module_device(model))
     N, D = list(data.size())
     generator_samples = model.sample(N)
 
@@ -194,15 +195,15 @@ def _grad_penalty(N, data, samples, discr):
     :return: The gradient penalty (A scalar PyTorch Variable)
     """
     # Interpolate between the generator samples and true data
-    alpha = torch.rand(N, 1)
-    alpha = alpha.expand_as(data).cuda()
+    alpha = torch.rand(N, 1, device=data.device)
+    alpha = alpha.expand_as(data)
     inter = alpha * data.data + (1-alpha) * samples.data
-    inter = torch.autograd.Variable(inter, requires_grad=True).cuda()
+    inter = torch.autograd.Variable(inter, requires_grad=True)
 
     # Compute gradient of discriminator at "interpolated", and use it for gradient penalty, 1e-12 for numerical stability
     probs = discr(inter)
     gradients = torch.autograd.grad(outputs=probs, inputs=inter,
-                                             grad_outputs=torch.ones(probs.size()).cuda(),
+                                             grad_outputs=torch.ones_like(probs),
                                              create_graph=True, retain_graph=True)[0]
     gradients_norm = torch.sqrt(torch.sum(gradients ** 2, dim=1) + 1e-12)
     return torch.mean(torch.sqrt((gradients_norm - 1.0) ** 2))
@@ -221,7 +222,7 @@ def validation_loss(model, minibatch):
     model.eval()
 
     # Compute samples
-    data = minibatch.cuda()
+    data = minibatch.to(module_device(model))
     N, D = minibatch.size()
     gen_samples = model.sample(N)
 
@@ -254,7 +255,7 @@ def train_3d_pose_gan(args):
     val_dataset = Human36M3DPoseDataset(actions=actions, data_path=args.data_dir, is_train=False)
     val_loader = DataLoader(dataset=val_dataset, batch_size=args.test_batch_size, shuffle=True,
                               num_workers=args.workers, pin_memory=True)
-    model = FullyConnectedGan(clip_max=args.clip_max).cuda()
+    model = FullyConnectedGan(clip_max=args.clip_max).to(get_device(args))
 
     train_loop(model, train_loader, val_loader, _make_optimizer_fn, _load_fn, _checkpoint_fn, _update_op,
                _validation_loss, args)
@@ -173,6 +173,8 @@ class Options:
         self._parser.add_argument('--use_horovod', action='store_true', help='Use to specify if horovod should be used to train on multiple GPUs concurrently.')
 
         self._parser.add_argument('--seed', type=int, default=234, help='Specify a seed for random generation (math/numpy/PyTorch).')
+        self._parser.add_argument('--device', type=str, default=None, help='The device to run on, "cpu", "cuda" or "cuda:<n>" (defaults to cuda if available, otherwise the cpu). See utils/device.py.')
+        self._parser.add_argument('--num_threads', type=int, default=None, help='The number of threads torch uses when running on the cpu (so that several cpu inference replicas can share a node).')
 
         # ===============================================================
         #                     run.py specific options
@@ -180,6 +182,15 @@ class Options:
         self._parser.add_argument('--process_as_video', dest='process_as_video', action='store_true',
                                  help='Process videos when using run.py with a network that operates on single frames')
         self._parser.add_argument('--run_with_train', action='store_true', help='If we want to run/visualize using the training set rather than the validation set.')
+        self._parser.add_argument('--video_batch_size', type=int, default=4096, help='The maximum number of frames (packed from one or more videos) to run the 2D to 3D network on at once in run.py (at least 1).')
+        self._parser.add_argument('--num_shards', type=int, default=1, help='Split the dataset into this many shards, to run inference with several processes (e.g. on cpu nodes, see --device and --num_threads).')
+        self._parser.add_argument('--shard_index', type=int, default=0, help='The shard of the dataset for this process to run inference on (with --num_shards).')
+        self._parser.add_argument('--camera', type=str, default='0', help='The camera index, or stream url, to run on in real time (run.py stitched_realtime), or "synthetic" for a synthetic camera.')
+        self._parser.add_argument('--realtime_frames', type=int, default=0, help='The number of frames to process in real time (run.py stitched_realtime), 0 to run until the stream ends (or Ctrl-C).')
+        self._parser.add_argument('--host', type=str, default='127.0.0.1', help='The address for the inference server (run.py stitched_server) to listen on.')
+        self._parser.add_argument('--port', type=int, default=8000, help='The port for the inference server (run.py stitched_server) to listen on.')
+        self._parser.add_argument('--server_max_batch_size', type=int, default=16, help='The largest number of concurrent requests that the inference server runs through the network at once.')
+        self._parser.add_argument('--server_max_latency_ms', type=float, default=5.0, help='The longest (in ms) that the inference server makes a request wait for other requests to batch it with.')
 
         # ===============================================================
         #                     viz.py specific options
@@ -193,6 +204,10 @@ class Options:
         self._parser.add_argument('--use_max_for_saliency_map', '--max_for_saliency', action="store_true", help="If we should use the max value from the prob scores (rather than a sum of values) when computing the saliency map.")
 
         self._parser.add_argument('--index', type=int, default=0, help='index into the dataset to use (orthogonal vizualization)')
+        self._parser.add_argument('--input_file', type=str, default='', help='The video to visualize (with the "video" script)')
+        self._parser.add_argument('--viz_batch_size', type=int, default=16, help='The number of video frames to run the network on at once (when visualizing a video)')
+        self._parser.add_argument('--viz_render_workers', type=int, default=4, help='The number of processes to render video frames with (when visualizing a video)')
+        self._parser.add_argument('--viz_queue_size', type=int, default=64, help='The maximum number of frames waiting between any two stages of the video visualization pipeline (bounds the memory used)')
         self._parser.add_argument('--num_orientations', type=int, default=16, help='the number of orientations to use in the orthogonal visualization')
 
 
@@ -202,6 +217,7 @@ class Options:
         self._parser.add_argument('--prediction_files', type=str, nargs='+', default=[], help='A comma seperated list of filenames for "predictions", output by stacked hourglass models.')
         self._parser.add_argument('--model_names', type=str, nargs='+', default=[], help='A comma seperated list of model names, corresponding to the models used to produce the predictions.')
         self._parser.add_argument('--output_filename', type=str, default=None, help='An output filename to save the graph to')
+        self._parser.add_argument('--metas', type=str, default='', help='File containing the meta data for the 3d pose estimations (saved by run.py), to compute their errors (per action) with')
 
         # ===============================================================
         #                     Hourglass model options
@@ -240,6 +256,8 @@ class Options:
         self._parser.add_argument('--schedule', type=int, nargs='+', default=[],
                             help='Decrease learning rate at these epochs.')
         self._parser.add_argument('--workers', type=int, default=6, help='The number of workers to use in a data loader (so training it bottelnecked by GPU not CPU')
+        self._parser.add_argument('--gpu_augment', action='store_true', help='Data loader workers only load (uint8) image regions and keypoints, and augmentation + heatmap generation is batched on the GPU (needs fewer workers)')
+        self._parser.add_argument('--cache_validation_set', action='store_true', help='Preprocess the (MPII) validation set once, into a memory mapped cache in .cache/mpii_val (~3GB each, the least recently used are evicted above 8GB), so validation epochs skip loading and cropping the images')
 
         # For data augmentation
         self._parser.add_argument('--augment_training_data', default=True, type=bool, help='Shoudl data be augmented in training?')
@@ -308,6 +326,7 @@ class Options:
         self._parser.add_argument('--dataset_normalization', action='store_true', help="If we want to revert to using dataset statistics for normalizing the input to the network, rather than normalizing per instance")
         self._parser.add_argument('--flip_prob', type=float, default=0.5, help="In the orthogonal data augmentation, the probability of performing a flip/reflection.")
         self._parser.add_argument('--drop_joint_prob', type=float, default=0.0, help="The probability of dropping each joint (independently) as input to the 3D baseline network.")
+        self._parser.add_argument('--resident_dataset', action='store_true', help="If we want to keep the whole (pose) dataset as tensors on the GPU, and augment/project/normalize batches there, rather than using a DataLoader.")
 
         # ===============================================================
         #                     "Generative models" training options
@@ -321,6 +340,7 @@ class Options:
         # ===============================================================
         self._parser.add_argument('--load_hourglass',  type=str, help='Checkpoint file for a pre-trained hourglass model.')
         self._parser.add_argument('--load_2d3d',       type=str, help='Checkpoint file for a pre-trained 2d3d model')
+        self._parser.add_argument('--img_shard_dir',   type=str, default=None, help='Directory of pre-cropped Human3.6m frame shards (see pack_frame_shards_script.py), to read frames from instead of decoding JPEGs.')
 
 
 
@@ -0,0 +1,55 @@
+import sys
+import os
+import scipy.misc
+import numpy as np
+from multiprocessing import Pool
+
+from utils.frame_shards import FrameShardWriter, shard_group_complete, img_crop_params, FRAME_RES
+import stacked_hourglass.pose.utils.transforms as hg_transforms
+
+
+# Tell people how to use this
+if len(sys.argv) != 4:
+    print("Usage: 'python pack_frame_shards_script <video_frames_dir> <shard_dir> <num_workers>'.")
+    print("Packs the frames output by extract_video_frames_script into (pre-cropped) frame shards.")
+    quit()
+
+
+# Unpack args
+frames_dir = sys.argv[1]
+shard_dir = sys.argv[2]
+num_workers = int(sys.argv[3])
+
+
+# Function to crop every frame from a (subject, action, camera) directory, and write them to a shard group
+def pack_video(args):
+    subject, action, camera = args
+    name = "S{s}.{a}.{c}".format(s=subject, a=action, c=camera)
+    if shard_group_complete(shard_dir, name):
+        print("Already packed subject '{s}', action '{a}', camera '{c}'".format(s=subject, a=action, c=camera))
+        return
+
+    print("Starting packing subject '{s}', action '{a}', camera '{c}':".format(s=subject, a=action, c=camera))
+    video_dir = os.path.join(frames_dir, subject, action, camera)
+    frames = sorted(int(filename.split(".")[0]) for filename in os.listdir(video_dir))
+    writer = FrameShardWriter(shard_dir, name)
+    for frame in frames:
+        img = scipy.misc.imread(os.path.join(video_dir, "{f}.jpg".format(f=frame)), mode='RGB')
+        center, scale = img_crop_params(img.shape[0], img.shape[1])
+        cropped_img = hg_transforms.crop_numpy(img, center, scale, [FRAME_RES, FRAME_RES], rot=0)
+        writer.add(int(subject), action, camera, frame, np.asarray(cropped_img, dtype=np.uint8), center, scale)
+    writer.close()
+    print("Finished packing subject '{s}', action '{a}', camera '{c}':".format(s=subject, a=action, c=camera))
+
+
+# Pack every (subject, action, camera) directory in a process pool (skipping any already packed, so can resume)
+videos = []
+for subject in sorted(os.listdir(frames_dir)):
+    for action in sorted(os.listdir(os.path.join(frames_dir, subject))):
+        for camera in sorted(os.listdir(os.path.join(frames_dir, subject, action))):
+            videos.append((subject, action, camera))
+
+pool = Pool(num_workers)
+pool.map(pack_video, videos)
+pool.close()
+pool.join()
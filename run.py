@@ -5,6 +5,8 @@ from __future__ import print_function, absolute_import, division
 from stacked_hourglass import run as run_hourglass_mpii
 from stitched import run_mpii as run_stitched_mpii
 from stitched import run_h36m as run_stitched_h36m
+from stitched import run_realtime as run_stitched_realtime
+from stitched import run_server as run_stitched_server
 from twod_threed import run as run_twod_to_threed_h36m
 
 # Absolute imports
@@ -61,6 +63,32 @@ def stitched_h36m(options):
 
 
 
+def stitched_realtime(options):
+    """
+    Script to run the stitched network in real time, on a live camera or stream (keeping only the latest frame)
+    options.load (or options.load_hourglass and options.load_2d3d): specifies the saved model(s)
+    options.camera: specifies the camera index or stream url (or "synthetic")
+    options.realtime_frames: specifies the number of frames to process (0 for until the stream ends)
+
+    :param options: Options for the training, defined in options.py. (Including defaults).
+    """
+    run_stitched_realtime(options)
+
+
+
+def stitched_server(options):
+    """
+    Script to serve the stitched network over (local) HTTP, loading it once and micro-batching concurrent requests
+    options.load (or options.load_hourglass and options.load_2d3d): specifies the saved model(s)
+    options.host, options.port: specifies the address to listen on
+    options.server_max_batch_size, options.server_max_latency_ms: specifies the batch size and latency budget
+
+    :param options: Options for the training, defined in options.py. (Including defaults).
+    """
+    run_stitched_server(options)
+
+
+
 
 
 
@@ -82,3 +110,7 @@ if __name__ == "__main__":
         stitched_mpii(options)
     elif script == "stitched_h36m":
         stitched_h36m(options)
+    elif script == "stitched_realtime":
+        stitched_realtime(options)
+    elif script == "stitched_server":
+        stitched_server(options)
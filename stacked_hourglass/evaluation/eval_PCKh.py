@@ -1,114 +1,191 @@
 from scipy.io import loadmat
 from numpy import transpose
-import skimage.io as sio
-from utils import visualize
 import numpy as np
 import os
-import sys
 
 
-valid_preds_file = sys.argv[1] # 'checkpoint/mpii/' + model_name + '/preds_valid.mat', model_name='hg4'
+GT_PREDS_PRT1_FILE = 'stacked_hourglass/evaluation/data/detections.mat'
+GT_PREDS_PRT2_FILE = 'stacked_hourglass/evaluation/data/detections_our_format.mat'
+SC_BIAS = 0.6
 
-def compute_PCKh_curve(pred_filename, modelname):
-    """
-    Print the PCKh@0.5 scores for a model and returns a vector of PCKh@x scores. (This was a script int he original
-    version of this repo.
+# The joints (by their names in 'dataset_joints') averaged for each of the reported scores and curves
+PCKH_JOINT_GROUPS = [
+    ('Head', ['head']),
+    ('Shoulder', ['lsho', 'rsho']),
+    ('Elbow', ['lelb', 'relb']),
+    ('Wrist', ['lwri', 'rwri']),
+    ('Hip', ['lhip', 'rhip']),
+    ('Knee', ['lkne', 'rkne']),
+    ('Ankle', ['lank', 'rank']),
+]
 
-    Michael: Not touching this code other than wrapping it in a script...
+# Ground truths loaded so far, keyed by the (filename, mtime) of the two .mat files, so they're only read once
+_ground_truth_cache = {}
 
-    :param filename: THe filename of the predictions saved by the stacked hourglass network
-    :return: PCKh, an array where PCKh[i] is the PCKh@(i*0.01) score
+
+
+def load_PCKh_ground_truth(gt_preds_prt1_file=GT_PREDS_PRT1_FILE, gt_preds_prt2_file=GT_PREDS_PRT2_FILE):
+    """
+    Loads the MPII validation ground truth needed for PCKh, caching it in memory so that the .mat files are read at
+    most once per process (unless they change on disk).
+
+    :param gt_preds_prt1_file: The 'detections.mat' file
+    :param gt_preds_prt2_file: The 'detections_our_format.mat' file
+    :return: A dictionary with 'joint_idxs' (joint name -> index), 'pos_gt_src' (N, 16, 2), 'jnt_visible' (16, N),
+        'jnt_count' (16,), 'headsizes' (N,) (already scaled by SC_BIAS) and 'det_idxs'
     """
-    gt_preds_prt1_file = 'stacked_hourglass/evaluation/data/detections.mat' # sys.argv[2] # 'stacked_hourglass/evaluation/data/detections.mat'
-    gt_preds_prt2_file = 'stacked_hourglass/evaluation/data/detections_our_format.mat' # sys.argv[3] # 'stacked_hourglassevaluation/data/detections_our_format.mat'
+    key = tuple((os.path.abspath(f), os.path.getmtime(f)) for f in (gt_preds_prt1_file, gt_preds_prt2_file))
+    if key in _ground_truth_cache:
+        return _ground_truth_cache[key]
 
     detection = loadmat(gt_preds_prt1_file)
-    det_idxs = detection['RELEASE_img_index']
-    debug = 0
-    threshold = 0.5
-    SC_BIAS = 0.6
-
-    pa = [2, 3, 7, 7, 4, 5, 8, 9, 10, 0, 12, 13, 8, 8, 14, 15]
-
-    dict = loadmat(gt_preds_prt2_file)
-    dataset_joints = dict['dataset_joints']
-    jnt_missing = dict['jnt_missing']
-    pos_gt_src = dict['pos_gt_src']
-    headboxes_src = dict['headboxes_src']
-
-    #predictions
-    predfile = pred_filename
-    preds = loadmat(predfile)['preds']
-    pos_pred_src = transpose(preds, [1, 2, 0])
-
-
-    if debug:
-
-        for i in range(len(det_idxs[0])):
-            anno = mat['RELEASE']['annolist'][0, 0][0][det_idxs[0][i] - 1]
-            fn = anno['image']['name'][0, 0][0]
-            imagePath = '/data/mpii/images/' + fn
-            oriImg = sio.imread(imagePath)
-            pred = pos_pred_src[:, :, i]
-            visualize(oriImg, pred, pa)
-
-
-    head = np.where(dataset_joints == 'head')[1][0]
-    lsho = np.where(dataset_joints == 'lsho')[1][0]
-    lelb = np.where(dataset_joints == 'lelb')[1][0]
-    lwri = np.where(dataset_joints == 'lwri')[1][0]
-    lhip = np.where(dataset_joints == 'lhip')[1][0]
-    lkne = np.where(dataset_joints == 'lkne')[1][0]
-    lank = np.where(dataset_joints == 'lank')[1][0]
-
-    rsho = np.where(dataset_joints == 'rsho')[1][0]
-    relb = np.where(dataset_joints == 'relb')[1][0]
-    rwri = np.where(dataset_joints == 'rwri')[1][0]
-    rkne = np.where(dataset_joints == 'rkne')[1][0]
-    rank = np.where(dataset_joints == 'rank')[1][0]
-    rhip = np.where(dataset_joints == 'rhip')[1][0]
-
-    jnt_visible = 1 - jnt_missing
-    uv_error = pos_pred_src - pos_gt_src
-    uv_err = np.linalg.norm(uv_error, axis=1)
+    gt = loadmat(gt_preds_prt2_file)
+    dataset_joints = gt['dataset_joints']
+    jnt_visible = 1 - gt['jnt_missing']
+    headboxes_src = gt['headboxes_src']
+
     headsizes = headboxes_src[1, :, :] - headboxes_src[0, :, :]
-    headsizes = np.linalg.norm(headsizes, axis=0)
-    headsizes *= SC_BIAS
-    scale = np.multiply(headsizes, np.ones((len(uv_err), 1)))
-    scaled_uv_err = np.divide(uv_err, scale)
-    scaled_uv_err = np.multiply(scaled_uv_err, jnt_visible)
-    jnt_count = np.sum(jnt_visible, axis=1)
-    less_than_threshold = np.multiply((scaled_uv_err < threshold), jnt_visible)
-    PCKh = np.divide(100. * np.sum(less_than_threshold, axis=1), jnt_count)
-
-
-    # save
-    rng = np.arange(0, 0.5, 0.01)
-    pckAll = np.zeros((len(rng), 16))
-
-    for r in range(len(rng)):
-        threshold = rng[r]
-        less_than_threshold = np.multiply(scaled_uv_err < threshold, jnt_visible)
-        pckAll[r, :] = np.divide(100.*np.sum(less_than_threshold, axis=1), jnt_count)
-
-    name = predfile.split(os.sep)[-1]
-    PCKh = np.ma.array(PCKh, mask=False)
-    PCKh.mask[6:8] = True
-    print("Model,  Head,   Shoulder, Elbow,  Wrist,   Hip ,     Knee  , Ankle ,  Mean")
-    print('{:s}   {:.2f}  {:.2f}     {:.2f}  {:.2f}   {:.2f}   {:.2f}   {:.2f}   {:.2f}'.format(modelname, PCKh[head], 0.5 * (PCKh[lsho] + PCKh[rsho])\
-            , 0.5 * (PCKh[lelb] + PCKh[relb]),0.5 * (PCKh[lwri] + PCKh[rwri]), 0.5 * (PCKh[lhip] + PCKh[rhip]), 0.5 * (PCKh[lkne] + PCKh[rkne]) \
-            , 0.5 * (PCKh[lank] + PCKh[rank]), np.mean(PCKh)))
-
-    # Compute all of the curves we want
-    curves = {
-        'Mean': np.mean(pckAll, axis=1),
-        'Head': pckAll[:,head],
-        'Shoulder': 0.5 * (pckAll[:,lsho] + pckAll[:,rsho]),
-        'Elbow': 0.5 * (pckAll[:,lelb] + pckAll[:,relb]),
-        'Wrist': 0.5 * (pckAll[:,lwri] + pckAll[:,rwri]),
-        'Hip': 0.5 * (pckAll[:,lhip] + pckAll[:,rhip]),
-        'Knee': 0.5 * (pckAll[:,lkne] + pckAll[:,rkne]),
-        'Ankle': 0.5 * (pckAll[:,lank] + pckAll[:,rank]),
+    headsizes = np.linalg.norm(headsizes, axis=0) * SC_BIAS
+
+    ground_truth = {
+        'joint_idxs': dict((joint, np.where(dataset_joints == joint)[1][0])
+                           for _, joints in PCKH_JOINT_GROUPS for joint in joints),
+        'pos_gt_src': np.ascontiguousarray(transpose(gt['pos_gt_src'], [2, 0, 1])),
+        'jnt_visible': jnt_visible,
+        'jnt_count': np.sum(jnt_visible, axis=1),
+        'headsizes': headsizes,
+        'det_idxs': detection['RELEASE_img_index'],
     }
+    _ground_truth_cache[key] = ground_truth
+    return ground_truth
+
 
-    return curves
\ No newline at end of file
+
+class PCKhEvaluator(object):
+    """
+    Computes PCKh scores and curves (PCKh@t for each threshold t) on the MPII validation set, for any number of models
+    at once.
+
+    The ground truth is loaded once (and cached), and all of the thresholds, joints and examples of a chunk of models
+    are computed in one broadcasted numpy pass, of shape (models x thresholds x joints x N). So comparing many
+    checkpoints only costs reading each of their prediction files.
+    """
+    def __init__(self, thresholds=None, gt_preds_prt1_file=GT_PREDS_PRT1_FILE,
+                 gt_preds_prt2_file=GT_PREDS_PRT2_FILE, models_per_chunk=8):
+        """
+        :param thresholds: The thresholds to compute the curves at (defaults to 0.0, 0.01, ..., 0.49)
+        :param gt_preds_prt1_file: The 'detections.mat' file
+        :param gt_preds_prt2_file: The 'detections_our_format.mat' file
+        :param models_per_chunk: The number of models broadcast over at once (bounds the memory used)
+        """
+        self.thresholds = np.arange(0, 0.5, 0.01) if thresholds is None else np.asarray(thresholds)
+        self.ground_truth = load_PCKh_ground_truth(gt_preds_prt1_file, gt_preds_prt2_file)
+        self.models_per_chunk = models_per_chunk
+
+
+
+    def scaled_errors(self, preds):
+        """
+        :param preds: A (models, N, 16, 2) array of predictions
+        :return: The (models, 16, N) errors, scaled by the head sizes (and zero for joints that aren't visible)
+        """
+        gt = self.ground_truth
+        uv_err = np.linalg.norm(preds - gt['pos_gt_src'], axis=3)
+        scaled_uv_err = uv_err / gt['headsizes'][:, None]
+        return np.transpose(scaled_uv_err, [0, 2, 1]) * gt['jnt_visible']
+
+
+
+    def evaluate(self, preds, model_names):
+        """
+        Computes the PCKh@0.5 scores and the PCKh curves of a set of models.
+
+        :param preds: A (models, N, 16, 2) array of predictions (or a list of (N, 16, 2) arrays), in the same format as
+            the 'preds' saved by the stacked hourglass network
+        :param model_names: A name for each model
+        :return: A dictionary from model name to a dictionary of its results:
+            'PCKh': (16,) masked array of per joint PCKh@0.5 scores (with the pelvis and thorax masked)
+            'scores': dictionary of the PCKh@0.5 for each of the joint groups, and 'Mean'
+            'curves': dictionary of the PCKh curve for each of the joint groups, and 'Mean'
+            'pck_all': (thresholds, 16) array of the per joint PCKh@t scores
+        """
+        preds = np.asarray(preds, dtype=np.float64)
+        if len(preds) != len(model_names):
+            raise Exception("Need a name for each model")
+
+        # Threshold 0.5 is appended to the curve's thresholds, so it's computed in the same pass
+        thresholds = np.append(self.thresholds, 0.5)
+        gt = self.ground_truth
+        counts = []
+        for i in range(0, len(preds), self.models_per_chunk):
+            scaled_uv_err = self.scaled_errors(preds[i:i+self.models_per_chunk])
+            less_than_threshold = (scaled_uv_err[:, None] < thresholds[None, :, None, None]) & \
+                                  (gt['jnt_visible'] > 0)
+            counts.append(np.sum(less_than_threshold, axis=3))
+        pck = 100. * np.concatenate(counts, axis=0) / gt['jnt_count']
+
+        results = {}
+        for name, model_pck in zip(model_names, pck):
+            PCKh = np.ma.array(model_pck[-1], mask=False)
+            PCKh.mask[6:8] = True
+            pck_all = model_pck[:-1]
+            scores = dict((group, self._group_mean(PCKh, joints)) for group, joints in PCKH_JOINT_GROUPS)
+            scores['Mean'] = np.mean(PCKh)
+            curves = dict((group, self._group_mean(pck_all.T, joints)) for group, joints in PCKH_JOINT_GROUPS)
+            curves['Mean'] = np.mean(pck_all, axis=1)
+            results[name] = {'PCKh': PCKh, 'scores': scores, 'curves': curves, 'pck_all': pck_all}
+        return results
+
+
+
+    def evaluate_files(self, pred_filenames, model_names):
+        """
+        Computes the PCKh@0.5 scores and the PCKh curves of models from their prediction files.
+
+        :param pred_filenames: The filenames of the predictions saved by the stacked hourglass network
+        :param model_names: A name for each model
+        :return: The results dictionary, as returned by 'evaluate'
+        """
+        preds = [loadmat(filename)['preds'] for filename in pred_filenames]
+        return self.evaluate(preds, model_names)
+
+
+
+    def _group_mean(self, pck, joints):
+        """
+        The mean of the (per joint) 'pck' (indexed by joint in its first dimension) over the named 'joints'
+        """
+        idxs = self.ground_truth['joint_idxs']
+        return sum(pck[idxs[joint]] for joint in joints) / float(len(joints))
+
+
+
+def print_PCKh_scores(results, model_names=None):
+    """
+    Print the PCKh@0.5 scores for each model in a dictionary of results from PCKhEvaluator.evaluate
+
+    :param results: The results from PCKhEvaluator.evaluate
+    :param model_names: The models to print (in order), defaults to all of them
+    """
+    print("Model,  Head,   Shoulder, Elbow,  Wrist,   Hip ,     Knee  , Ankle ,  Mean")
+    for modelname in (results if model_names is None else model_names):
+        scores = results[modelname]['scores']
+        print('{:s}   {:.2f}  {:.2f}     {:.2f}  {:.2f}   {:.2f}   {:.2f}   {:.2f}   {:.2f}'.format(modelname,
+              scores['Head'], scores['Shoulder'], scores['Elbow'], scores['Wrist'], scores['Hip'], scores['Knee'],
+              scores['Ankle'], scores['Mean']))
+
+
+
+def compute_PCKh_curve(pred_filename, modelname):
+    """
+    Print the PCKh@0.5 scores for a model and returns a vector of PCKh@x scores. (This was a script int he original
+    version of this repo.
+
+    To evaluate many models, use PCKhEvaluator.evaluate_files directly, which computes them all in one pass.
+
+    :param filename: THe filename of the predictions saved by the stacked hourglass network
+    :return: A dictionary of curves (for each joint group, and 'Mean'), where curve[i] is the PCKh@(i*0.01) score
+    """
+    results = PCKhEvaluator().evaluate_files([pred_filename], [modelname])
+    print_PCKh_scores(results)
+    return results[modelname]['curves']
@@ -16,11 +16,13 @@ import horovod.torch as hvd
 
 from stacked_hourglass.pose import Bar
 from stacked_hourglass.pose.utils.logger import Logger, savefig
-from stacked_hourglass.pose.utils.evaluation import accuracy_PCK, accuracy_PCKh, final_preds
+from stacked_hourglass.pose.utils.evaluation import accuracy_PCK, PCKhAccuracy, final_preds
 from stacked_hourglass.pose.utils.misc import save_checkpoint, save_pred, adjust_learning_rate
+from utils.device import get_device, module_device, load_checkpoint
 from utils.osutils import mkdir_p, isfile, isdir, join
 from stacked_hourglass.pose.utils.imutils import batch_with_heatmap
 from stacked_hourglass.pose.utils.transforms import fliplr, flip_back
+from stacked_hourglass.pose.utils.batch_augmentation import BatchAugmentation, collate_raw
 from stacked_hourglass.pose.models import HourglassNet, JointVisibilityNet
 import stacked_hourglass.pose.datasets as datasets
 
@@ -64,14 +66,16 @@ def main(args):
         hvd.init()
         torch.cuda.set_device(hvd.local_rank())
         args.lr *= hvd.size()
-        model.cuda()
+        device = get_device(args)
+        model.to(device)
     else:
-        model = model.cuda()
+        device = get_device(args)
+        model = model.to(device)
         if args.predict_joint_visibility:
-            joint_visibility_model = joint_visibility_model.cuda()
+            joint_visibility_model = joint_visibility_model.to(device)
 
     # define loss function (criterion) and optimizer
-    criterion = torch.nn.MSELoss(size_average=True).cuda()
+    criterion = torch.nn.MSELoss(size_average=True).to(device)
     joint_visibility_criterion = None if not args.predict_joint_visibility else torch.nn.BCEWithLogitsLoss()
     params = [{'params': model.parameters(), 'lr': args.lr}]
     if args.predict_joint_visibility:
@@ -98,7 +102,7 @@ def main(args):
     if args.load:
         if isfile(args.load):
             print("=> loading checkpoint '{}'".format(args.load))
-            checkpoint = torch.load(args.load)
+            checkpoint = load_checkpoint(args.load)
 
             # remove old usage of data parallel (used to be wrapped around model) # TODO: remove this when no old models used this
             state_dict = {}
@@ -127,6 +131,10 @@ def main(args):
 
     # Data loading code
     train_dataset, train_loader, val_loader = _make_torch_data_loaders(args)
+    train_augmenter, val_augmenter = None, None
+    if args.gpu_augment:
+        train_augmenter = BatchAugmentation(train_loader.dataset)
+        val_augmenter = BatchAugmentation(val_loader.dataset)
 
     if args.evaluate:
         print('\nEvaluation only') 
@@ -153,12 +161,14 @@ def main(args):
                                       tb_freq=args.tb_log_freq, no_grad_clipping=args.no_grad_clipping,
                                       grad_clip=args.grad_clip, use_horovod=args.use_horovod,
                                       predict_joint_visibility=args.predict_joint_visibility,
-                                      predict_joint_loss_coeff=args.joint_visibility_loss_coeff)
+                                      predict_joint_loss_coeff=args.joint_visibility_loss_coeff,
+                                      augmenter=train_augmenter)
 
         # evaluate on validation set
         valid_loss, valid_acc_PCK, valid_acc_PCKh, valid_acc_PCKh_per_joint, valid_joint_visibility_loss, valid_joint_visibility_acc, predictions = validate(
                                         val_loader, model, joint_visibility_model, criterion, joint_visibility_criterion, args.num_classes, args.debug, args.flip,
-                                        args.use_horovod, args.use_train_mode_to_eval, args.predict_joint_visibility)
+                                        args.use_horovod, args.use_train_mode_to_eval, args.predict_joint_visibility,
+                                        augmenter=val_augmenter)
 
         # append logger file, and write to tensorboard summaries
         writer.add_scalars('data/epoch/losses_wrt_epochs', {'train_loss': train_loss, 'test_lost': valid_loss}, epoch)
@@ -216,25 +226,28 @@ def _make_torch_data_loaders(args):
                                 'stacked_hourglass/data/mpii/images',
                                 sigma=args.sigma, label_type=args.label_type, train=False, augment_data=False, args=args)
 
+    # With gpu augmentation the items are (differently sized) image regions, which need padding to be batched
+    collate_fn = collate_raw if args.gpu_augment else torch.utils.data.dataloader.default_collate
+
     if args.use_horovod:
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset, num_replicas=hvd.size(),
                                                                         rank=hvd.rank())
         train_loader = torch.utils.data.DataLoader(train_dataset,
                                                    batch_size=args.train_batch_size, sampler=train_sampler,
                                                    # shuffle=True,#sampler=train_sampler,
-                                                   num_workers=args.workers, pin_memory=True)
+                                                   num_workers=args.workers, pin_memory=True, collate_fn=collate_fn)
         val_sampler = torch.utils.data.distributed.DistributedSampler(val_dataset, num_replicas=hvd.size(),
                                                                       rank=hvd.rank())
         val_loader = torch.utils.data.DataLoader(val_dataset,
                                                  batch_size=args.test_batch_size, sampler=val_sampler,
                                                  # shuffle=False, #sampler=val_sampler,
-                                                 num_workers=args.workers, pin_memory=True)
+                                                 num_workers=args.workers, pin_memory=True, collate_fn=collate_fn)
     else:
         train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.train_batch_size, shuffle=True,
-                                                   num_workers=args.workers, pin_memory=True)
+                                                   num_workers=args.workers, pin_memory=True, collate_fn=collate_fn)
 
         val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.test_batch_size, shuffle=False,
-                                                 num_workers=args.workers, pin_memory=True)
+                                                 num_workers=args.workers, pin_memory=True, collate_fn=collate_fn)
 
     return train_dataset, train_loader, val_loader
 
@@ -245,7 +258,7 @@ def _make_torch_data_loaders(args):
 def train(train_loader, model, joint_visibility_model, criterion, num_joints, joint_visibility_criterion, optimizer,
           epoch, writer, lr, debug=False, flip=True, remove_intermediate_supervision=False, tb_freq=100,
           no_grad_clipping=False, grad_clip=10.0, use_horovod=False, predict_joint_visibility=False,
-          predict_joint_loss_coeff=0.0):
+          predict_joint_loss_coeff=0.0, augmenter=None):
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
@@ -264,13 +277,18 @@ def train(train_loader, model, joint_visibility_model, criterion, num_joints, jo
     epoch_beg_iter = epoch * epoch_len
 
     gt_win, pred_win = None, None
+    device = module_device(model)
     bar = Bar('Processing', max=epoch_len)
     for i, (inputs, target, meta) in enumerate(train_loader):
         # measure data loading time
         data_time.update(time.time() - end)
 
-        input_var = torch.autograd.Variable(inputs.cuda())
-        target_var = torch.autograd.Variable(target.cuda(async=True))
+        # If augmenting on the gpu, the loader only gives image regions and keypoints (see batch_augmentation)
+        if augmenter is not None:
+            inputs, target, meta = augmenter(inputs.to(device), target, meta)
+
+        input_var = torch.autograd.Variable(inputs.to(device))
+        target_var = torch.autograd.Variable(target.to(device, non_blocking=True))
 
         # compute output
         output = model(input_var)
@@ -281,20 +299,20 @@ def train(train_loader, model, joint_visibility_model, criterion, num_joints, jo
         if not remove_intermediate_supervision:
             for j in range(len(output)-2, -1, -1):
                 loss += criterion(output[j], target_var)
-        acc = accuracy_PCK(score_map, target, idx)
+        acc = accuracy_PCK(output[-1].data, target_var.data, idx).cpu()
 
         # Add joint visibility loss if necessary
         if predict_joint_visibility:
             visibility_input = torch.stack(output, dim=2).view(inputs.size(0) * num_joints, -1)
-            visibility_gts = _joint_visibility_ground_truths_from_meta(meta)
+            visibility_gts = _joint_visibility_ground_truths_from_meta(meta, device)
             visibility_pred_logits = joint_visibility_model(visibility_input)
             visibility_loss = joint_visibility_criterion(visibility_pred_logits, visibility_gts)
             visibility_acc = _joint_visibility_acc(visibility_pred_logits, visibility_gts)
             loss += predict_joint_loss_coeff * visibility_loss
 
         if debug: # visualize groundtruth and predictions
-            gt_batch_img = batch_with_heatmap(inputs, target)
-            pred_batch_img = batch_with_heatmap(inputs, score_map)
+            gt_batch_img = batch_with_heatmap(inputs.cpu(), target.cpu())
+            pred_batch_img = batch_with_heatmap(inputs.cpu(), score_map.cpu())
             if not gt_win or not pred_win:
                 ax1 = plt.subplot(121)
                 ax1.title.set_text('Groundtruth')
@@ -379,7 +397,7 @@ def train(train_loader, model, joint_visibility_model, criterion, num_joints, jo
 
 
 
-def validate(val_loader, model, joint_visibility_model, criterion, joint_visibility_criterion, num_classes, debug=False, flip=True, use_horovod=False, use_train_mode_to_eval=False, predict_joint_visibility=False):
+def validate(val_loader, model, joint_visibility_model, criterion, joint_visibility_criterion, num_classes, debug=False, flip=True, use_horovod=False, use_train_mode_to_eval=False, predict_joint_visibility=False, augmenter=None):
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -399,33 +417,40 @@ def validate(val_loader, model, joint_visibility_model, criterion, joint_visibil
             joint_visibility_model.eval()
 
     gt_win, pred_win = None, None
+    device = module_device(model)
+    accuracy_PCKh = PCKhAccuracy(val_loader.dataset.get_headboxes(), val_loader.dataset.joint_idxs, device)
     end = time.time()
     bar = Bar('Processing', max=len(val_loader))
     for i, (inputs, target, meta) in enumerate(val_loader):
         # measure data loading time
         data_time.update(time.time() - end)
 
-        target = target.cuda(async=True)
+        # If augmenting on the gpu, the loader only gives image regions and keypoints (see batch_augmentation)
+        if augmenter is not None:
+            inputs, target, meta = augmenter(inputs.to(device), target, meta)
 
-        input_var = torch.autograd.Variable(inputs.cuda(), volatile=True)
+        inputs = inputs.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
+
+        input_var = torch.autograd.Variable(inputs, volatile=True)
         target_var = torch.autograd.Variable(target, volatile=True)
 
         # compute output
         output = model(input_var)
-        score_map = output[-1].data.cpu()
+        score_map = output[-1].data.clone()
         if flip:
             flip_input_var = torch.autograd.Variable(
-                    torch.from_numpy(fliplr(inputs.clone().numpy())).float().cuda(),
+                    torch.from_numpy(fliplr(inputs.cpu().clone().numpy())).float().to(device),
                     volatile=True
                 )
             flip_output_var = model(flip_input_var)
             flip_output = flip_back(flip_output_var[-1].data.cpu())
-            score_map += flip_output
+            score_map += flip_output.to(device)
 
         # Compute visibilities (reshape the output to (batchsize * numjoints, numstacks * width * height)
         if predict_joint_visibility:
             visibility_input = torch.stack(output, dim=2).view(inputs.size(0)*num_classes, -1)
-            visibility_gts = _joint_visibility_ground_truths_from_meta(meta)
+            visibility_gts = _joint_visibility_ground_truths_from_meta(meta, device)
             visibility_pred_logits = joint_visibility_model(visibility_input)
             visibility_loss = joint_visibility_criterion(visibility_pred_logits, visibility_gts)
             visibility_acc = _joint_visibility_acc(visibility_pred_logits, visibility_gts)
@@ -434,18 +459,17 @@ def validate(val_loader, model, joint_visibility_model, criterion, joint_visibil
         loss = 0
         for o in output:
             loss += criterion(o, target_var)
-        acc_PCK = accuracy_PCK(score_map, target.cpu(), idx)
-        acc_PCKh, acc_PCKh_per_joint = accuracy_PCKh(score_map, target.cpu(), meta, idx, val_loader.dataset.joint_idxs)
+        acc_PCK = accuracy_PCK(score_map, target, idx)
 
-        # generate predictions
+        # generate predictions (on the device, where PCKh is computed from them)
         preds = final_preds(score_map, meta['center'], meta['scale'], [64, 64])
-        for n in range(score_map.size(0)):
-            predictions[meta['index'][n], :, :] = preds[n, :, :]
+        acc_PCKh, acc_PCKh_per_joint = accuracy_PCKh(score_map, meta, preds=preds)
+        predictions[meta['index']] = preds.cpu()
 
 
         if debug:
-            gt_batch_img = batch_with_heatmap(inputs, target)
-            pred_batch_img = batch_with_heatmap(inputs, score_map)
+            gt_batch_img = batch_with_heatmap(inputs.cpu(), target.cpu())
+            pred_batch_img = batch_with_heatmap(inputs.cpu(), score_map.cpu())
             if not gt_win or not pred_win:
                 plt.subplot(121)
                 gt_win = plt.imshow(gt_batch_img)
@@ -514,15 +538,15 @@ def _joint_visibility_acc(logits, ground_truth_visibilities):
 
 
 
-def _joint_visibility_ground_truths_from_meta(meta):
+def _joint_visibility_ground_truths_from_meta(meta, device):
     """
-    Get the joint visibilities from the meta variable
+    Get the joint visibilities from the meta variable (on 'device')
     This could be of the shape [batch_size, num_joints, 1], but we will return it as [batch_size * num_joints, 1] with reshaping
     """
     points = meta['pts']
     vis = points[:,:,2]
     batch_size, num_joints = list(vis.size())
-    return vis.view(batch_size * num_joints, 1).cuda()
+    return vis.view(batch_size * num_joints, 1).to(device)
 
 
 
@@ -1,5 +1,6 @@
 from __future__ import print_function, absolute_import
 
+import hashlib
 import os
 import numpy as np
 import json
@@ -11,11 +12,37 @@ from scipy.io import loadmat
 import torch
 import torch.utils.data as data
 
+from utils import cache_utils
 from utils.osutils import *
 from stacked_hourglass.pose.utils.imutils import *
 from stacked_hourglass.pose.utils.transforms import *
 
 
+# Version of the code computing the (cached) mean and std, bump to invalidate the cached values (see cache_utils)
+MEANSTD_VERSION = 1
+
+# Directory (and version) of the memory mapped validation set caches (see Mpii._load_val_cache). Each cache is ~3GB
+# (for the default resolutions), the least recently used are evicted to keep the directory under MAX_VAL_CACHE_BYTES
+VAL_CACHE_DIR = ".cache/mpii_val"
+VAL_CACHE_VERSION = 1
+MAX_VAL_CACHE_BYTES = 2 ** 33
+
+DETECTIONS_FILE = 'stacked_hourglass/evaluation/data/detections_our_format.mat'
+
+# The contents of DETECTIONS_FILE, loaded at most once per process (every dataset instance needs it)
+_detections = {}
+
+
+
+def _load_detections(filename=DETECTIONS_FILE):
+    """
+    Load (and cache) the .mat file with the validation set's headboxes and joint names
+    """
+    if filename not in _detections:
+        _detections[filename] = loadmat(filename)
+    return _detections[filename]
+
+
 class Mpii(data.Dataset):
     """
     Dataset that produces img, 2d pose, meta triples. Where meta contains lots of additional information
@@ -23,6 +50,7 @@ class Mpii(data.Dataset):
     """
     def __init__(self, jsonfile, img_folder, inp_res=256, out_res=64, train=True, sigma=1, scale_factor=0.25, \
                  rot_factor=30, label_type='Gaussian', mean=None, stddev=None, augment_data=True, args=None):
+        self.jsonfile = jsonfile        # annotations file
         self.img_folder = img_folder    # root image folders
         self.is_train = train           # training set or test set
         self.inp_res = inp_res
@@ -33,6 +61,12 @@ class Mpii(data.Dataset):
         self.label_type = label_type
         self.augment_data = augment_data
         self.add_random_masking = args is not None and args.add_random_masking
+        self.gpu_augment = args is not None and args.gpu_augment
+
+        self.cache_validation_set = args is not None and args.cache_validation_set
+        self._val_cache = None
+        self._val_cache_dir = None
+        self._val_cache_sigma = None
 
         # Args for when there is random masking
         if self.add_random_masking:
@@ -58,7 +92,7 @@ class Mpii(data.Dataset):
         # Marge joint visibility data and headbox data into self.anno
         # We only have this for the validation set, and we have to trust the authors that headboxes_src is correct
         # Shape of headboxes_src is (2,2,validation_dataset_size)
-        dict = loadmat('stacked_hourglass/evaluation/data/detections_our_format.mat')
+        dict = _load_detections()
         if not self.is_train:
             headboxes_src = dict['headboxes_src']
             for i in range(len(self.valid)):
@@ -89,19 +123,33 @@ class Mpii(data.Dataset):
         else:
             self.mean, self.std = self._compute_mean()
 
+        # The validation set is deterministic (without augmentation), so it can be preprocessed once and memory mapped
+        if self.cache_validation_set and not self.is_train and not self.augment_data and \
+                not self.add_random_masking and not self.gpu_augment:
+            self._load_val_cache(workers=args.workers)
+
 
     def _compute_mean(self):
         """
         Helper function to compuete the mean and std of the dataset for normalization
         :return: mean, std dev
         """
-        # Load from cache if it exists
-        dataset_specific_cache_file = ".cache/mpii_meanstd"
-        if isfile(dataset_specific_cache_file):
-            meanstd = torch.load(dataset_specific_cache_file)
-            self.mean, self.std = meanstd["mean"], meanstd["stddev"]
-            return self.mean, self.std
+        # Load from cache if it exists (keyed by the annotations and images used)
+        inputs = {
+            "files": cache_utils.file_fingerprints([self.jsonfile, self.img_folder]),
+            "train_imgs": hashlib.sha1(",".join(self.anno[index]['img_paths'] for index in self.train)
+                                       .encode("utf-8")).hexdigest(),
+        }
+        meanstd = cache_utils.cached("mpii_meanstd", inputs, self._compute_mean_uncached, version=MEANSTD_VERSION)
+        self.mean, self.std = meanstd["mean"], meanstd["stddev"]
+        return self.mean, self.std
+
 
+    def _compute_mean_uncached(self):
+        """
+        Computes the mean and std for _compute_mean (which caches them, as it's slow)
+        :return: {"mean": mean, "stddev": std dev}
+        """
         mean = torch.zeros(3)
         std = torch.zeros(3)
         train_len = len(self.train)
@@ -118,21 +166,17 @@ class Mpii(data.Dataset):
             print('    Mean: %.4f, %.4f, %.4f' % (mean[0], mean[1], mean[2]))
             print('    Std:  %.4f, %.4f, %.4f' % (std[0], std[1], std[2]))
 
-        # Cache the computation (as it's slow)
-        if not isdir(".cache"):
-            mkdir_p(".cache")
-        cache = {"mean": mean, "stddev": std}
-        torch.save(cache, dataset_specific_cache_file)
-
-        return mean, std
+        return {"mean": mean, "stddev": std}
 
 
     def set_mean_stddev(self, mean, stddev):
         """
-        Setter
+        Setter (the validation cache is dropped, as it was normalized with the old mean and std)
         """
         self.mean = mean
         self.std = stddev
+        self._val_cache = None
+        self._val_cache_dir = None
 
 
     def get_mean_stddev(self):
@@ -142,10 +186,23 @@ class Mpii(data.Dataset):
         return self.mean, self.std
 
 
+    def get_headboxes(self):
+        """
+        The headboxes of every example in the validation set (used to normalize the distances in PCKh).
+
+        :return: A (N, 2, 2) array, where N is the size of the validation set
+        """
+        return np.stack([self.anno[self.valid[i]]['headbox'] for i in range(len(self.valid))])
+
+
     def __getitem__(self, index):
         """
         Get the 'index'th item from the dataset. The item being (img, 2d pose, meta) triplet.
         """
+        # Use the validation cache if we have one (and sigma hasn't been decayed since it was made)
+        if self._val_cache is not None and self._val_cache_sigma == self.sigma:
+            return self._get_cached_item(index)
+
         # Unpacking
         sf = self.scale_factor
         rf = self.rot_factor
@@ -172,8 +229,11 @@ class Mpii(data.Dataset):
             s = s * 1.25
 
         # For single-person pose estimation with a centered/scaled figure
-        nparts = pts.size(0)
-        img = load_numpy_image(img_path)  # CxHxW
+        img = load_uint8_image(img_path)  # CxHxW
+
+        # (The batch augmentation masks on the gpu, so the raw image is returned unmasked)
+        if self.gpu_augment:
+            return self._get_raw_item(index, img, pts, c, s, a)
 
         # If not, "no_random_masking" then randomly mask the image (mask may copy img data to provide "no masking")
         if self.add_random_masking:
@@ -182,41 +242,40 @@ class Mpii(data.Dataset):
                 generate_random_mask(img, pts_coords, self.mask_prob, self.orientation_prob, self.mean_valued_prob,
                                      self.mean, self.max_cover_ratio, self.noise_std)
             if should_mask:
-                img[:, min_x:max_x, min_y:max_y] = mask
+                img[:, min_x:max_x, min_y:max_y] = torch.from_numpy(np.clip(np.round(mask * 255), 0, 255)).byte()
 
         r = 0
+        flip = False
         if self.augment_data:
-            img = torch.Tensor(img)
-
             # Generate a random scale and rotation
             s = s*torch.randn(1).mul_(sf).add_(1).clamp(1-sf, 1+sf)[0]
             r = torch.randn(1).mul_(rf).clamp(-2*rf, 2*rf)[0] if random.random() <= 0.6 else 0
 
-            # Flip
+            # Flip (the image is flipped as part of the warp below)
             if random.random() <= 0.5:
-                img = torch.from_numpy(fliplr(img.numpy())).float()
+                flip = True
                 pts = shufflelr(pts, width=img.size(2), dataset='mpii')
                 c[0] = img.size(2) - c[0]
 
-            # Color
-            img[0, :, :].mul_(random.uniform(0.8, 1.2)).clamp_(0, 1)
-            img[1, :, :].mul_(random.uniform(0.8, 1.2)).clamp_(0, 1)
-            img[2, :, :].mul_(random.uniform(0.8, 1.2)).clamp_(0, 1)
-
-        # Convert numpy
-        img = torch.Tensor(img)
+        # Prepare the image, cropping, scaling, rotating and flipping with a single warp (straight from the uint8 image)
+        trans = get_augmentation_transform(c, s, [self.inp_res, self.inp_res], rot=r,
+                                           flip_width=img.size(2) if flip else None)
+        inp = warp_images(img.unsqueeze(0), trans[np.newaxis], [self.inp_res, self.inp_res])[0]
 
-        # Prepare image and groundtruth map
-        inp = crop(img, c, s, [self.inp_res, self.inp_res], rot=r)
+        # Color
+        if self.augment_data:
+            inp[0, :, :].mul_(random.uniform(0.8, 1.2)).clamp_(0, 1)
+            inp[1, :, :].mul_(random.uniform(0.8, 1.2)).clamp_(0, 1)
+            inp[2, :, :].mul_(random.uniform(0.8, 1.2)).clamp_(0, 1)
         inp = color_normalize(inp, self.mean, self.std)
 
-        # Generate ground truth
+        # Generate ground truth (for every labelled joint at once)
         tpts = pts.clone()
-        target = torch.zeros(nparts, self.out_res, self.out_res)
-        for i in range(nparts):
-            if tpts[i, 1] > 0:
-                tpts[i, 0:2] = to_torch(transform(tpts[i, 0:2]+1, c, s, [self.out_res, self.out_res], rot=r))
-                target[i] = draw_labelmap(target[i], tpts[i]-1, self.sigma, type=self.label_type)
+        labelled = tpts[:, 1] > 0
+        out_pts = to_torch(transform_batch(tpts[:, 0:2]+1, c, s, [self.out_res, self.out_res], rot=r)).float()
+        tpts[:, 0:2] = torch.where(labelled.view(-1, 1), out_pts, tpts[:, 0:2])
+        target = draw_labelmaps(tpts[:, 0:2]-1, [self.out_res, self.out_res], self.sigma, type=self.label_type,
+                                visible=labelled)
 
         # Meta info
         meta = {'index': index, 'center': c, 'scale': s,
@@ -230,6 +289,184 @@ class Mpii(data.Dataset):
         return inp, target, meta
 
 
+    def _get_cached_item(self, index):
+        """
+        Get the 'index'th item from the validation cache, the same (img, 2d pose, meta) triplet as __getitem__ would
+        produce, but without loading or processing the image.
+        """
+        cache = self._val_cache
+        inp = torch.from_numpy(np.array(cache['inputs'][index]))
+        target = torch.from_numpy(np.array(cache['targets'][index]))
+        meta = {'index': index, 'center': torch.from_numpy(np.array(cache['center'][index])),
+                'scale': float(cache['scale'][index]), 'pts': torch.from_numpy(np.array(cache['pts'][index])),
+                'tpts': torch.from_numpy(np.array(cache['tpts'][index])),
+                'visible': torch.from_numpy(np.array(cache['visible'][index])),
+                'filename': cache['filenames'][index], 'headbox': np.array(cache['headbox'][index])}
+        return inp, target, meta
+
+
+    def _load_val_cache(self, workers=0):
+        """
+        Memory maps the preprocessed validation set (inputs, targets and meta data), making it first if it doesn't
+        exist. It's keyed by everything the preprocessing depends on (the annotations, images, resolutions, sigma,
+        label type and mean/std), and only one process makes it (others wait for it, and then load it).
+
+        The images are only fingerprinted by the mtime and size of the image folder (as for the mean and std), so
+        changing the content of an image in place isn't detected. Delete VAL_CACHE_DIR if the images are modified.
+
+        The cache is a directory in VAL_CACHE_DIR, with a .npy file per array, and the filenames in filenames.txt.
+        After making a cache, the least recently used caches are evicted to keep VAL_CACHE_DIR under
+        MAX_VAL_CACHE_BYTES.
+
+        Sets self._val_cache (a dictionary of read only, memory mapped arrays, and the 'filenames'), self._val_cache_dir
+        and self._val_cache_sigma (the sigma that the targets were made with).
+
+        :param workers: The number of DataLoader workers to use to make the cache
+        """
+        inputs = {
+            "files": cache_utils.file_fingerprints([self.jsonfile, self.img_folder]),
+            "valid_imgs": hashlib.sha1(",".join(self.anno[index]['img_paths'] for index in self.valid)
+                                       .encode("utf-8")).hexdigest(),
+            "inp_res": self.inp_res,
+            "out_res": self.out_res,
+            "sigma": self.sigma,
+            "label_type": self.label_type,
+            "mean": [float(x) for x in self.mean],
+            "std": [float(x) for x in self.std],
+        }
+        key = cache_utils.cache_key("mpii_val", inputs, version=VAL_CACHE_VERSION)
+        cache_dir = join(VAL_CACHE_DIR, key)
+        with cache_utils.lock(key, cache_dir=VAL_CACHE_DIR):
+            if not isdir(cache_dir):
+                print("caching the preprocessed validation set to: {dir}".format(dir=cache_dir))
+                self._make_val_cache(cache_dir, workers)
+                cache_utils.evict_directories(MAX_VAL_CACHE_BYTES, VAL_CACHE_DIR, keep=[key])
+            self._val_cache = self._map_val_cache(cache_dir)
+        self._val_cache_dir = cache_dir
+        self._val_cache_sigma = self.sigma
+
+
+    def _map_val_cache(self, cache_dir):
+        """
+        Memory maps the arrays of the validation cache in 'cache_dir' (whose lock must be held, so that it isn't
+        evicted whilst being mapped), and marks it as recently used.
+        """
+        cache = {name: np.load(join(cache_dir, name + ".npy"), mmap_mode='r')
+                 for name in ['inputs', 'targets', 'center', 'scale', 'pts', 'tpts', 'visible', 'headbox']}
+        with open(join(cache_dir, "filenames.txt")) as f:
+            cache['filenames'] = f.read().splitlines()
+        cache_utils.touch(cache_dir)
+        return cache
+
+
+    def __getstate__(self):
+        """
+        When pickled (e.g. sent to DataLoader worker processes) don't copy the memory mapped validation cache, it's
+        re-mapped in __setstate__, so that all processes share the same pages.
+        """
+        state = self.__dict__.copy()
+        state['_val_cache'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        """
+        Re-map the validation cache (see __getstate__). If it has been evicted since, then fall back to processing
+        the images.
+        """
+        self.__dict__.update(state)
+        if self._val_cache_dir is not None:
+            key = os.path.basename(self._val_cache_dir)
+            with cache_utils.lock(key, cache_dir=VAL_CACHE_DIR):
+                if isdir(self._val_cache_dir):
+                    self._val_cache = self._map_val_cache(self._val_cache_dir)
+
+
+    def _make_val_cache(self, cache_dir, workers=0, batch_size=32):
+        """
+        Preprocesses every item in the validation set (with __getitem__) and writes them to the memory mapped arrays
+        of a validation cache (see _load_val_cache). Everything is written to a temporary directory, which is renamed
+        into place, so an interrupted run never leaves a partial cache.
+        """
+        tmp_dir = cache_dir + ".tmp"
+        if not isdir(tmp_dir):
+            mkdir_p(tmp_dir)
+
+        num_items = len(self)
+        num_joints = len(self.anno[self.valid[0]]['joint_self'])
+        shapes = {
+            'inputs': (num_items, 3, self.inp_res, self.inp_res),
+            'targets': (num_items, num_joints, self.out_res, self.out_res),
+            'center': (num_items, 2),
+            'scale': (num_items,),
+            'pts': (num_items, num_joints, 3),
+            'tpts': (num_items, num_joints, 3),
+            'visible': (num_items, num_joints),
+            'headbox': (num_items, 2, 2),
+        }
+        dtypes = {'scale': np.float64, 'headbox': np.float64}
+        arrays = {name: np.lib.format.open_memmap(join(tmp_dir, name + ".npy"), mode='w+',
+                                                  dtype=dtypes.get(name, np.float32), shape=shape)
+                  for name, shape in shapes.items()}
+        filenames = []
+
+        # (self._val_cache is None whilst making the cache, so the loader runs the full preprocessing)
+        loader = data.DataLoader(self, batch_size=batch_size, shuffle=False, num_workers=workers)
+        for i, (inp, target, meta) in enumerate(loader):
+            if i % 10 == 0: print("In caching the validation set: At "+str(i*batch_size)+" out of "+str(num_items))
+            batch = slice(i * batch_size, i * batch_size + inp.size(0))
+            arrays['inputs'][batch] = inp.numpy()
+            arrays['targets'][batch] = target.numpy()
+            for name in ['center', 'scale', 'pts', 'tpts', 'visible', 'headbox']:
+                arrays[name][batch] = meta[name].numpy()
+            filenames.extend(meta['filename'])
+
+        for array in arrays.values():
+            array.flush()
+        del arrays
+        with open(join(tmp_dir, "filenames.txt"), "w") as f:
+            f.write("\n".join(filenames) + "\n")
+        os.rename(tmp_dir, cache_dir)
+
+
+    def _get_raw_item(self, index, img, pts, c, s, a):
+        """
+        Get the 'index'th item from the dataset, for batched augmentation (see pose/utils/batch_augmentation.py). Only
+        the (scalar) random augmentation parameters are sampled here, and the item is a (region, pts, meta) triplet.
+        Region is the uint8 region of the image that the augmented input is warped from, pts are the raw keypoints,
+        and meta contains the matrices needed to warp the region and transform the keypoints.
+        """
+        # Generate a random scale, rotation and flip (masking and color jitter are sampled with the batch)
+        sf = self.scale_factor
+        rf = self.rot_factor
+        r = 0
+        flip = False
+        if self.augment_data:
+            s = s*torch.randn(1).mul_(sf).add_(1).clamp(1-sf, 1+sf)[0]
+            r = torch.randn(1).mul_(rf).clamp(-2*rf, 2*rf)[0] if random.random() <= 0.6 else 0
+            if random.random() <= 0.5:
+                flip = True
+                c[0] = img.size(2) - c[0]
+
+        # Cut out the region of the image that the input will be warped from
+        trans = get_augmentation_transform(c, s, [self.inp_res, self.inp_res], rot=r,
+                                           flip_width=img.size(2) if flip else None)
+        region, region_trans = crop_region(img, trans, [self.inp_res, self.inp_res])
+
+        # Meta info
+        meta = {'index': index, 'center': c, 'scale': float(s), 'rot': float(r), 'flip': flip,
+                'width': img.size(2), 'visible': pts[:, 2].clone(),
+                'filename': os.path.join(self.img_folder, a['img_paths']),
+                'trans': torch.from_numpy(trans), 'region_trans': torch.from_numpy(region_trans),
+                'pts_trans': torch.from_numpy(get_transform(c, s, [self.out_res, self.out_res], rot=r))}
+
+        # Add headbox information to meta if we are in the validation dataset
+        if not self.is_train:
+            meta['headbox'] = a['headbox']
+
+        return region, pts, meta
+
+
     def __len__(self):
         """
         Size of the dataset
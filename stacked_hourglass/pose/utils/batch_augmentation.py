@@ -0,0 +1,165 @@
+from __future__ import absolute_import
+
+import numpy as np
+import torch
+from torch.utils.data.dataloader import default_collate
+
+from .imutils import draw_labelmaps
+from .transforms import warp_images
+
+
+"""
+Batched (on device) data augmentation for the stacked hourglass, for when the dataset only returns uint8 image
+regions and raw keypoints (see Mpii with 'gpu_augment'), rather than fully augmented inputs and target heatmaps.
+
+The dataset samples the (scalar) augmentation parameters, and cuts out the (box filtered) region of the image that the
+augmented crop samples from. 'collate_raw' pads the regions into a single uint8 batch, and 'BatchAugmentation' then
+warps, flips, masks, color jitters and normalizes the whole batch, and renders the target heatmaps, on the device.
+"""
+
+
+# Pairs of (left, right) joints for MPII, swapped when flipping (see transforms.shufflelr)
+MPII_FLIP_PAIRS = ([0, 5], [1, 4], [2, 3], [10, 15], [11, 14], [12, 13])
+
+
+
+def collate_raw(batch):
+    """
+    Collates (region, pts, meta) triplets from a dataset with 'gpu_augment', zero padding the (differently sized) uint8
+    image regions to the largest in the batch (at the bottom/right, so region coordinates are unchanged).
+    """
+    regions = [item[0] for item in batch]
+    height = max(region.size(1) for region in regions)
+    width = max(region.size(2) for region in regions)
+    imgs = torch.zeros(len(regions), regions[0].size(0), height, width, dtype=torch.uint8)
+    for i, region in enumerate(regions):
+        imgs[i, :, :region.size(1), :region.size(2)] = region
+    pts, meta = default_collate([item[1:] for item in batch])
+    return imgs, pts, meta
+
+
+
+class BatchAugmentation(object):
+    """
+    Applies the augmentation of a dataset's (e.g. Mpii) '__getitem__' to a whole (collated) batch on the device. The
+    settings (resolutions, sigma, label type, mean/std, masking) are read from the dataset on every call, so changes
+    to it (e.g. sigma decay) are respected.
+    """
+    def __init__(self, dataset, flip_pairs=MPII_FLIP_PAIRS):
+        """
+        :param dataset: The dataset (constructed with 'gpu_augment') that the batches come from
+        :param flip_pairs: Pairs of joint indices to swap when a pose is flipped
+        """
+        self.dataset = dataset
+        self.flip_perm = np.arange(dataset.num_joints if hasattr(dataset, 'num_joints') else 16)
+        for left, right in flip_pairs:
+            self.flip_perm[left], self.flip_perm[right] = right, left
+
+
+
+    def __call__(self, imgs, pts, meta):
+        """
+        Augment a batch.
+
+        :param imgs: A uint8 tensor of (padded) image regions, (N, C, h, w), on the device to augment on
+        :param pts: The (N, J, 3) raw keypoints, (x, y, visible) in the original images
+        :param meta: The collated meta data, with 'trans', 'region_trans', 'pts_trans', 'flip' and 'width' from the
+            dataset
+        :return: inputs, target, meta. The (N, C, inp_res, inp_res) color normalized inputs, the (N, J, out_res,
+            out_res) target heatmaps, and meta with the (flipped) 'pts' and 'tpts' (the keypoints in the heatmaps), on
+            the cpu
+        """
+        ds = self.dataset
+        device = imgs.device
+        inp_res = [ds.inp_res, ds.inp_res]
+        out_res = [ds.out_res, ds.out_res]
+        trans = meta['trans'].double().to(device)
+        region_trans = meta['region_trans'].double().to(device)
+        pts_trans = meta['pts_trans'].double().to(device)
+
+        # Warp every region to the input resolution, with the composed (region -> image -> input) matrices
+        inp = warp_images(imgs, torch.matmul(trans, region_trans), inp_res)
+
+        # Flip the keypoints that need it (as in shufflelr), swapping left and right joints
+        pts = pts.float().to(device)
+        flip = meta['flip'].to(device).bool()
+        flipped = pts[:, torch.from_numpy(self.flip_perm).to(device)].clone()
+        flipped[:, :, 0] = meta['width'].float().to(device).view(-1, 1) - flipped[:, :, 0]
+        pts = torch.where(flip.view(-1, 1, 1), flipped, pts)
+
+        # Transform the (labelled) keypoints to the output (and input) resolution (as in transforms.transform)
+        labelled = pts[:, :, 1] > 0
+        heatmap_pts = self._transform_pts(pts, pts_trans)
+        input_pts = heatmap_pts * float(ds.inp_res) / ds.out_res
+        out_pts = (heatmap_pts.long() + 1).float()
+        tpts = pts.clone()
+        tpts[:, :, 0:2] = torch.where(labelled.unsqueeze(2), out_pts, pts[:, :, 0:2])
+        target = draw_labelmaps(tpts[:, :, 0:2] - 1, out_res, ds.sigma, type=ds.label_type, visible=labelled)
+
+        # Mask, color jitter, and normalize the inputs
+        if ds.add_random_masking:
+            inp = self._random_mask(inp, input_pts, labelled)
+        if ds.augment_data:
+            jitter = torch.empty(inp.size(0), inp.size(1), 1, 1, device=device).uniform_(0.8, 1.2)
+            inp = (inp * jitter).clamp_(0, 1)
+        inp = inp - ds.mean.to(device).view(1, -1, 1, 1)
+
+        # (The keypoints in meta are small, and used on the cpu for evaluation, so move them back)
+        meta['pts'] = pts.cpu()
+        meta['tpts'] = tpts.cpu()
+        return inp, target, meta
+
+
+
+    def _transform_pts(self, pts, trans):
+        """
+        Transforms keypoints with the matrices 'trans' (mapping the original images to the output heatmaps)
+        """
+        xs = pts[:, :, 0].double()
+        ys = pts[:, :, 1].double()
+        new_xs = trans[:, 0, 0:1] * xs + trans[:, 0, 1:2] * ys + trans[:, 0, 2:3]
+        new_ys = trans[:, 1, 0:1] * xs + trans[:, 1, 1:2] * ys + trans[:, 1, 2:3]
+        return torch.stack([new_xs, new_ys], dim=2)
+
+
+
+    def _random_mask(self, inp, input_pts, labelled):
+        """
+        Batched version of transforms.generate_random_mask, applied in the (augmented) input. Each image is covered by
+        a bar (either a band of rows or of columns), that partially overlaps the bounding box of its labelled joints,
+        filled with the mean color or gaussian noise around it.
+        """
+        ds = self.dataset
+        n, c, height, width = inp.size()
+        device = inp.device
+
+        # Bounding box of the (labelled) joints
+        big = torch.full_like(input_pts[:, :, 0], float('inf'))
+        x_min = torch.where(labelled, input_pts[:, :, 0], big).min(1)[0].clamp(0, width)
+        x_max = torch.where(labelled, input_pts[:, :, 0], -big).max(1)[0].clamp(0, width)
+        y_min = torch.where(labelled, input_pts[:, :, 1], big).min(1)[0].clamp(0, height)
+        y_max = torch.where(labelled, input_pts[:, :, 1], -big).max(1)[0].clamp(0, height)
+
+        # Pick which images to mask, the orientation of the bars, and their extents
+        should_mask = torch.rand(n, device=device) <= float(ds.mask_prob)
+        rows = torch.rand(n, device=device) < float(ds.orientation_prob)
+        lo = torch.where(rows, y_min, x_min)
+        hi = torch.where(rows, y_max, x_max)
+        size = torch.where(rows, torch.full_like(lo, height), torch.full_like(lo, width))
+        start = (lo + (hi - lo - 1) * torch.rand(n, device=device).double()).floor().clamp(min=0)
+        max_extent = torch.min((hi - lo) * float(ds.max_cover_ratio), size - start)
+        end = torch.max((start + max_extent * torch.rand(n, device=device).double()).floor(), start + 1)
+
+        # Build the masks, and fill them with the mean or noise
+        ys = torch.arange(height, device=device).double().view(1, -1, 1)
+        xs = torch.arange(width, device=device).double().view(1, 1, -1)
+        in_rows = (ys >= start.view(-1, 1, 1)) & (ys < end.view(-1, 1, 1))
+        in_cols = (xs >= start.view(-1, 1, 1)) & (xs < end.view(-1, 1, 1))
+        mask = torch.where(rows.view(-1, 1, 1), in_rows.expand(n, height, width), in_cols.expand(n, height, width))
+        mask = (mask & should_mask.view(-1, 1, 1)).unsqueeze(1)
+
+        mean = ds.mean.to(device).float().view(1, -1, 1, 1)
+        mean_valued = torch.rand(n, 1, 1, 1, device=device) < float(ds.mean_valued_prob)
+        noise = mean + float(ds.noise_std) * torch.randn_like(inp)
+        fill = torch.where(mean_valued, mean.expand_as(inp), noise)
+        return torch.where(mask, fill, inp)
@@ -1,6 +1,5 @@
 from __future__ import absolute_import
 
-import math
 import numpy as np
 import matplotlib.pyplot as plt
 from random import randint
@@ -8,7 +7,7 @@ from random import randint
 from .misc import *
 from .transforms import transform, transform_preds
 
-__all__ = ['accuracy_PCK', 'accuracy_PCKh']
+__all__ = ['accuracy_PCK', 'accuracy_PCKh', 'PCKhAccuracy']
 
 def get_preds(scores):
     ''' get predictions from score maps in torch Tensor
@@ -30,45 +29,43 @@ def get_preds(scores):
     return preds
 
 def calc_dists(preds, target, normalize):
+    ''' Distances between 'preds' and 'target' (batch x joints x 2), normalized per sample, and transposed to be
+        joints x batch. Distances for joints without a target (x or y <= 1) are -1. Computed on the device of 'preds'
+    '''
     preds = preds.float()
     target = target.float()
-    dists = torch.zeros(preds.size(1), preds.size(0))
-    for n in range(preds.size(0)):
-        for c in range(preds.size(1)):
-            if target[n,c,0] > 1 and target[n, c, 1] > 1:
-                dists[c, n] = torch.dist(preds[n,c,:], target[n,c,:])/normalize[n]
-            else:
-                dists[c, n] = -1
-    return dists
+    normalize = to_torch(normalize).float().to(preds.device)
+    dists = torch.norm(preds - target, dim=2) / normalize.view(-1, 1)
+    has_target = target[:,:,0].gt(1) & target[:,:,1].gt(1)
+    dists = torch.where(has_target, dists, -torch.ones_like(dists))
+    return dists.t()
 
 def dist_acc(dists, thr=0.5):
-    ''' Return percentage below threshold while ignoring values with a -1 '''
-    if dists.ne(-1).sum() > 0:
-        return dists.le(thr).eq(dists.ne(-1)).sum()*1.0 / dists.ne(-1).sum()
-    else:
-        return -1
+    ''' Return percentage below threshold while ignoring values with a -1 (or -1 if every value is -1). If 'dists' is
+        joints x batch, then a tensor of percentages per joint is returned
+    '''
+    valid = dists.ne(-1)
+    count = valid.sum(-1).float()
+    acc = (dists.le(thr) & valid).sum(-1).float() / count.clamp(min=1)
+    return torch.where(count.gt(0), acc, -torch.ones_like(acc))
 
 def accuracy_PCK(output, target, idxs, thr=0.5):
     ''' Calculate accuracy according to PCK, but uses ground truth heatmap rather than x,y locations
         First value to be returned is average accuracy across 'idxs', followed by individual accuracies
+        Computed on the device of 'output', without any host-device syncs
     '''
     preds   = get_preds(output)
     gts     = get_preds(target)
-    norm    = torch.ones(preds.size(0))*output.size(3)/10
+    norm    = torch.ones(preds.size(0), device=preds.device)*output.size(3)/10
     dists   = calc_dists(preds, gts, norm)
 
-    acc = torch.zeros(len(idxs)+1)
-    avg_acc = 0
-    cnt = 0
-
-    for i in range(len(idxs)):
-        acc[i+1] = dist_acc(dists[idxs[i]-1], thr=thr)
-        if acc[i+1] >= 0: 
-            avg_acc = avg_acc + acc[i+1]
-            cnt += 1
-            
-    if cnt != 0:  
-        acc[0] = avg_acc / cnt
+    joint_idxs = torch.tensor(idxs, dtype=torch.long, device=dists.device) - 1
+    joint_acc = dist_acc(dists[joint_idxs], thr=thr)
+    has_acc = joint_acc.ge(0).float()
+
+    acc = torch.zeros(len(idxs)+1, device=dists.device)
+    acc[1:] = joint_acc
+    acc[0] = (joint_acc * has_acc).sum() / has_acc.sum().clamp(min=1)
     return acc
 
 def accuracy_PCKh(output, target, meta, idxs, joint_name_to_idx, threshold=0.5):
@@ -134,35 +131,118 @@ def accuracy_PCKh(output, target, meta, idxs, joint_name_to_idx, threshold=0.5):
     }
 
 
+# The joints averaged for each of the per joint PCKh scores (the same as in 'accuracy_PCKh')
+PCKH_JOINT_GROUPS = [
+    ('head', ['head']),
+    ('shoulder', ['lsho', 'rsho']),
+    ('elbow', ['lelb', 'relb']),
+    ('wrist', ['lwri', 'rwri']),
+    ('hip', ['lhip', 'rhip']),
+    ('knee', ['lkne', 'rkne']),
+    ('ankle', ['lank', 'rank']),
+]
+
+class PCKhAccuracy(object):
+    ''' An on-device equivalent of 'accuracy_PCKh' (which is kept as the numpy reference implementation).
+
+        The head sizes (the PCKh normalizers) only depend on the (static) headboxes of the validation set, so they're
+        computed once, and looked up with meta['index']. Every comparison in a batch is done at once on the device,
+        and only the mean and per joint scores (a handful of scalars) are copied back to the host.
+    '''
+    def __init__(self, headboxes, joint_name_to_idx, device=None, num_joints=16, threshold=0.5):
+        '''
+        :param headboxes: The (N, 2, 2) headboxes of the whole validation set (see Mpii.get_headboxes)
+        :param joint_name_to_idx: The index of each joint name (see Mpii.joint_idxs)
+        :param device: The device to compute on
+        :param num_joints: The number of joints in a pose
+        :param threshold: The PCKh threshold (as a fraction of the head size)
+        '''
+        SC_BIAS = 0.6
+        headboxes = to_torch(np.asarray(headboxes, dtype=np.float64))
+        self.head_sizes = (torch.norm(headboxes[:, 1, :] - headboxes[:, 0, :], dim=1) * SC_BIAS).to(device)
+        self.threshold = threshold
+
+        # The pelvis and thorax (6 and 7) are excluded from the mean, as the masked array in 'accuracy_PCKh' does
+        self.mean_mask = torch.ones(num_joints, dtype=torch.float64, device=device)
+        self.mean_mask[6:8] = 0
+
+        # Matrices to average (and count) the per joint scores of each joint group
+        self.group_names = [name for name, _ in PCKH_JOINT_GROUPS]
+        self.group_weights = torch.zeros(len(PCKH_JOINT_GROUPS), num_joints, dtype=torch.float64)
+        self.group_counts = torch.zeros(len(PCKH_JOINT_GROUPS), num_joints, dtype=torch.float64)
+        for i, (_, joints) in enumerate(PCKH_JOINT_GROUPS):
+            for joint in joints:
+                self.group_weights[i, joint_name_to_idx[joint]] += 1.0 / len(joints)
+                self.group_counts[i, joint_name_to_idx[joint]] = 1.0
+        self.group_weights = self.group_weights.to(device)
+        self.group_counts = self.group_counts.to(device)
+
+    def __call__(self, output, meta, preds=None):
+        '''
+        Computes the PCKh scores of a batch.
+
+        :param output: The (batch, joints, 64, 64) score maps output by the network (on the device)
+        :param meta: The meta data for the batch, with 'index', 'center', 'scale', 'pts' and 'visible'
+        :param preds: The predictions from 'final_preds', if they have already been computed
+        :return: The mean PCKh, and a dictionary of (PCKh, count) for each joint group, as 'accuracy_PCKh' returns
+        '''
+        device = self.head_sizes.device
+        if preds is None:
+            preds = final_preds(output.to(device), meta['center'], meta['scale'], [64, 64])
+        preds = preds.to(device)
+        pos_gt = meta['pts'][:, :, :2].to(device, non_blocking=True).type_as(preds)
+        jnt_visible = meta['visible'].to(device, non_blocking=True).double()
+        head_sizes = self.head_sizes[to_torch(meta['index']).to(device, non_blocking=True).long()]
+
+        # Scaled distances, and the (per joint) PCKh over the batch
+        uv_err = torch.norm(preds - pos_gt, dim=2).double()
+        scaled_uv_err = uv_err / head_sizes.view(-1, 1) * jnt_visible
+        jnt_count = jnt_visible.sum(0)
+        less_than_threshold = scaled_uv_err.lt(self.threshold).double() * jnt_visible
+        PCKh = 100. * less_than_threshold.sum(0) / jnt_count.clamp(min=1.0)
+
+        # Mean and joint groups, copied to the host in one go
+        mean = (PCKh * self.mean_mask).sum(0, keepdim=True) / self.mean_mask.sum()
+        scores = torch.cat([mean, torch.mv(self.group_weights, PCKh), torch.mv(self.group_counts, jnt_count)])
+        scores = scores.cpu().tolist()
+        num_groups = len(self.group_names)
+        return scores[0], dict((name, (scores[1 + i], scores[1 + num_groups + i]))
+                               for i, name in enumerate(self.group_names))
+
+
 def final_preds(output, center, scale, res):
     coords = get_preds(output) # float type
     return final_preds_post_processing(output, coords, center, scale, res)
 
 def final_preds_post_processing(output, coords, center, scale, res, cuda=False):
-    # pose-processing
-    for n in range(coords.size(0)):
-        for p in range(coords.size(1)):
-            hm = output[n][p]
-            px = int(math.floor(coords[n][p][0]))
-            py = int(math.floor(coords[n][p][1]))
-            if px > 1 and px < res[0] and py > 1 and py < res[1]:
-                diff = torch.Tensor([hm[py - 1][px] - hm[py - 1][px - 2], hm[py][px - 1]-hm[py - 2][px - 1]])
-                if cuda: diff = diff.cuda()
-                coords[n][p] += diff.sign() * .25
+    ''' Refines the (heatmap) coordinates 'coords' by a quarter pixel towards the higher neighbouring heatmap values,
+        and transforms them back to the original image coordinates. Everything is batched, so stays on the device of
+        'output' and 'coords' ('cuda' is unused, kept for compatibility). 'coords' is updated in place
+    '''
+    # pose-processing: gather the neighbours of each (floored) coordinate from the flattened heatmaps
+    heatmaps = output.detach()
+    batch_size, num_joints, height, width = heatmaps.size()
+    heatmaps = heatmaps.view(batch_size, num_joints, height * width)
+    px = torch.floor(coords[:, :, 0].detach()).long()
+    py = torch.floor(coords[:, :, 1].detach()).long()
+    valid = (px > 1) & (px < res[0]) & (py > 1) & (py < res[1])
+    px = px.clamp(2, width - 1)
+    py = py.clamp(2, height - 1)
+
+    def neighbour(x, y):
+        return heatmaps.gather(2, (y * width + x).unsqueeze(2)).squeeze(2)
+
+    diff_x = neighbour(px, py - 1) - neighbour(px - 2, py - 1)
+    diff_y = neighbour(px - 1, py) - neighbour(px - 1, py - 2)
+    diff = torch.stack([diff_x, diff_y], dim=2).sign() * valid.unsqueeze(2).type_as(diff_x)
+    coords += (diff * .25).type_as(coords)
     coords += 0.5
-    preds = coords.clone()
 
     # Transform back
-    for i in range(coords.size(0)):
-        preds[i] = transform_preds(coords[i], center[i], scale[i], res)
+    transform_preds(coords, center, scale, res)
+    preds = coords.clone()
 
     if preds.dim() < 3:
         preds = preds.view(1, preds.size())
 
     return preds
-
-
-
-
-    
-
@@ -48,6 +48,14 @@ def load_numpy_image(img_path):
     return img
 
 
+def load_uint8_image(img_path):
+    """
+    Load an image as a uint8 pytorch tensor (C x H x W), with values in [0,255]
+    """
+    img = scipy.misc.imread(img_path, mode='RGB')
+    return torch.from_numpy(np.ascontiguousarray(np.transpose(img, (2, 0, 1))))
+
+
 def resize(img, owidth, oheight):
     """
     Resize 'img', a pytorch tensor.
@@ -115,6 +123,62 @@ def draw_labelmap(img, pt, sigma, type='Gaussian'):
     img[img_y[0]:img_y[1], img_x[0]:img_x[1]] = g[g_y[0]:g_y[1], g_x[0]:g_x[1]]
     return to_torch(img)
 
+# Cache of the (torch) kernels pasted by 'draw_labelmaps', keyed by (sigma, type, device)
+_labelmap_kernels = {}
+
+def labelmap_kernel(sigma, type='Gaussian', device='cpu'):
+    """
+    The (6*sigma+1, 6*sigma+1) kernel that 'draw_labelmap' pastes around a point, as a (cached) torch tensor on 'device'.
+    """
+    key = (sigma, type, str(device))
+    if key not in _labelmap_kernels:
+        size = 6 * sigma + 1
+        x = np.arange(0, size, 1, float)
+        y = x[:, np.newaxis]
+        x0 = y0 = size // 2
+        if type == 'Gaussian':
+            g = np.exp(- ((x - x0) ** 2 + (y - y0) ** 2) / (2 * sigma ** 2))
+        elif type == 'Cauchy':
+            g = sigma / (((x - x0) ** 2 + (y - y0) ** 2 + sigma ** 2) ** 1.5)
+        else:
+            raise ValueError("Unknown label type: " + type)
+        _labelmap_kernels[key] = to_torch(g).float().to(device)
+    return _labelmap_kernels[key]
+
+def draw_labelmaps(pts, res, sigma, type='Gaussian', visible=None):
+    """
+    Vectorized version of 'draw_labelmap', drawing the heatmaps for every joint at once (with identical output).
+
+    'pts' can either be the joints of a single pose, of shape (J, 2), or a batch of poses, of shape (N, J, 2), in
+    which case the heatmaps are computed on the device of 'pts' (e.g. after collation). 'res' is (height, width) of the
+    heatmaps, and 'visible' is an optional mask, of shape (J,) or (N, J), of the joints to draw (others are zero).
+    Returns a tensor of shape (J, H, W) or (N, J, H, W).
+    """
+    pts = to_torch(pts)
+    height, width = res
+    kernel = labelmap_kernel(sigma, type, device=pts.device)
+    size = kernel.size(0)
+
+    # The top left and bottom right (exclusive) of the window the kernel is pasted into (as in draw_labelmap)
+    ul = (pts[..., 0:2] - 3 * sigma).long()
+    br = (pts[..., 0:2] + 3 * sigma + 1).long()
+
+    # Offsets of each pixel (column/row) into the kernel, and if they're inside the window
+    xs = torch.arange(width, device=pts.device).view(*([1] * (pts.dim() - 1) + [width]))
+    ys = torch.arange(height, device=pts.device).view(*([1] * (pts.dim() - 1) + [height]))
+    dx = xs - ul[..., 0:1]
+    dy = ys - ul[..., 1:2]
+    in_x = (dx >= 0) & (dx < size) & (xs < br[..., 0:1])
+    in_y = (dy >= 0) & (dy < size) & (ys < br[..., 1:2])
+
+    # Gather the kernel values for every pixel, and zero anything outside of the windows (or for invisible joints)
+    labelmaps = kernel[dy.clamp(0, size - 1).unsqueeze(-1), dx.clamp(0, size - 1).unsqueeze(-2)]
+    mask = in_y.unsqueeze(-1) & in_x.unsqueeze(-2)
+    if visible is not None:
+        visible = to_torch(visible).to(pts.device).bool()
+        mask = mask & visible.view(*(visible.size() + (1, 1)))
+    return labelmaps * mask.float()
+
 # =============================================================================
 # Helpful display functions
 # =============================================================================
@@ -3,6 +3,7 @@ from __future__ import print_function, absolute_import
 import os
 import time
 
+import numpy as np
 import torch
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
@@ -14,6 +15,7 @@ from stacked_hourglass.pose import Bar
 from stacked_hourglass.pose.models import HourglassNet
 from stacked_hourglass.pose.utils.evaluation import final_preds
 # from stacked_hourglass.pose.utils.misc import save_checkpoint, save_pred, adjust_learning_rate
+from utils.device import get_device, module_device, load_checkpoint
 from utils.osutils import mkdir_p, isfile, isdir, join
 # from stacked_hourglass.pose.utils.imutils import batch_with_heatmap
 # from stacked_hourglass.pose.utils.transforms import fliplr, flip_back
@@ -29,7 +31,10 @@ def run(options):
     Important options params:
     options.load: The file for the saved model
     options.data_dir: The input directory for data (RGB images) to pass through the network
-    options.output_dir: The directory to store output predictions
+    options.output_dir: The directory to store output predictions (see _open_preds for the format)
+    options.device: The device to run on (e.g. "cpu", see utils/device.py)
+    options.test_batch_size: The batch size to run the network with
+    options.workers: The number of data loader workers
 
     :param options: The options passed in by command line
     """
@@ -40,8 +45,7 @@ def run(options):
 
     # Run
     model, input_dataset = _load_model_and_dataset(model_file, data_input_dir, options)
-    dataset, ground_truths = _run_model(model, input_dataset)
-    _save_preds(dataset, ground_truths, data_output_dir)
+    _run_model(model, input_dataset, data_output_dir, options.test_batch_size, options.workers)
 
 
 
@@ -51,17 +55,17 @@ def _load_model_and_dataset(model_file, data_input_dir, args):
 
     :param model_file: The file for the saved model
     :param data_input_dir: Directory for the dataset to run network on
-    :param args: The arguments (or options) passed to the script. Needed to specify the architecture
-    :return: A PyTorch nn.Module object for the trained Stacked Hourglass network
+    :param args: The arguments (or options) passed to the script. Needed to specify the architecture and device
+    :return: A PyTorch nn.Module object for the trained Stacked Hourglass network (on the device)
         and the dataset object
     """
     # Make the model
     model = HourglassNet(num_stacks=args.stacks, num_blocks=args.blocks, num_classes=args.num_classes,
                          batch_norm_momentum=args.batch_norm_momentum, use_layer_norm=args.use_layer_norm, width=256, height=256)
-    model = model.cuda()
+    model = model.to(get_device(args))
 
     # Load in weights from checkpoint + set in eval mode
-    checkpoint = torch.load(model_file)
+    checkpoint = load_checkpoint(model_file)
     state_dict = {}
     for key in checkpoint['state_dict']:
         new_key = key[len("module."):] if key.startswith("module.") else key
@@ -84,60 +88,96 @@ def _load_model_and_dataset(model_file, data_input_dir, args):
 
 
 
-def _run_model(model, dataset):
+def _run_model(model, dataset, data_output_dir, batch_size=1, num_workers=0):
     """
-    Run a trained model on an entire dataset. (Run's with a batch size of one for now).
+    Run a trained model on an entire dataset, in batches, writing the predictions (and ground truths) into
+    preallocated (memory mapped) arrays in 'data_output_dir' as we go (see _open_preds).
+
+    Batches are loaded by 'num_workers' DataLoader workers (into pinned memory when running on a gpu), and copied to
+    the device without blocking, so that loading overlaps with the forward passes.
 
     :param model: PyTorch nn.Module object for the trained Stacked Hourglass network
     :param dataset: The input dataset to run the model on.
-    :return: PyTorch Dataset object of 2D pose predictions
+    :param data_output_dir: The directory to write the predictions to
+    :param batch_size: The batch size to run the model with
+    :param num_workers: The number of DataLoader workers
     """
-    # Make sure model is in eval mode
+    # Make sure model is in eval mode, and make the output arrays
     model.eval()
+    device = module_device(model)
+    predictions, ground_truths = _open_preds(data_output_dir, _filenames(dataset), model.num_classes)
 
-    # Placeholder dictionarys for predictions and ground truths
-    predictions = {}
-    ground_truths = {}
-
-    # Loop through each item of the dataset
-    for i in range(len(dataset)):
-        # Progress
-        if i % 100 == 0:
-            print("At " + str(i) + " out of " + str(len(dataset)) + ".")
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                                              pin_memory=(device.type == "cuda"))
 
-        # Get info about the file
-        inputs, targets, meta = dataset[i]
-        filename = dataset.anno[dataset.train[i]]['img_paths']
+    # Loop through each batch of the dataset
+    with torch.no_grad():
+        for i, (inputs, _, meta) in enumerate(data_loader):
+            # Progress
+            if i % 100 == 0:
+                print("At batch " + str(i) + " out of " + str(len(data_loader)) + ".")
 
-        # Compute and store the prediction (unsqueeze input to make a batch size of one)
-        input_var = torch.autograd.Variable(inputs.unsqueeze(0).cuda(), volatile=True)
-        output = model(input_var)
-        score_map = output[-1].data.cpu()
-        joint_preds = final_preds(score_map, [meta['center']], [meta['scale']], [64, 64])
+            # Compute the predictions (in the original image coordinates)
+            output = model(inputs.to(device, non_blocking=True))
+            joint_preds = final_preds(output[-1], meta['center'], meta['scale'], [64, 64])
 
-        # Squeeze output to remove the phantom batch size + put into dataset
-        predictions[filename] = joint_preds.view(joint_preds.size()[1:])
-        ground_truths[filename] = targets
+            # Write into the output arrays, at the dataset indices
+            index = meta['index'].numpy()
+            predictions[index] = joint_preds.cpu().numpy()
+            ground_truths[index] = meta['pts'].numpy()
 
-    return predictions, ground_truths
+    predictions.flush()
+    ground_truths.flush()
 
 
 
-def _save_preds(dataset, ground_truths, data_output_dir):
+def _filenames(dataset):
     """
-    Save the PyTorch Dataset of predictions to a file
+    The (image) filename for every example in the (Mpii) dataset, in order
+    """
+    indices = dataset.train if dataset.is_train else dataset.valid
+    return [dataset.anno[index]['img_paths'] for index in indices]
+
+
 
-    :param dataset: The PyTorch Dataset object of predictions
-    :param ground_truths: The ground truth 2D joint locations
-    :param data_output_dir: The filename for the file to save
+def _open_preds(data_output_dir, filenames, num_joints):
+    """
+    Make the output files for the predictions of a dataset, in 'data_output_dir':
+      2dposes.npy: A float32 array of shape (num_examples, num_joints, 2), the predicted joints (x, y) in the images
+      ground_truths.npy: A float32 array of shape (num_examples, num_joints, 3), the ground truth joints (x, y,
+          visible) in the images
+      filenames.txt: The filename of each example, one per line (the index for the two arrays)
+
+    :param data_output_dir: The directory to write to
+    :param filenames: The filename of every example
+    :param num_joints: The number of joints predicted
+    :return: The (writable, memory mapped) predictions and ground truths arrays
     """
     # Make directory if it doesn't exists
     if not isdir(data_output_dir):
         mkdir_p(data_output_dir)
 
-    # Just save the predictions in the correct place via PyTorch
-    torch.save(dataset, data_output_dir+"/2dposes")
-    torch.save(ground_truths, data_output_dir+"/ground_truths")
+    with open(join(data_output_dir, "filenames.txt"), "w") as f:
+        f.write("\n".join(filenames) + "\n")
+    predictions = np.lib.format.open_memmap(join(data_output_dir, "2dposes.npy"), mode="w+", dtype=np.float32,
+                                            shape=(len(filenames), num_joints, 2))
+    ground_truths = np.lib.format.open_memmap(join(data_output_dir, "ground_truths.npy"), mode="w+",
+                                              dtype=np.float32, shape=(len(filenames), num_joints, 3))
+    return predictions, ground_truths
 
 
 
+def load_preds(data_output_dir):
+    """
+    Load the predictions written by 'run' (see _open_preds), as dictionaries keyed by filename (as the predictions
+    used to be saved).
+
+    :param data_output_dir: The directory that the predictions were written to
+    :return: Dictionaries from filenames to the predicted 2D joints and to the ground truth joints (torch.Tensors)
+    """
+    with open(join(data_output_dir, "filenames.txt")) as f:
+        filenames = f.read().splitlines()
+    predictions = np.load(join(data_output_dir, "2dposes.npy"), mmap_mode="r")
+    ground_truths = np.load(join(data_output_dir, "ground_truths.npy"), mmap_mode="r")
+    return ({filename: torch.from_numpy(np.array(predictions[i])) for i, filename in enumerate(filenames)},
+            {filename: torch.from_numpy(np.array(ground_truths[i])) for i, filename in enumerate(filenames)})
@@ -6,6 +6,7 @@ import random
 import scipy.misc
 import matplotlib.pyplot as plt
 import torch
+import torch.nn.functional as F
 
 from .misc import *
 from .imutils import *
@@ -140,16 +141,67 @@ def transform(pt, center, scale, res, invert=0, rot=0):
     return new_pt[:2].astype(int) + 1
 
 
+def transform_batch(pts, center, scale, res, invert=0, rot=0):
+    """
+    Vectorized version of 'transform', transforming every point of 'pts' (an (N, 2) array or tensor) by the same
+    matrix, with identical results. Returns an (N, 2) int numpy array.
+    """
+    t = get_transform(center, scale, res, rot=rot)
+    if invert:
+        t = np.linalg.inv(t)
+    pts = to_numpy(pts)
+    xs = (pts[:, 0] - 1).astype(np.float64)
+    ys = (pts[:, 1] - 1).astype(np.float64)
+    new_xs = t[0, 0] * xs + t[0, 1] * ys + t[0, 2]
+    new_ys = t[1, 0] * xs + t[1, 1] * ys + t[1, 2]
+    return np.stack([new_xs, new_ys], axis=1).astype(int) + 1
+
+
+def _batch_tensor(values, device):
+    """
+    Stacks a list of per sample values (floats, Numpy arrays or PyTorch tensors) into a tensor, on 'device'. (If
+    'values' is already a tensor, it's just moved to 'device').
+    """
+    if not torch.is_tensor(values):
+        values = torch.from_numpy(np.array([to_numpy(v) if torch.is_tensor(v) else v for v in values]))
+    if not values.is_floating_point():
+        values = values.double()
+    return values.to(device)
+
+
 def transform_preds(coords, center, scale, res):
     """
     Transforms the joint coordinates by a scaling around the point 'center', and maps the coordinates to resolution
-    'res'.
+    'res'. (The inverse of 'transform' without rotation, applied to every joint at once).
+
+    'coords' can either be a single pose, of shape (num_joints, 2), with a single center and scale, or a batch of
+    poses, of shape (batch_size, num_joints, 2), with a center and scale per pose. 'coords' is updated in place.
     """
-    # size = coords.size()
-    # coords = coords.view(-1, coords.size(-1))
-    # print(coords.size())
-    for p in range(coords.size(0)):
-        coords[p, 0:2] = to_torch(transform(coords[p, 0:2], center, scale, res, 1, 0))
+    if coords.dim() == 2:
+        transform_preds(coords.unsqueeze(0), [center], [scale], res)
+        return coords
+
+    # Compute the (non-zero) entries of the matrices from 'get_transform', with the same arithmetic that it would use
+    # (for tensor scales, PyTorch computes 'number / tensor' as 'number * tensor.reciprocal()')
+    scale_is_tensor = torch.is_tensor(scale) or all(torch.is_tensor(s) for s in scale)
+    scale = _batch_tensor(scale, coords.device).view(-1)
+    center = _batch_tensor(center, coords.device).view(-1, 2).type_as(scale)
+    h = 200 * scale
+    divide = (lambda x: x * h.reciprocal()) if scale_is_tensor else (lambda x: x / h)
+    t_00 = divide(float(res[1]))
+    t_11 = divide(float(res[0]))
+    t_02 = res[1] * (divide(-center[:, 0]) + .5)
+    t_12 = res[0] * (divide(-center[:, 1]) + .5)
+
+    # Invert them (as np.linalg.inv does), and apply them to every joint
+    inv_00 = 1.0 / t_00.double()
+    inv_11 = 1.0 / t_11.double()
+    inv_02 = -t_02.double() * inv_00
+    inv_12 = -t_12.double() * inv_11
+    pts = (coords[:, :, 0:2] - 1).double()
+    xs = inv_00.view(-1, 1) * pts[:, :, 0] + inv_02.view(-1, 1)
+    ys = inv_11.view(-1, 1) * pts[:, :, 1] + inv_12.view(-1, 1)
+    coords[:, :, 0:2] = (torch.stack([xs, ys], dim=2).long() + 1).type_as(coords)
     return coords
 
 def crop(img, center, scale, res, rot=0):
@@ -222,6 +274,130 @@ def crop_numpy(img, center, scale, res, rot=0):
 
 
 
+def get_augmentation_transform(center, scale, res, rot=0, flip_width=None):
+    """
+    Composes a horizontal flip (of an image of width 'flip_width', if it's not None) with the crop around 'center',
+    scaled by 'scale' and rotated by 'rot' (see get_transform), into a single matrix. The matrix maps (zero based) pixel
+    coordinates in the original image to pixel coordinates in the (res) output, so the same matrix warps the image and
+    transforms the keypoints. ('center' should be in the flipped image's coordinates, as for 'crop').
+    """
+    t = get_transform(center, scale, res, rot=rot)
+    if flip_width is not None:
+        flip = np.array([[-1., 0., flip_width - 1.], [0., 1., 0.], [0., 0., 1.]])
+        t = np.dot(t, flip)
+    return t
+
+
+def warp_images(imgs, matrices, res):
+    """
+    Warps a batch of images with the affine 'matrices' (see get_augmentation_transform), sampling every output pixel
+    once (bilinearly) from the (unnormalized) input images. When the images are being downscaled by a factor of two or
+    more, they're box filtered first (like 'crop_numpy'), to avoid aliasing. Pixels that map from outside of an image
+    are zero.
+
+    :param imgs: A uint8 (values in [0,255]) or float (values in [0,1]) tensor of images, of shape (N, C, H, W)
+    :param matrices: A (N, 3, 3) array or tensor of matrices, mapping image coordinates to output coordinates
+    :param res: The resolution (height, width) of the output images
+    :return: A float tensor of shape (N, C, res[0], res[1]), with values in [0,1], on the device of 'imgs'
+    """
+    factor, grid = warp_grid(matrices, imgs.size(2), imgs.size(3), res, imgs.device)
+    return apply_warp_grid(imgs, factor, grid)
+
+
+
+def warp_grid(matrices, height, width, res, device):
+    """
+    The box filter factor and sampling grid that 'warp_images' warps (height, width) images with. They only depend on
+    the matrices and sizes, so can be computed once and reused for many images (e.g. every frame of a video).
+
+    :param matrices: A (N, 3, 3) array or tensor of matrices, mapping image coordinates to output coordinates
+    :param height: The height of the images to warp
+    :param width: The width of the images to warp
+    :param res: The resolution (height, width) of the output images
+    :param device: The device to compute the grid on
+    :return: factor, grid. The factor to box filter the images by (if >= 2), and the (N, res[0], res[1], 2) grid to
+        sample the (filtered) images with (see apply_warp_grid)
+    """
+    matrices = to_torch(np.asarray(matrices, dtype=np.float64)) if not torch.is_tensor(matrices) else matrices
+    matrices = matrices.double().to(device)
+
+    # Box filter if every image is being downscaled by at least a factor of 2, and sample from the filtered images
+    # (the factor is shared by the batch, so it's the smallest downscale, as filtering more would blur some images)
+    factor = int((1.0 / torch.sqrt(torch.abs(matrices[:, 0, 0] * matrices[:, 1, 1] -
+                                             matrices[:, 0, 1] * matrices[:, 1, 0]))).min().item())
+    if factor >= 2:
+        height, width = (height + factor - 1) // factor, (width + factor - 1) // factor
+        unfilter = torch.tensor([[factor, 0., (factor - 1) / 2.0], [0., factor, (factor - 1) / 2.0], [0., 0., 1.]],
+                                dtype=torch.float64, device=device)
+        matrices = torch.matmul(matrices, unfilter)
+
+    # Map each output pixel back into its image, and normalize to [-1,1] for grid_sample
+    ys = torch.arange(res[0], dtype=torch.float64, device=device).view(-1, 1).expand(res[0], res[1])
+    xs = torch.arange(res[1], dtype=torch.float64, device=device).view(1, -1).expand(res[0], res[1])
+    out_pts = torch.stack([xs, ys, torch.ones_like(xs)], dim=2).view(-1, 3)
+    in_pts = torch.matmul(out_pts, torch.inverse(matrices).transpose(1, 2))
+    grid = torch.stack([2.0 * in_pts[:, :, 0] / max(width - 1, 1) - 1.0,
+                        2.0 * in_pts[:, :, 1] / max(height - 1, 1) - 1.0], dim=2)
+    return factor, grid.view(-1, res[0], res[1], 2).float()
+
+
+
+def apply_warp_grid(imgs, factor, grid):
+    """
+    Warps a batch of images with a (precomputed) box filter factor and sampling grid, from 'warp_grid'.
+
+    :param imgs: A uint8 (values in [0,255]) or float (values in [0,1]) tensor of images, of shape (N, C, H, W)
+    :param factor: The factor to box filter by (if >= 2)
+    :param grid: The (N, res[0], res[1], 2) sampling grid
+    :return: A float tensor of shape (N, C, res[0], res[1]), with values in [0,1], on the device of 'imgs'
+    """
+    imgs = imgs.float() / 255.0 if imgs.dtype == torch.uint8 else imgs.float()
+    if factor >= 2:
+        imgs = F.avg_pool2d(imgs, factor, ceil_mode=True)
+    return F.grid_sample(imgs, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+
+
+
+def crop_region(img, trans, res):
+    """
+    Cuts out the region of 'img' that warping with 'trans' (see warp_images) to resolution 'res' would sample from, box
+    filtered by the same factor that warp_images would use. Warping the (much smaller) region later, e.g. batched on
+    the gpu, gives the same result as warping the whole image (up to rounding the box filtered region to uint8).
+
+    :param img: A uint8 tensor image, of shape (C, H, W)
+    :param trans: The 3x3 matrix, mapping pixel coordinates in 'img' to pixel coordinates in the output
+    :param res: The resolution (height, width) of the output
+    :return: region, region_trans. region is a uint8 tensor of shape (C, h, w), and region_trans is a 3x3 matrix
+        mapping pixel coordinates in the region to pixel coordinates in 'img'. (So 'trans . region_trans' warps region)
+    """
+    height, width = img.size(1), img.size(2)
+    factor = max(1, int(1.0 / np.sqrt(np.abs(np.linalg.det(trans[:2, :2])))))
+
+    # Bounding box of the output in the image (with a margin for the bilinear sampling and box filter)
+    corners = np.array([[0, res[1] - 1, 0, res[1] - 1], [0, 0, res[0] - 1, res[0] - 1], [1, 1, 1, 1]], dtype=float)
+    pts = np.dot(np.linalg.inv(trans), corners)
+    x0 = int(max(0, np.floor(pts[0].min()) - factor))
+    y0 = int(max(0, np.floor(pts[1].min()) - factor))
+    x1 = int(min(width, np.ceil(pts[0].max()) + factor + 1))
+    y1 = int(min(height, np.ceil(pts[1].max()) + factor + 1))
+
+    # Align the box to the blocks that warp_images would filter the whole image with
+    x0, y0 = x0 - x0 % factor, y0 - y0 % factor
+    x1, y1 = min(width, x1 + (-x1) % factor), min(height, y1 + (-y1) % factor)
+    if x1 <= x0 or y1 <= y0:
+        x0, y0, x1, y1 = 0, 0, 1, 1
+        img = torch.zeros_like(img[:, :1, :1])
+
+    region = img[:, y0:y1, x0:x1]
+    if factor >= 2:
+        region = F.avg_pool2d(region.float().unsqueeze(0), factor, ceil_mode=True)[0].round().byte()
+    region_trans = np.array([[factor, 0., x0 + (factor - 1) / 2.0],
+                             [0., factor, y0 + (factor - 1) / 2.0],
+                             [0., 0., 1.]])
+    return region.contiguous(), region_trans
+
+
+
 def generate_random_mask(img, pts, mask_prob, orientation_prob, mean_valued_prob, mean_values,
                          max_cover_ratio, noise_std):
     """
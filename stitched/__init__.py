@@ -1,3 +1,5 @@
 from .run import run_mpii, run_h36m
+from .realtime import run_realtime
+from .server import run_server
 from .stitched_network import StitchedNetwork
 from .soft_argmax import SoftArgmax1D, SoftArgmax2D
\ No newline at end of file
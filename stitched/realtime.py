@@ -0,0 +1,440 @@
+from __future__ import print_function, absolute_import, division
+
+import collections
+import threading
+import time
+
+import numpy as np
+import torch
+
+from stacked_hourglass.pose.utils.transforms import get_transform, warp_grid, apply_warp_grid
+from stitched.run import load_model_h36m, load_2d_pose_normalization_stats
+from utils.device import module_device
+from utils.frame_shards import img_crop_params
+
+
+"""
+Real-time (live camera/stream) inference with the stitched network.
+
+A 'FrameGrabber' thread reads frames from the source as fast as it produces them into a 'LatestFrameBuffer', which
+only ever holds the newest frame, so that when inference is slower than the source, stale frames are dropped rather
+than queued (and latency stays bounded). 'RealtimeStitchedNetwork' then runs each frame through the network, reusing
+preallocated buffers (and the precomputed crop) between frames, and keeps track of its latency.
+
+'FramePreprocessor' (crop, resize and color normalize frames on the device) is shared with the inference server
+(server.py) and the video visualization (viz.py).
+
+A 'SyntheticFrameSource' can stand in for the camera, so the whole thing can be run (and profiled) on a cpu only
+machine (see benchmark_realtime_script.py).
+"""
+
+
+# How often (in frames) to print the latency report
+REPORT_FREQ = 100
+
+
+
+class LatestFrameBuffer(object):
+    """
+    Holds (only) the latest frame from a source. Putting a frame replaces any frame that hasn't been taken yet (which
+    is counted as dropped), so the consumer always gets the newest frame, and never works through a backlog.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._frame = None
+        self._stamp = None
+        self._closed = False
+        self.num_frames = 0
+        self.num_dropped = 0
+
+
+
+    def put(self, frame):
+        """
+        Replace the latest frame with 'frame' (timestamped with the time now)
+        """
+        with self._cond:
+            if self._frame is not None:
+                self.num_dropped += 1
+            self._frame = frame
+            self._stamp = time.time()
+            self.num_frames += 1
+            self._cond.notify()
+
+
+
+    def get(self):
+        """
+        Waits for a frame that hasn't been taken yet, and takes it.
+
+        :return: frame, stamp. The frame and the time it was put in the buffer, or None, None if the buffer was closed
+        """
+        with self._cond:
+            while self._frame is None and not self._closed:
+                self._cond.wait()
+            frame, stamp = self._frame, self._stamp
+            self._frame, self._stamp = None, None
+            return frame, stamp
+
+
+
+    def close(self):
+        """
+        Marks the end of the stream (any waiting 'get' returns, once the last frame has been taken)
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+
+class FrameGrabber(threading.Thread):
+    """
+    A (daemon) thread reading frames from a source (anything with cv2.VideoCapture's 'read', e.g. a camera or
+    SyntheticFrameSource) into a LatestFrameBuffer, until the source ends or 'stop' is called.
+    """
+    def __init__(self, source, buffer, bgr=True):
+        """
+        :param source: The source to read frames from
+        :param buffer: The LatestFrameBuffer to put the frames into
+        :param bgr: If the source produces BGR frames (as cv2 does), that need converting to RGB
+        """
+        super(FrameGrabber, self).__init__()
+        self.daemon = True
+        self.source = source
+        self.buffer = buffer
+        self.bgr = bgr
+        self._stopped = threading.Event()
+
+
+
+    def run(self):
+        # (cv2 is only needed for real cameras, so that synthetic sources work without it)
+        if self.bgr:
+            import cv2
+        success, frame = self.source.read()
+        while success and not self._stopped.is_set():
+            self.buffer.put(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if self.bgr else frame)
+            success, frame = self.source.read()
+        self.buffer.close()
+
+
+
+    def stop(self):
+        self._stopped.set()
+
+
+
+class SyntheticFrameSource(object):
+    """
+    A stand in for a camera, with the same 'read' and 'release' interface as cv2.VideoCapture. Produces (RGB) frames
+    of noise, with a bright square moving across them, at a fixed frame rate.
+    """
+    def __init__(self, height=480, width=640, fps=30.0, num_frames=None, seed=0):
+        """
+        :param height: The height of the frames
+        :param width: The width of the frames
+        :param fps: The frame rate to produce frames at ('read' blocks until the next frame is due)
+        :param num_frames: The number of frames to produce before ending (or None to never end)
+        :param seed: The random seed for the noise
+        """
+        self.height = height
+        self.width = width
+        self.fps = fps
+        self.num_frames = num_frames
+        self._background = np.random.RandomState(seed).randint(0, 256, (height, width, 3)).astype(np.uint8)
+        self._index = 0
+        self._next_time = None
+
+
+
+    def read(self):
+        """
+        :return: success, frame. As cv2.VideoCapture.read (but the frame is RGB)
+        """
+        if self.num_frames is not None and self._index >= self.num_frames:
+            return False, None
+
+        # Wait until the next frame is due
+        now = time.time()
+        if self._next_time is None:
+            self._next_time = now
+        if self._next_time > now:
+            time.sleep(self._next_time - now)
+        self._next_time += 1.0 / self.fps
+
+        # Draw the frame
+        frame = self._background.copy()
+        size = min(self.height, self.width) // 4
+        x = (self._index * 8) % max(self.width - size, 1)
+        y = (self.height - size) // 2
+        frame[y:y + size, x:x + size] = 255
+        self._index += 1
+        return True, frame
+
+
+
+    def release(self):
+        pass
+
+
+
+class LatencyMeter(object):
+    """
+    Records the latencies of (the most recent 'window') frames, to report percentiles of them.
+    """
+    def __init__(self, window=1000):
+        self._latencies = collections.deque(maxlen=window)
+        self.count = 0
+
+
+
+    def add(self, seconds):
+        self._latencies.append(seconds)
+        self.count += 1
+
+
+
+    def summary(self):
+        """
+        :return: A dictionary of the 'p50', 'p99' and 'mean' latencies (in ms) over the window, and the total 'count'
+        """
+        if len(self._latencies) == 0:
+            return {'p50': 0.0, 'p99': 0.0, 'mean': 0.0, 'count': self.count}
+        latencies = np.array(self._latencies) * 1000.0
+        return {'p50': float(np.percentile(latencies, 50)), 'p99': float(np.percentile(latencies, 99)),
+                'mean': float(np.mean(latencies)), 'count': self.count}
+
+
+
+class FramePreprocessor(object):
+    """
+    Turns uint8 RGB frames into inputs for a StitchedNetwork, as Human36mDataset does: crops the whole frame (see
+    'img_crop_params'), resizes it to the hourglass input resolution and color normalizes it, all on the device. The
+    crop (box filter factor and sampling grid) only depends on the frame size, so it's cached per frame size.
+    Thread safe.
+    """
+    def __init__(self, model, in_res=None):
+        """
+        :param model: The StitchedNetwork (on the device to run on)
+        :param in_res: The (square) input resolution of the hourglass, defaults to the model's
+        """
+        self.device = module_device(model)
+        self.res = [in_res, in_res] if in_res is not None else list(model.hg_in_res)
+        self._img_mean = torch.as_tensor(np.asarray(model.hg_mean), dtype=torch.float32).to(self.device).view(1, -1, 1, 1)
+        self._img_std = torch.as_tensor(np.asarray(model.hg_std), dtype=torch.float32).to(self.device).view(1, -1, 1, 1)
+        self._crops = {}
+        self._lock = threading.Lock()
+
+
+
+    def crop(self, height, width):
+        """
+        The (cached) crop of a whole (height, width) frame.
+
+        :return: center, scale, factor, grid. The crop's center and scale (see 'img_crop_params'), and the box filter
+            factor and (1, res[0], res[1], 2) sampling grid (see 'warp_grid')
+        """
+        with self._lock:
+            if (height, width) not in self._crops:
+                center, scale = img_crop_params(height, width)
+                trans = get_transform(center, scale, self.res)[np.newaxis]
+                factor, grid = warp_grid(trans, height, width, self.res, self.device)
+                self._crops[(height, width)] = (center, scale, factor, grid)
+            return self._crops[(height, width)]
+
+
+
+    def __call__(self, imgs, out=None):
+        """
+        Preprocess a batch of (same sized) frames.
+
+        :param imgs: A uint8 tensor of frames, of shape (N, 3, H, W), on the device
+        :param out: An optional (N, 3, res[0], res[1]) tensor to write the inputs into (rather than allocating one)
+        :return: inputs, center, scale. The network inputs, and the (shared) center and scale of the crop
+        """
+        center, scale, factor, grid = self.crop(imgs.size(2), imgs.size(3))
+        warped = apply_warp_grid(imgs, factor, grid.expand(imgs.size(0), -1, -1, -1))
+        if out is None:
+            out = warped
+        else:
+            out.copy_(warped)
+        out.mul_(255.0).sub_(self._img_mean).div_(self._img_std)
+        return out, center, scale
+
+
+
+class RealtimeStitchedNetwork(object):
+    """
+    Runs a StitchedNetwork on one frame at a time, with as little per frame work as possible. The (pinned) frame
+    buffers, network input, color and 2D pose normalization statistics, crop (sampling grid) and meta data are all
+    allocated on the device once (and again only if the frame size changes), and the network is run under 'no_grad'.
+    The latency of each call is recorded in 'latency'.
+    """
+    def __init__(self, model, pose_2d_mean=None, pose_2d_std=None, in_res=None):
+        """
+        :param model: The StitchedNetwork (on the device to run on)
+        :param pose_2d_mean: The dataset 2D pose mean, if the model uses dataset normalization
+        :param pose_2d_std: The dataset 2D pose std, if the model uses dataset normalization
+        :param in_res: The (square) input resolution of the hourglass, defaults to the model's
+        """
+        self.model = model.eval()
+        self.device = module_device(model)
+        self.preprocess = FramePreprocessor(model, in_res)
+        self.res = self.preprocess.res
+        self.latency = LatencyMeter()
+
+        self._inputs = torch.empty(1, 3, self.res[0], self.res[1], device=self.device)
+        self._meta = {}
+        if pose_2d_mean is not None:
+            self._meta['2d_mean'] = torch.as_tensor(np.asarray(pose_2d_mean), dtype=torch.float32).view(1, -1).to(self.device)
+            self._meta['2d_std'] = torch.as_tensor(np.asarray(pose_2d_std), dtype=torch.float32).view(1, -1).to(self.device)
+        self._frame_shape = None
+
+
+
+    def _allocate(self, height, width):
+        """
+        (Re)allocate the frame buffers, and precompute the crop (of the whole frame) and meta data, for a frame size
+        """
+        self._frame_shape = (height, width)
+        self._host_frame = torch.empty(height, width, 3, dtype=torch.uint8)
+        if self.device.type == "cuda":
+            self._host_frame = self._host_frame.pin_memory()
+        self._device_frame = torch.empty(1, 3, height, width, dtype=torch.uint8, device=self.device)
+
+        center, scale, _, _ = self.preprocess.crop(height, width)
+        self._meta['center'] = torch.from_numpy(center).view(1, 2).to(self.device)
+        self._meta['scale'] = torch.full((1,), scale, device=self.device)
+
+
+
+    def __call__(self, frame):
+        """
+        Estimate the pose in a frame.
+
+        :param frame: An RGB uint8 numpy array, of shape (H, W, 3)
+        :return: twod_pred, threed_pred. The (J, 2) 2D pose in image coordinates, and the (normalized) 3D pose, as
+            numpy arrays
+        """
+        start = time.time()
+        if frame.shape[:2] != self._frame_shape:
+            self._allocate(frame.shape[0], frame.shape[1])
+
+        with torch.no_grad():
+            # Copy the frame into the (reused) buffers, and crop and normalize it into the (reused) input
+            self._host_frame.copy_(torch.from_numpy(np.ascontiguousarray(frame)))
+            self._device_frame.copy_(self._host_frame.permute(2, 0, 1).unsqueeze(0), non_blocking=True)
+            self.preprocess(self._device_frame, out=self._inputs)
+
+            # Hourglass -> soft argmax -> 3D baseline
+            _, twod_preds, threed_preds = self.model(self._inputs, self._meta)
+            twod_pred = twod_preds[0].cpu().numpy()
+            threed_pred = threed_preds[0].cpu().numpy()
+
+        self.latency.add(time.time() - start)
+        return twod_pred, threed_pred
+
+
+
+
+def run_realtime_loop(estimator, source, max_frames=0, bgr=True, callback=None):
+    """
+    Runs 'estimator' on the latest frame from 'source', over and over, until the source ends, 'max_frames' have been
+    processed, or it's interrupted (Ctrl-C). Prints a latency report every REPORT_FREQ frames, and at the end.
+
+    :param estimator: A RealtimeStitchedNetwork
+    :param source: The frame source (e.g. a cv2.VideoCapture or a SyntheticFrameSource)
+    :param max_frames: The maximum number of frames to process (0 for no limit)
+    :param bgr: If the source produces BGR frames (as cv2 does)
+    :param callback: An optional function, called with (frame, twod_pred, threed_pred) for every processed frame
+    :return: A dictionary of the latency metrics (see _latency_report)
+    """
+    buffer = LatestFrameBuffer()
+    grabber = FrameGrabber(source, buffer, bgr=bgr)
+    end_to_end = LatencyMeter()
+    start = time.time()
+    grabber.start()
+    try:
+        frame, stamp = buffer.get()
+        while frame is not None:
+            twod_pred, threed_pred = estimator(frame)
+            end_to_end.add(time.time() - stamp)
+            if callback is not None:
+                callback(frame, twod_pred, threed_pred)
+
+            # Report
+            if end_to_end.count % REPORT_FREQ == 0:
+                _print_latency_report(_latency_report(estimator, end_to_end, buffer, time.time() - start))
+            if max_frames > 0 and end_to_end.count >= max_frames:
+                break
+            frame, stamp = buffer.get()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        grabber.stop()
+        grabber.join(1.0)
+        source.release()
+
+    report = _latency_report(estimator, end_to_end, buffer, time.time() - start)
+    _print_latency_report(report)
+    return report
+
+
+
+
+def run_realtime(options):
+    """
+    Run the stitched network on a live camera or stream (or a synthetic one), in real time, reporting latency metrics.
+
+    Important options params:
+    options.load, options.load_hourglass, options.load_2d3d: The model (see load_model_h36m)
+    options.camera: The camera index, or stream url, to open with cv2.VideoCapture (or "synthetic")
+    options.realtime_frames: The number of frames to process (0 to run until the stream ends, or Ctrl-C)
+    options.device: The device to run on (e.g. "cpu", see utils/device.py)
+
+    :param options: The options passed in by command line
+    """
+    # Load the model (once) and the normalization stats
+    model = load_model_h36m(options.load, options.load_hourglass, options.load_2d3d, options)
+    pose_2d_mean, pose_2d_std = load_2d_pose_normalization_stats(options)
+    estimator = RealtimeStitchedNetwork(model, pose_2d_mean, pose_2d_std)
+
+    # Open the source, and run
+    if options.camera == "synthetic":
+        source, bgr = SyntheticFrameSource(), False
+    else:
+        import cv2
+        source, bgr = cv2.VideoCapture(int(options.camera) if options.camera.isdigit() else options.camera), True
+    run_realtime_loop(estimator, source, max_frames=options.realtime_frames, bgr=bgr)
+
+
+
+
+def _latency_report(estimator, end_to_end, buffer, elapsed):
+    """
+    The latency metrics: the inference latency (frame -> pose), the end to end latency (frame captured -> pose,
+    including waiting for the network to be free), the frames processed and dropped, and the processed fps.
+    """
+    inference = estimator.latency.summary()
+    capture = end_to_end.summary()
+    return {
+        'inference_p50_ms': inference['p50'],
+        'inference_p99_ms': inference['p99'],
+        'end_to_end_p50_ms': capture['p50'],
+        'end_to_end_p99_ms': capture['p99'],
+        'frames_processed': capture['count'],
+        'frames_captured': buffer.num_frames,
+        'frames_dropped': buffer.num_dropped,
+        'fps': capture['count'] / max(elapsed, 1.0e-8),
+    }
+
+
+
+
+def _print_latency_report(report):
+    print("frames: {n} ({d} dropped) | fps: {f:.1f} | inference p50: {ip50:.1f}ms p99: {ip99:.1f}ms | "
+          "end to end p50: {ep50:.1f}ms p99: {ep99:.1f}ms".format(
+              n=report['frames_processed'], d=report['frames_dropped'], f=report['fps'],
+              ip50=report['inference_p50_ms'], ip99=report['inference_p99_ms'],
+              ep50=report['end_to_end_p50_ms'], ep99=report['end_to_end_p99_ms']))
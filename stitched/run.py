@@ -4,9 +4,12 @@ import os
 import time
 
 import torch
+from torch.utils.data import DataLoader, Subset
 
 import stacked_hourglass.pose.datasets as datasets
 from stitched.stitched_network import StitchedNetwork
+from utils.device import get_device, module_device, load_checkpoint
+from utils.human36m_dataset import Human36mDataset
 from utils.transform import mpii_to_h36m_joints
 
 from utils.osutils import mkdir_p, isfile, isdir, join
@@ -21,6 +24,8 @@ def run_mpii(options):
     options.load: The file for the saved model
     options.data_dir: The input directory for data (RGB images) to pass through the network
     options.output_dir: The directory to store output predictions
+    options.device: The device to run on (e.g. "cpu", see utils/device.py)
+    options.num_shards, options.shard_index: To split the dataset between several (e.g. cpu) processes
 
     :param options: The options passed in by command line
     """
@@ -32,8 +37,8 @@ def run_mpii(options):
 
     # Run
     model, data_loader = load_model_and_dataset_mpii(hg_model_file, threed_baseline_model_file, data_input_dir, options)
-    twod_predictions, threed_predictions = _run_model_mpii(model, data_loader)
-    _save_preds(twod_predictions, threed_predictions, data_output_dir)
+    twod_predictions, threed_predictions = _run_model_mpii(model, data_loader, options)
+    _save_preds(twod_predictions, threed_predictions, _shard_output_dir(data_output_dir, options))
 
 
 
@@ -44,11 +49,12 @@ def load_model_and_dataset_mpii(hg_file, threed_baseline_file, data_input_dir, a
     :param hg_file: The file for the saved hourglass model
     :param threed_baseline_file: The file for the saved 3D baseline model
     :param data_input_dir: Directory for the dataset (of RGB images) to run network on
-    :param args: (Ignored for now). The arguments (or options) passed to the script. Needed to specify the architecture
-    :return: A PyTorch nn.Module object for a stitched network and a PyTorch dataloader object
+    :param args: The arguments (or options) passed to the script. Needed to specify the architecture and device
+    :return: A PyTorch nn.Module object for a stitched network (on the device) and a PyTorch dataloader object
     """
     # Load the hourglass checkpoint
-    checkpoint = torch.load(hg_file)
+    device = get_device(args)
+    checkpoint = load_checkpoint(hg_file)
 
     # create the dataset, NOT in train mode, and load the mean and stddev (if not a pre-trained model)
     mean = checkpoint['mean'] if 'mean' in checkpoint else None
@@ -67,28 +73,29 @@ def load_model_and_dataset_mpii(hg_file, threed_baseline_file, data_input_dir, a
                             hg_mean=mean, hg_std=stddev, width=256, height=256, transformer_fn=mpii_to_h36m_joints,
                             dataset_normlization=args.dataset_normalization)
     model.load(hg_file, threed_baseline_file)
-    model = model.cuda()
+    model = model.to(device)
     model.eval()
 
-    # wrap in a data loader
-    data_loader = torch.utils.data.DataLoader(dataset, batch_size=args.test_batch_size, shuffle=False,
-                                              num_workers=args.workers, pin_memory=True)
+    # wrap (this process's shard of the dataset) in a data loader
+    data_loader = DataLoader(_shard_dataset(dataset, args), batch_size=args.test_batch_size, shuffle=False,
+                             num_workers=args.workers, pin_memory=(device.type == "cuda"))
 
     return model, data_loader
 
 
 
-def load_model_and_dataset_h36m(file, hg_file, threed_baseline_file, args):
+def load_model_h36m(file, hg_file, threed_baseline_file, args):
     """
-    Load the PyTorch stitched model.
+    Load the PyTorch stitched model (without a dataset, e.g. to run on frames from a camera).
 
-    We assume that the network uses the color normalizationa dn
+    We assume that the network uses the color normalization from the MPII dataset (as the hourglass was pre-trained
+    on it).
 
     :param file: File for the entire network
-    :param hg_file:
-    :param threed_baseline_file:
-    :param args:
-    :return:
+    :param hg_file: The file for the saved hourglass model (if file is empty)
+    :param threed_baseline_file: The file for the saved 3D baseline model (if file is empty)
+    :param args: The arguments (or options) passed to the script. Needed to specify the architecture and device
+    :return: A PyTorch nn.Module object for a stitched network (on the device, in eval mode)
     """
     # If file isn't empty, then we have a complete checkpoint. Which can be loaded by setting the following
     if file != '':
@@ -96,7 +103,8 @@ def load_model_and_dataset_h36m(file, hg_file, threed_baseline_file, args):
         threed_baseline_file = None
 
     # Get the mean and std (possibly from the MPII dataset, but cache it if we did)
-    checkpoint = torch.load(hg_file)
+    device = get_device(args)
+    checkpoint = load_checkpoint(hg_file)
     mean = checkpoint['mean'] if 'mean' in checkpoint else None
     stddev = checkpoint['stddev'] if 'stddev' in checkpoint else None
     if mean is None or stddev is None:
@@ -110,40 +118,77 @@ def load_model_and_dataset_h36m(file, hg_file, threed_baseline_file, args):
     # Make the model and load weights from checkpoints and set to eval mode
     model = StitchedNetwork(hg_stacks=args.stacks, hg_blocks=args.blocks, hg_num_classes=args.num_classes,
                             hg_batch_norm_momentum=args.batch_norm_momentum, hg_use_layer_norm=args.use_layer_norm,
-                            hg_mean=mean, hg_std=stddev, width=256, height=256, transformer_fn=mpii_to_h36m_joints)
+                            hg_mean=mean, hg_std=stddev, width=256, height=256, transformer_fn=mpii_to_h36m_joints,
+                            dataset_normlization=args.dataset_normalization)
     model.load(hg_file, threed_baseline_file)
-    model = model.cuda()
+    model = model.to(device)
     model.eval()
+    return model
+
+
+
+def load_2d_pose_normalization_stats(args):
+    """
+    The (Human3.6m) dataset statistics that the 2D poses are normalized with before the 3D baseline network, if the
+    model uses dataset normalization (read without loading any image data).
+
+    :param args: The arguments (or options) passed to the script. Uses 'data_dir' and 'dataset_normalization'
+    :return: The 2D pose mean and std, as numpy arrays, or None, None if the model uses instance normalization
+    """
+    if not args.dataset_normalization:
+        return None, None
+    h36m_dataset = Human36mDataset(dataset_path=args.data_dir, is_train=False,
+                                   dataset_normalization=args.dataset_normalization, load_image_data=False)
+    return h36m_dataset.pose_2d_mean, h36m_dataset.pose_2d_std
+
+
+
+def load_model_and_dataset_h36m(file, hg_file, threed_baseline_file, args):
+    """
+    Load the PyTorch stitched model, and the Human3.6m (validation) dataset to run it on.
+
+    :param file: File for the entire network
+    :param hg_file: The file for the saved hourglass model (if file is empty)
+    :param threed_baseline_file: The file for the saved 3D baseline model (if file is empty)
+    :param args: The arguments (or options) passed to the script. Needed to specify the architecture and device
+    :return: A PyTorch nn.Module object for a stitched network (on the device) and a PyTorch dataloader object
+    """
+    model = load_model_h36m(file, hg_file, threed_baseline_file, args)
+    device = module_device(model)
 
-    # Make the dataset and dataloader, manually setting the mean and std
-    dataset = Human36mDataset(dataset_path=data_input_dir, is_train=False,
-                                  dataset_normalization=dataset_normalization, load_image_data=True)
+    # Make the dataset and dataloader (over this process's shard), manually setting the mean and std
+    dataset = Human36mDataset(dataset_path=args.data_dir, is_train=False,
+                                  dataset_normalization=args.dataset_normalization, load_image_data=True,
+                                  img_shard_dir=args.img_shard_dir)
     dataset.set_color_mean(model.hg_mean)
     dataset.set_color_std(model.hg_std)
-    data_loader = DataLoader(dataset=dataset, batch_size=args.test_batch_size, shuffle=True,
-                            num_workers=args.workers, pin_memory=True)
+    data_loader = DataLoader(dataset=_shard_dataset(dataset, args), batch_size=args.test_batch_size, shuffle=False,
+                            num_workers=args.workers, pin_memory=(device.type == "cuda"))
 
     return model, data_loader
 
 
 
 
-def _run_model_mpii(model, data_loader):
+def _run_model_mpii(model, data_loader, args):
     """
     Run a trained model on an entire dataset
 
     :param model: PyTorch nn.Module object for the trained Stacked Hourglass network
     :param data_loader: A PyTorch DataLoader object for the dataset.
+    :param args: The arguments (or options) passed to the script
     :return: A 'dataset' map of 2D pose predictions and a 'dataset' map of 3D pose predictions
     """
     # Placeholder dictionarys for predictions and ground truths
     twod_predictions = {}
     threed_predictions = {}
+    device = module_device(model)
 
     # Get the PyTorch tensors for dataset normalization in 3d baseline (not used if instance norm)
-    dataset = Human36mDataset(dataset_path=data_input_dir, is_train=False,
-                                  dataset_normalization=dataset_normalization, load_image_data=True)
-    mean, std = torch.Tensor(dataset.pose_2d_mean), torch.Tensor(dataset.pose_2d_std)
+    h36m_dataset = Human36mDataset(dataset_path=args.data_dir, is_train=False,
+                                   dataset_normalization=args.dataset_normalization, load_image_data=False)
+    mean, std = torch.Tensor(h36m_dataset.pose_2d_mean), torch.Tensor(h36m_dataset.pose_2d_std)
+    dataset = _unshard_dataset(data_loader.dataset)
 
     # Loop through each batch of the dataset
     for i, (inputs, target, meta) in enumerate(data_loader):
@@ -155,20 +200,17 @@ def _run_model_mpii(model, data_loader):
         meta['2d_mean'] = mean
         meta['2d_std'] = std
 
-        # Compute and store the prediction (unsqueeze input to make a batch size of one)
-        input_var = torch.autograd.Variable(inputs.cuda(), volatile=True)
-        _, twod_preds, threed_preds = model(input_var, meta)
+        # Compute and store the prediction
+        with torch.no_grad():
+            _, twod_preds, threed_preds = model(inputs.to(device), meta)
         # score_map = output[-1].data.cpu()
         # joint_preds = final_preds(score_map, [meta['center']], [meta['scale']], [64, 64])
 
-        # Squeeze output to remove the phantom batch size + put into dataset
-        dataset = data_loader.dataset
+        # Put into dataset
         index = meta['index']
         for j in range(inputs.size(0)):
             anno_index = dataset.train[index[j]] if dataset.is_train else dataset.valid[index[j]]
             filename = dataset.anno[anno_index]['img_paths']
-            print(filename)
-            quit()
             twod_predictions[filename] = twod_preds[j].cpu().detach()
             threed_predictions[filename] = threed_preds[j].cpu().detach()
 
@@ -191,6 +233,7 @@ def _run_model_h36m(model, data_loader):
     threed_predictions = {}
     threed_ground_truths = {}
     metas = {}
+    device = module_device(model)
 
     # Loop through each batch of the dataset
     for i, (inputs, _, _, targets, meta) in enumerate(data_loader):
@@ -201,8 +244,8 @@ def _run_model_h36m(model, data_loader):
         # Compute and store the predictions
         meta['center'] = meta['img_center']
         meta['scale'] = meta['img_scale']
-        input_var = torch.autograd.Variable(inputs.cuda(), volatile=True)
-        _, twod_preds, threed_preds = model(input_var, meta)
+        with torch.no_grad():
+            _, twod_preds, threed_preds = model(inputs.to(device), meta)
 
         # Get the ground truths
         twod_gt = meta["2d_pose_orig_img"]
@@ -211,8 +254,6 @@ def _run_model_h36m(model, data_loader):
         # Put into dataset
         for j in range(inputs.size(0)):
             filename = meta["img_filename"][j]
-            print(filename)
-            quit()
             twod_predictions[filename] = twod_preds[j].cpu().detach()
             twod_ground_truths[filename] = twod_gt[j]
             threed_predictions[filename] = threed_preds[j].cpu().detach()
@@ -251,6 +292,8 @@ def run_h36m(options):
     options.load_2d3d: The file for the 3D baseline network
     options.data_dir: The input directory for data (RGB images) to pass through the network
     options.output_dir: The directory to store output predictions
+    options.device: The device to run on (e.g. "cpu", see utils/device.py)
+    options.num_shards, options.shard_index: To split the dataset between several (e.g. cpu) processes
 
     :param options: The options passed in by command line
     """
@@ -262,15 +305,15 @@ def run_h36m(options):
 
     # Run
     model, data_loader = load_model_and_dataset_h36m(model_file, hg_model_file, threed_baseline_model_file, options)
-    pred_2d, pred_3d, gt_2d, gt_3d = _run_model_h36m(model, data_loader)
-    _save_preds_h36m(pred_2d, pred_3d, gt_2d, gt_3d, metas, data_output_dir)
+    pred_2d, pred_3d, gt_2d, gt_3d, metas = _run_model_h36m(model, data_loader)
+    _save_preds_h36m(pred_2d, pred_3d, gt_2d, gt_3d, metas, _shard_output_dir(data_output_dir, options))
 
 
 
 
-def _save_preds(pred_2d, pred_3d, gt_2d, gt_3d, metas, data_output_dir):
+def _save_preds_h36m(pred_2d, pred_3d, gt_2d, gt_3d, metas, data_output_dir):
     """
-    TODO
+    Save the PyTorch set of predictions and ground truths (and metas) for Human3.6m to files in 'data_output_dir'
     """
     # Make directory if it doesn't exists
     if not isdir(data_output_dir):
@@ -285,3 +328,31 @@ def _save_preds(pred_2d, pred_3d, gt_2d, gt_3d, metas, data_output_dir):
 
 
 
+def _shard_dataset(dataset, args):
+    """
+    The part of 'dataset' that this process should run on. With 'args.num_shards' > 1, every process (e.g. one per cpu
+    node) runs on every 'num_shards'th example, starting from 'args.shard_index', so that inference scales horizontally.
+    """
+    num_shards = getattr(args, 'num_shards', 1)
+    if num_shards <= 1:
+        return dataset
+    return Subset(dataset, list(range(args.shard_index, len(dataset), num_shards)))
+
+
+
+def _unshard_dataset(dataset):
+    """
+    The dataset underlying a (possibly) sharded dataset
+    """
+    return dataset.dataset if isinstance(dataset, Subset) else dataset
+
+
+
+def _shard_output_dir(data_output_dir, args):
+    """
+    The directory for a process to save its predictions in (a subdirectory per shard, if the dataset is sharded)
+    """
+    num_shards = getattr(args, 'num_shards', 1)
+    if num_shards <= 1:
+        return data_output_dir
+    return join(data_output_dir, "shard_{i}_of_{n}".format(i=args.shard_index, n=num_shards))
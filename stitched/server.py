@@ -0,0 +1,466 @@
+from __future__ import print_function, absolute_import, division
+
+import io
+import json
+import threading
+import time
+
+import numpy as np
+import torch
+
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+except ImportError:
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen
+
+from stitched.realtime import FramePreprocessor, LatencyMeter
+from stitched.run import load_model_h36m, load_2d_pose_normalization_stats
+from utils.device import module_device
+
+
+"""
+A long lived (local) HTTP inference server for the stitched network, so that the model is loaded once, rather than
+per invocation of run.py.
+
+Endpoints:
+    POST /predict  An image, either encoded (e.g. JPEG/PNG, decoded with OpenCV) or as a (H, W, 3) uint8 RGB numpy
+                   array in .npy format (with 'Content-Type: application/x-npy'). Returns the 2D pose (in image
+                   coordinates) and (normalized) 3D pose as JSON ({"pose_2d": [[x, y], ...], "pose_3d": [...]}), or
+                   as a .npz of 'pose_2d' and 'pose_3d' arrays with 'Accept: application/x-npz'.
+    GET /health    {"status": "ok", ...} once the model is loaded.
+    GET /metrics   Request counts, batch sizes and latencies (p50/p99) as JSON.
+
+Each request is preprocessed (cropped and normalized, on the device) in its own handler thread, and then queued for
+a 'MicroBatcher', which runs concurrent requests through the network together. A batch is run once it's full
+('max_batch_size'), or once its oldest request has waited for 'max_latency' seconds.
+"""
+
+
+NPY_CONTENT_TYPE = "application/x-npy"
+NPZ_CONTENT_TYPE = "application/x-npz"
+JSON_CONTENT_TYPE = "application/json"
+
+
+
+class _PendingRequest(object):
+    """
+    A (preprocessed) request waiting to be run in a batch, and (once it has been) its result
+    """
+    def __init__(self, inputs, center, scale):
+        self.inputs = inputs
+        self.center = center
+        self.scale = scale
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+
+class MicroBatcher(object):
+    """
+    Runs requests through a StitchedNetwork in (micro) batches, on a single background thread. 'submit' blocks until
+    the batch containing the request has been run.
+    """
+    def __init__(self, model, pose_2d_mean=None, pose_2d_std=None, max_batch_size=16, max_latency=0.005):
+        """
+        :param model: The StitchedNetwork (on the device to run on)
+        :param pose_2d_mean: The dataset 2D pose mean, if the model uses dataset normalization
+        :param pose_2d_std: The dataset 2D pose std, if the model uses dataset normalization
+        :param max_batch_size: The largest number of requests to run at once
+        :param max_latency: The longest time (in seconds) a request waits for more requests to batch with
+        """
+        self.model = model.eval()
+        self.device = module_device(model)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._pose_2d_mean = None
+        self._pose_2d_std = None
+        if pose_2d_mean is not None:
+            self._pose_2d_mean = torch.as_tensor(np.asarray(pose_2d_mean), dtype=torch.float32).view(1, -1).to(self.device)
+            self._pose_2d_std = torch.as_tensor(np.asarray(pose_2d_std), dtype=torch.float32).view(1, -1).to(self.device)
+
+        # Metrics
+        self._lock = threading.Lock()
+        self.num_batches = 0
+        self.num_batched_requests = 0
+        self.queue_wait = LatencyMeter()
+        self.batch_latency = LatencyMeter()
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+
+    def submit(self, inputs, center, scale):
+        """
+        Run a single (preprocessed) input through the network, batched with any other concurrent requests.
+
+        :param inputs: The (3, H, W) normalized network input (on the device)
+        :param center: The (x, y) center the image was cropped around
+        :param scale: The scale the image was cropped with
+        :return: pose_2d, pose_3d. The (J, 2) 2D pose in image coordinates and the (normalized) 3D pose, as numpy arrays
+        """
+        request = _PendingRequest(inputs, center, scale)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+
+
+    def close(self):
+        """
+        Stop the batching thread (once any queued requests have been run)
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+
+
+    def metrics(self):
+        """
+        :return: A dictionary of the number of batches, the mean batch size, and the queue wait and batch latencies
+        """
+        with self._lock:
+            return {
+                'batches': self.num_batches,
+                'batched_requests': self.num_batched_requests,
+                'mean_batch_size': self.num_batched_requests / max(self.num_batches, 1),
+                'queue_wait_ms': self.queue_wait.summary(),
+                'batch_latency_ms': self.batch_latency.summary(),
+            }
+
+
+
+    def _run(self):
+        """
+        The batching loop. Waits for a request, then gathers more until the batch is full or the first request has
+        waited for 'max_latency', and runs them. (Requests that are already queued are always gathered, even if the
+        first request has waited too long, e.g. behind the previous batch.)
+        """
+        stopping = False
+        while not stopping:
+            request = self._queue.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = request.arrival + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                try:
+                    request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+            self._run_batch(batch)
+
+
+
+    def _run_batch(self, batch):
+        """
+        Run a list of _PendingRequests through the network, and wake up their handlers
+        """
+        start = time.time()
+        try:
+            with torch.no_grad():
+                inputs = torch.stack([request.inputs for request in batch])
+                meta = {
+                    'center': torch.from_numpy(np.stack([request.center for request in batch])).to(self.device),
+                    'scale': torch.tensor([request.scale for request in batch], device=self.device),
+                }
+                if self._pose_2d_mean is not None:
+                    meta['2d_mean'] = self._pose_2d_mean.expand(len(batch), -1)
+                    meta['2d_std'] = self._pose_2d_std.expand(len(batch), -1)
+                _, twod_preds, threed_preds = self.model(inputs, meta)
+                twod_preds = twod_preds.cpu().numpy()
+                threed_preds = threed_preds.cpu().numpy()
+            for i, request in enumerate(batch):
+                request.result = (twod_preds[i], threed_preds[i])
+        except Exception as e:
+            for request in batch:
+                request.error = e
+
+        with self._lock:
+            self.num_batches += 1
+            self.num_batched_requests += len(batch)
+            self.batch_latency.add(time.time() - start)
+            for request in batch:
+                self.queue_wait.add(start - request.arrival)
+        for request in batch:
+            request.done.set()
+
+
+
+class PoseInferenceServer(object):
+    """
+    The HTTP server (see the top of this file for the endpoints). Handles every request on its own thread, and
+    preprocesses images there, before handing them to a MicroBatcher.
+    """
+    def __init__(self, model, pose_2d_mean=None, pose_2d_std=None, host="127.0.0.1", port=8000, max_batch_size=16,
+                 max_latency=0.005, in_res=None):
+        """
+        :param model: The StitchedNetwork (on the device to run on)
+        :param pose_2d_mean: The dataset 2D pose mean, if the model uses dataset normalization
+        :param pose_2d_std: The dataset 2D pose std, if the model uses dataset normalization
+        :param host: The host to listen on (only locally, by default)
+        :param port: The port to listen on (0 to pick any free port, see 'address')
+        :param max_batch_size: The largest number of requests to run at once
+        :param max_latency: The longest time (in seconds) a request waits for more requests to batch with
+        :param in_res: The (square) input resolution of the hourglass, defaults to the model's
+        """
+        self.model = model
+        self.device = module_device(model)
+        self.batcher = MicroBatcher(model, pose_2d_mean, pose_2d_std, max_batch_size, max_latency)
+
+        # Crops are cached by image size, as most clients will send images of the same size
+        self.preprocess = FramePreprocessor(model, in_res)
+        self.res = self.preprocess.res
+
+        # Metrics
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.request_latency = LatencyMeter()
+
+        self.httpd = _ThreadingHTTPServer((host, port), _PoseRequestHandler)
+        self.httpd.pose_server = self
+        self._thread = None
+
+
+
+    @property
+    def address(self):
+        """
+        The (host, port) that the server is listening on
+        """
+        return self.httpd.server_address[:2]
+
+
+
+    def serve_forever(self):
+        """
+        Serve requests (on this thread) until 'shutdown' is called (or Ctrl-C)
+        """
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+
+    def start(self):
+        """
+        Serve requests on a background thread (e.g. to test the server with a client in the same process)
+        """
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+
+    def shutdown(self):
+        """
+        Stop serving requests, and close the socket and the batcher
+        """
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread.join()
+        self.httpd.server_close()
+        self.batcher.close()
+
+
+
+    def predict(self, frame):
+        """
+        Estimate the pose in an image (batched with any concurrent requests).
+
+        :param frame: An RGB uint8 numpy array, of shape (H, W, 3)
+        :return: pose_2d, pose_3d. The (J, 2) 2D pose in image coordinates and the (normalized) 3D pose
+        """
+        with torch.no_grad():
+            img = torch.from_numpy(np.ascontiguousarray(frame)).to(self.device).permute(2, 0, 1).unsqueeze(0)
+            inputs, center, scale = self.preprocess(img)
+        return self.batcher.submit(inputs[0], center, scale)
+
+
+
+    def metrics(self):
+        """
+        :return: A dictionary of the server's metrics (requests, errors, latencies, and the batcher's metrics)
+        """
+        with self._lock:
+            metrics = {
+                'uptime_s': time.time() - self.start_time,
+                'requests': self.num_requests,
+                'errors': self.num_errors,
+                'request_latency_ms': self.request_latency.summary(),
+            }
+        metrics.update(self.batcher.metrics())
+        return metrics
+
+
+
+    def _record(self, seconds, error):
+        with self._lock:
+            self.num_requests += 1
+            self.num_errors += int(error)
+            self.request_latency.add(seconds)
+
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+
+class _PoseRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles a single HTTP request, for the PoseInferenceServer in 'self.server.pose_server'
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        pose_server = self.server.pose_server
+        if self.path == "/health":
+            self._send_json(200, {'status': 'ok', 'device': str(pose_server.device)})
+        elif self.path == "/metrics":
+            self._send_json(200, pose_server.metrics())
+        else:
+            self._send_json(404, {'error': "Unknown path '{p}'".format(p=self.path)})
+
+
+
+    def do_POST(self):
+        pose_server = self.server.pose_server
+        start = time.time()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != "/predict":
+            self._send_json(404, {'error': "Unknown path '{p}'".format(p=self.path)})
+            return
+
+        # Decode the image
+        try:
+            frame = _decode_image(body, self.headers.get('Content-Type', ''))
+        except Exception as e:
+            pose_server._record(time.time() - start, True)
+            self._send_json(400, {'error': "Couldn't decode the image: {e}".format(e=e)})
+            return
+
+        # Run the network, and respond with the poses
+        try:
+            pose_2d, pose_3d = pose_server.predict(frame)
+        except Exception as e:
+            pose_server._record(time.time() - start, True)
+            self._send_json(500, {'error': str(e)})
+            return
+        pose_server._record(time.time() - start, False)
+        if NPZ_CONTENT_TYPE in self.headers.get('Accept', ''):
+            out = io.BytesIO()
+            np.savez(out, pose_2d=pose_2d, pose_3d=pose_3d)
+            self._send(200, NPZ_CONTENT_TYPE, out.getvalue())
+        else:
+            self._send_json(200, {'pose_2d': pose_2d.tolist(), 'pose_3d': pose_3d.tolist()})
+
+
+
+    def _send_json(self, code, obj):
+        self._send(code, JSON_CONTENT_TYPE, json.dumps(obj).encode('utf-8'))
+
+
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+
+    def log_message(self, format, *args):
+        # (Don't log every request, see /metrics instead)
+        pass
+
+
+
+
+def _decode_image(body, content_type):
+    """
+    Decode a request body into a (H, W, 3) uint8 RGB numpy array. Either a .npy array (with content type
+    'application/x-npy'), or an encoded image (e.g. JPEG or PNG), decoded with OpenCV.
+    """
+    if content_type.startswith(NPY_CONTENT_TYPE):
+        frame = np.load(io.BytesIO(body), allow_pickle=False)
+    else:
+        import cv2
+        frame = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            raise ValueError("not a supported image format")
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    if frame.ndim != 3 or frame.shape[2] != 3:
+        raise ValueError("expected an (H, W, 3) image, but got an array of shape {s}".format(s=frame.shape))
+    return frame.astype(np.uint8)
+
+
+
+
+def request_pose(url, frame, binary=False, timeout=60.0):
+    """
+    A (minimal) client for the server. Sends a frame to '<url>/predict' as a .npy array.
+
+    :param url: The url of the server, e.g. "http://127.0.0.1:8000"
+    :param frame: An RGB uint8 numpy array, of shape (H, W, 3)
+    :param binary: If the poses should be sent back as a .npz, rather than JSON
+    :param timeout: The timeout (in seconds) for the request
+    :return: pose_2d, pose_3d. The (J, 2) 2D pose in image coordinates and the (normalized) 3D pose, as numpy arrays
+    """
+    body = io.BytesIO()
+    np.save(body, frame)
+    headers = {'Content-Type': NPY_CONTENT_TYPE, 'Accept': NPZ_CONTENT_TYPE if binary else JSON_CONTENT_TYPE}
+    response = urlopen(Request(url + "/predict", data=body.getvalue(), headers=headers), timeout=timeout).read()
+    if binary:
+        arrays = np.load(io.BytesIO(response))
+        return arrays['pose_2d'], arrays['pose_3d']
+    poses = json.loads(response.decode('utf-8'))
+    return np.array(poses['pose_2d']), np.array(poses['pose_3d'])
+
+
+
+
+def run_server(options):
+    """
+    Load the stitched network (once), and serve it over HTTP until interrupted.
+
+    Important options params:
+    options.load, options.load_hourglass, options.load_2d3d: The model (see load_model_h36m)
+    options.host, options.port: The address to listen on
+    options.server_max_batch_size: The largest number of requests to run through the network at once
+    options.server_max_latency_ms: The longest a request waits (in ms) for other requests to batch with
+    options.device: The device to run on (e.g. "cpu", see utils/device.py)
+
+    :param options: The options passed in by command line
+    """
+    model = load_model_h36m(options.load, options.load_hourglass, options.load_2d3d, options)
+    pose_2d_mean, pose_2d_std = load_2d_pose_normalization_stats(options)
+    server = PoseInferenceServer(model, pose_2d_mean, pose_2d_std, host=options.host, port=options.port,
+                                 max_batch_size=options.server_max_batch_size,
+                                 max_latency=options.server_max_latency_ms / 1000.0)
+    host, port = server.address
+    print("Serving the stitched network at http://{h}:{p} (POST /predict, GET /health, GET /metrics)".format(
+        h=host, p=port))
+    server.serve_forever()
+    server.shutdown()
@@ -2,6 +2,25 @@ from __future__ import division
 
 import torch
 
+
+# Caches of coordinate grids and windows, keyed by their shape, device and dtype (see _coordinate_grid/_local_window)
+_coordinate_grids = {}
+_local_windows = {}
+
+
+def _coordinate_grid(height, width, device, dtype):
+    """
+    Returns (cached) xs and ys coordinate vectors, of shapes (1, 1, width) and (1, height, 1), so that they broadcast
+    against a [channels, height, width] grid.
+    """
+    key = (height, width, str(device), dtype)
+    if key not in _coordinate_grids:
+        xs = torch.arange(width, device=device).to(dtype).view(1, 1, width)
+        ys = torch.arange(height, device=device).to(dtype).view(1, height, 1)
+        _coordinate_grids[key] = (xs, ys)
+    return _coordinate_grids[key]
+
+
 def _make_radial_window(width, height, cx, cy, fn, window_width=10.0):
     """
     Returns a grid, where grid[i,j] = fn((i**2 + j**2)**0.5)
@@ -13,25 +32,30 @@ def _make_radial_window(width, height, cx, cy, fn, window_width=10.0):
     :param fn: The function to apply
     :return:
     """
-    # The length of cx and cy is the number of channels we need
-    channels = cx.size(0)
-
-    # Explicitly tile cx and cy, ready for computing the distance matrix below, because pytorch doesn't broadcast very well
-    # Make the shape [channels, height, width]
-    cx = cx.repeat(height, width, 1).permute(2, 0, 1)
-    cy = cy.repeat(height, width, 1).permute(2, 0, 1)
-
-    # Compute a grid where dist[i,j] = (i-cx)**2 + (j-cy)**2, need to view and repeat to tile and make shape [channels, height, width]
-    xs = torch.arange(width).view((1, width)).repeat(channels, height, 1).float().cuda()
-    ys = torch.arange(height).view((height, 1)).repeat(channels, 1, width).float().cuda()
-    delta_xs = xs - cx
-    delta_ys = ys - cy
+    # Compute a grid where dist[i,j] = (i-cx)**2 + (j-cy)**2, of shape [channels, height, width], by broadcasting
+    # (cached) coordinate vectors against the centers (on the device of the centers)
+    xs, ys = _coordinate_grid(height, width, cx.device, cx.dtype)
+    delta_xs = xs - cx.view(-1, 1, 1)
+    delta_ys = ys - cy.view(-1, 1, 1)
     dists = torch.sqrt((delta_ys ** 2) + (delta_xs ** 2))
 
     # apply the function to the grid and return it
     return fn(dists, window_width)
 
 
+def _local_window(radius, fn, window_width, device, dtype):
+    """
+    Returns (cached) offsets -radius, ..., radius, of shape (2*radius+1,), and the window 'fn' evaluated on the
+    (2*radius+1, 2*radius+1) grid of offsets around a center point.
+    """
+    key = (radius, fn, window_width, str(device), dtype)
+    if key not in _local_windows:
+        offsets = torch.arange(-radius, radius + 1, device=device).to(dtype)
+        dists = torch.sqrt(offsets.view(-1, 1) ** 2 + offsets.view(1, -1) ** 2)
+        _local_windows[key] = (offsets, fn(dists, window_width))
+    return _local_windows[key]
+
+
 def _parzen_scalar(delta, width):
     """For reference"""
     del_ovr_wid = math.abs(delta) / width
@@ -53,8 +77,8 @@ def _parzen_torch(dists, width):
     hwidth = width / 2.0
     del_ovr_width = dists / hwidth
 
-    near_mode = (dists <= hwidth/2.0).float()
-    in_tail = ((dists > hwidth/2.0) * (dists <= hwidth)).float()
+    near_mode = (dists <= hwidth/2.0).to(dists.dtype)
+    in_tail = ((dists > hwidth/2.0) * (dists <= hwidth)).to(dists.dtype)
 
     return near_mode * (1 - 6 * (del_ovr_width ** 2) * (1 - del_ovr_width)) \
         + in_tail * (2 * ((1 - del_ovr_width) ** 3))
@@ -68,14 +92,14 @@ def _uniform_window(dists, width):
     :return: A 2d grid, who's values are 0 or 1 depending on if it's in the window or not
     """
     hwidth = width / 2.0
-    return (dists <= hwidth).float()
+    return (dists <= hwidth).to(dists.dtype)
 
 
 def _identity_window(dists, width):
     """
     An "identity window". (I.e. a "window" which when multiplied by, will not change the input).
     """
-    return torch.ones(dists.size())
+    return torch.ones_like(dists)
 
 
 
@@ -177,31 +201,58 @@ class SoftArgmax2D(torch.nn.Module):
         :return: Output of the 2D soft arg-max layer, x_coords and y_coords, in the shape (B, C, 2), which are the soft
             argmaxes per channel
         """
-        # Compute windowed softmax
-        # Compute windows using a batch_size of "batch_size * channels"
+        # Find the argmax per channel (treating the input as a batch of "batch_size * channels")
         batch_size, channels, height, width = x.size()
         argmax = torch.argmax(x.view(batch_size * channels, -1), dim=1)
-        argmax_x, argmax_y = torch.remainder(argmax, width).float(), torch.floor(torch.div(argmax.float(), float(width)))
-        windows = _make_radial_window(width, height, argmax_x, argmax_y, self.window_fn, self.window_width)
-        windows = windows.view(batch_size, channels, height, width).cuda()
-        smax = self._softmax_2d(x, self.softmax_temp) * windows
-        smax = smax / torch.sum(smax.view(batch_size, channels, -1), dim=2).view(batch_size,channels,1,1)
 
-        # compute x index (sum over y axis, produce with indices and then sum over x axis for the expectation)
-        x_end_index = self.base_index + width * self.step_size
-        x_indices = torch.arange(start=self.base_index, end=x_end_index, step=self.step_size).cuda()
-        x_coords = torch.sum(torch.sum(smax, 2) * x_indices, 2)
+        # With a window, everything outside of it is zeroed, so only the window around the argmax needs computing
+        if self.window_type is not None:
+            return self._local_soft_argmax(x, argmax)
 
-        # compute y index (sum over x axis, produce with indices and then sum over y axis for the expectation)
-        y_end_index = self.base_index + height * self.step_size
-        y_indices = torch.arange(start=self.base_index, end=y_end_index, step=self.step_size).cuda()
-        y_coords = torch.sum(torch.sum(smax, 3) * y_indices, 2)
+        # Compute the softmax (the identity window doesn't change it)
+        smax = self._softmax_2d(x, self.softmax_temp)
 
-        # For debugging (testing if it's actually like the argmax?)
-        # argmax_x = argmax_x.view(batch_size, channels)
-        # argmax_y = argmax_y.view(batch_size, channels)
-        # print("X err in soft argmax: {err}".format(err=torch.mean(torch.abs(argmax_x - x_coords))))
-        # print("Y err in soft argmax: {err}".format(err=torch.mean(torch.abs(argmax_y - y_coords))))
+        # compute x index (sum over y axis, produce with indices and then sum over x axis for the expectation)
+        # compute y index (sum over x axis, produce with indices and then sum over y axis for the expectation)
+        xs, ys = _coordinate_grid(height, width, x.device, x.dtype)
+        x_coords = torch.sum(torch.sum(smax, 2) * (self.base_index + self.step_size * xs), 2)
+        y_coords = torch.sum(torch.sum(smax, 3) * (self.base_index + self.step_size * ys.view(1, 1, height)), 2)
 
         # Put the x coords and y coords (shape (B,C)) into an output with shape (B,C,2)
         return torch.cat([torch.unsqueeze(x_coords, 2), torch.unsqueeze(y_coords, 2)], dim=2)
+
+
+
+    def _local_soft_argmax(self, x, argmax):
+        """
+        The windowed soft argmax, computed over the (2*radius+1, 2*radius+1) patch around each argmax, where radius is
+        half the window width. This is equivalent to multiplying the full softmax by the window and renormalizing, as
+        the softmax's normalization cancels out.
+
+        :param x: The input to the soft arg-max layer, of shape (B, C, H, W)
+        :param argmax: The (flattened) argmax of each channel, of shape (B*C,)
+        :return: The soft argmaxes, of shape (B, C, 2)
+        """
+        batch_size, channels, height, width = x.size()
+        x_flat = x.view(batch_size * channels, -1)
+        radius = int(self.window_width // 2)
+        offsets, window = _local_window(radius, self.window_fn, self.window_width, x.device, x.dtype)
+        offsets = offsets.long()
+
+        # Indices of the patch around each argmax (clamped to the image, with out of bounds points masked out)
+        xs = (argmax % width).view(-1, 1, 1) + offsets.view(1, 1, -1)
+        ys = (argmax // width).view(-1, 1, 1) + offsets.view(1, -1, 1)
+        in_bounds = ((xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)).to(x.dtype)
+        indices = ys.clamp(0, height - 1) * width + xs.clamp(0, width - 1)
+
+        # Windowed softmax over the patches (subtracting the max, the value at the argmax, for stability)
+        patches = x_flat.gather(1, indices.view(batch_size * channels, -1)).view(indices.size())
+        max_vals = x_flat.gather(1, argmax.view(-1, 1)).view(-1, 1, 1)
+        weights = torch.exp((patches - max_vals) / self.softmax_temp) * window * in_bounds
+        weights = weights / torch.sum(weights.view(batch_size * channels, -1), dim=1).view(-1, 1, 1)
+
+        # Expectation of the (base_index + step_size * i) coordinates
+        x_coords = torch.sum((weights * xs.to(x.dtype)).view(batch_size * channels, -1), dim=1)
+        y_coords = torch.sum((weights * ys.to(x.dtype)).view(batch_size * channels, -1), dim=1)
+        coords = torch.stack([x_coords, y_coords], dim=1).view(batch_size, channels, 2)
+        return self.base_index + self.step_size * coords
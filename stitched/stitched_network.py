@@ -4,6 +4,7 @@ from .soft_argmax import SoftArgmax2D
 from stacked_hourglass.pose.models.hourglass import HourglassNet
 from stacked_hourglass.pose.utils.evaluation import final_preds_post_processing
 from twod_threed.src.model import LinearModel as Transform2D3DNet
+from utils.device import load_checkpoint
 
 
 def _identity(x):
@@ -34,6 +35,7 @@ class StitchedNetwork(torch.nn.Module):
         self.hg_use_layer_norm = hg_use_layer_norm
         self.hg_mean = hg_mean
         self.hg_std = hg_std
+        self.hg_in_res = [height, width]
 
         self.baseline_linear_size = linear_size
         self.baseline_num_stage = num_stage
@@ -62,14 +64,14 @@ class StitchedNetwork(torch.nn.Module):
         :return: Nothing. Sets internal weights/state.
         """
         if file2 is not None:
-            hourglass_checkpoint = torch.load(file1)
-            twod_threed_checkpoint = torch.load(file2)
+            hourglass_checkpoint = load_checkpoint(file1)
+            twod_threed_checkpoint = load_checkpoint(file2)
 
             self.stacked_hourglass.load_state_dict(hourglass_checkpoint['state_dict'])
             self.twod_threed.load_state_dict(twod_threed_checkpoint['state_dict'])
 
         else:
-            checkpoint = torch.load(file1)
+            checkpoint = load_checkpoint(file1)
             self.load_state_dict(checkpoint['state_dict'])
 
 
@@ -98,8 +100,8 @@ class StitchedNetwork(torch.nn.Module):
         # Unpack meta
         centers = meta['center']
         scales = meta['scale']
-        mean_2d = meta['2d_mean'] if '2d_mean' in meta else None
-        std_2d = meta['2d_std'] if '2d_std' in meta else None
+        mean_2d = meta['2d_mean'].to(x.device) if '2d_mean' in meta else None
+        std_2d = meta['2d_std'].to(x.device) if '2d_std' in meta else None
 
         # 2D prediction
         heatmaps = self.stacked_hourglass(x)
@@ -114,11 +116,11 @@ class StitchedNetwork(torch.nn.Module):
         # If using dataset statistics for normalization, we should re-scale the pose as if it were 1000x1002 as in h36m
         # Instance normalization it will not matter the scale, so we can ignore this. (We could also safely multiply by
         # any constant, but that would be confusing).
-        twod_preds = self.joint_format_transform(twod_preds)
+        twod_preds = self.joint_format_transform(twod_preds).view(twod_preds.size(0), -1)
         if self.baseline_dataset_normalization:
             twod_preds *= 1000.0 / 64.0
-        normalized_twod_preds = data_utils.normalize_poses(twod_preds, 16, self.baseline_dataset_normalization,
-                                                           pose_mean=mean_2d, pose_std=std_2d, is_2d=True)
+        normalized_twod_preds, _, _ = data_utils.normalize_poses(twod_preds, 16, self.baseline_dataset_normalization,
+                                                                 pose_mean=mean_2d, pose_std=std_2d, is_2d=True)
 
         # Run through the 3D baseline network
         threed_preds = self.twod_threed(normalized_twod_preds)
@@ -1,11 +1,16 @@
-from torch.utils.data import Dataset, DataLoader
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
 
-from stitched.stitched_network import StitchedNetwork
 from stitched.run import load_model_and_dataset_mpii
 
 from utils.human36m_dataset import Human36mDataset
 
 from utils import train_loop
+from utils import data_utils
+from utils.device import module_device, load_checkpoint
 from utils import parameter_magnitude, gradient_magnitude, update_magnitude, update_ratio
 
 
@@ -16,13 +21,13 @@ def _make_optimizer_fn(model, lr, weight_decay):
     """
     The make optimizer function, as part of the interface for the "train_loop" function in utils.training_utils.
 
-    :param model: The model to make an optimizer for (in this case a FCGan object)
+    :param model: The model to make an optimizer for (in this case a StitchedNetwork object)
     :param lr: The learning rate to use
     :param weight_decay: THe weight decay to use
     :return: The optimizer for the network, which is passed into the remaining
         training loop functions
     """
-    return torch.optim.Adam(model.discr.parameters(), lr=lr, weight_decay=weight_decay, amsgrad=True)
+    return torch.optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay, amsgrad=True)
 
 
 def _load_fn(model, optimizer, load_file):
@@ -35,7 +40,7 @@ def _load_fn(model, optimizer, load_file):
     :return: The restored model, optimizer and the current epoch with the best validation loss seen so far.
     """
     # Load state dict, and update the model and
-    checkpoint = torch.load(load_file)
+    checkpoint = load_checkpoint(load_file)
     cur_epoch = checkpoint['next_epoch']
     best_val_loss = checkpoint['best_val_loss']
     model.load_state_dict(checkpoint['model_state_dict'])
@@ -100,11 +105,12 @@ def _update_op(model, optimizer, minibatch_data, iter, args):
     # Unpack the minibatch data, and, run the forward pass (get all of the data to compute a loss)
     img, _, _, pose, meta = minibatch_data
 
-    inputs = Variable(inps.cuda())
-    targets = Variable(pose.cuda(async=True))
-    criterion = nn.MSELoss(size_average=True).cuda()
+    device = module_device(model)
+    inputs = img.to(device)
+    targets = pose.to(device, non_blocking=True)
+    criterion = torch.nn.MSELoss()
 
-    preds = model(inputs)
+    _, _, preds = model(inputs, meta)
 
     # Compute the loss, and make an optimization step
     losses = {}
@@ -120,17 +126,17 @@ def _update_op(model, optimizer, minibatch_data, iter, args):
         weight_mag = parameter_magnitude(model)
         grad_mag = gradient_magnitude(model)
         update_mag = update_magnitude(model, args.lr, grad_mag)
-        update_ratio = update_ratio(model, args.lr, weight_mag, grad_mag)
+        model_update_ratio = update_ratio(model, args.lr, weight_mag, grad_mag)
         losses['model/weight_mag'] = weight_mag
         losses['model/grad_mag'] = grad_mag
         losses['model/update_mag'] = update_mag
-        losses['model/update_ratio'] = update_ratio
+        losses['model/update_ratio'] = model_update_ratio
 
     # Return the dictionary of 'losses'
     return losses
 
 
-def validation_loss(model, minibatch_data):
+def _validation_loss(model, minibatch_data):
     """
     Computes the (non-saturating) GAN loss on a minibatch that has not been seen during training at all.
 
@@ -146,11 +152,12 @@ def validation_loss(model, minibatch_data):
     # Unpack the minibatch data, and, run the forward pass (get all of the data to compute a loss)
     img, _, _, pose, meta = minibatch_data
 
-    inputs = Variable(inps.cuda())
-    targets = Variable(pose.cuda(async=True))
-    criterion = nn.MSELoss(size_average=True).cuda()
+    device = module_device(model)
+    inputs = img.to(device)
+    targets = pose.to(device, non_blocking=True)
+    criterion = torch.nn.MSELoss()
 
-    preds = model(inputs)
+    _, _, preds = model(inputs, meta)
 
     # Compute the same loss as above
     loss = criterion(targets, preds)
@@ -194,13 +201,15 @@ def train_stitched_fine_tune(args):
 
     # Make data loaders, correcting the color norm and std (as the hourglass was pre-trained on MPII)
     train_dataset = Human36mDataset(dataset_path=data_input_dir, is_train=True,
-                                    dataset_normalization=dataset_normalization, load_image_data=True)
+                                    dataset_normalization=dataset_normalization, load_image_data=True,
+                                    img_shard_dir=args.img_shard_dir)
     train_dataset.set_color_mean(model.hg_mean)
     train_dataset.set_color_std(model.hg_std)
     train_loader = DataLoader(dataset=train_dataset, batch_size=args.train_batch_size, shuffle=True,
                               num_workers=args.workers, pin_memory=True)
     val_dataset = Human36mDataset(dataset_path=data_input_dir, is_train=False,
-                                  dataset_normalization=dataset_normalization, load_image_data=True)
+                                  dataset_normalization=dataset_normalization, load_image_data=True,
+                                  img_shard_dir=args.img_shard_dir)
     val_dataset.set_color_mean(model.hg_mean)
     val_dataset.set_color_std(model.hg_std)
     val_loader = DataLoader(dataset=val_dataset, batch_size=args.test_batch_size, shuffle=True,
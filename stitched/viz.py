@@ -1,84 +1,359 @@
-import cv2
-import scipy
+from __future__ import print_function, absolute_import, division
+
 import os
+import time
+import threading
+import multiprocessing as mp
+
+import cv2
 import numpy as np
+import torch
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from twod_threed.src.viz import viz_3d_pose
 from stacked_hourglass.evaluation.utils import visualize as viz_2d_overlay
+from stitched.realtime import FramePreprocessor
+from stitched.run import load_model_h36m, load_2d_pose_normalization_stats
+from utils.device import module_device
 
 
 
 
 def visualize_video(options):
     """
-    Visualization run on a video. # TODO: Actually explain what it's doing
-    :param options: # TODO: actually describe these
+    Visualization run on a video. Each frame is passed through the stitched network, and the output is a single video
+    (<output_dir>/<video name>_viz.mp4) with the 2D pose overlaid on each frame, next to a plot of the 3D pose.
+
+    The work is split into a pipeline of stages, connected by bounded queues, so that the stages all run at once, and
+    memory use doesn't grow with the length of the video:
+        decode (thread) -> batch preprocess (thread) -> inference (main thread) -> render (processes) -> encode (process)
+    Rendering (matplotlib) and encoding are cpu bound and hold the GIL, so they are run in their own processes. Once
+    the video is finished, the per stage latencies and the end to end fps are printed. If any stage fails, the error is
+    raised here (rather than the other stages waiting on it forever).
+
+    Important options params:
+    options.input_file: The video to visualize
+    options.load, options.load_hourglass, options.load_2d3d: The model (see load_model_h36m)
+    options.data_dir, options.dataset_normalization: The 2D pose statistics (see load_2d_pose_normalization_stats)
+    options.output_dir: The directory to write the output video to
+    options.viz_batch_size: The number of frames to run the network on at once
+    options.viz_render_workers: The number of processes to render frames with
+    options.viz_queue_size: The maximum number of frames (or batches) waiting between any two stages
+
+    :param options: The options passed in by command line
     """
-    # Unpack optiosn
+    # Unpack options
     video_filename = options.input_file
     file = options.load
     hg_file = options.load_hourglass
     threed_baseline_file = options.load_2d3d
     output_dir = options.output_dir
+    batch_size = options.viz_batch_size
+    num_render_workers = options.viz_render_workers
+    queue_size = options.viz_queue_size
 
-    # If file isn't empty, then we have a complete checkpoint. Which can be loaded by setting the following
-    if file != '':
-        hg_file = file
-        threed_baseline_file = None
+    # Work out the output filename, and the frame rate to write it with
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    video_name = os.path.splitext(os.path.basename(video_filename))[0]
+    output_filename = os.path.join(output_dir, "{v}_viz.mp4".format(v=video_name))
+    vid = cv2.VideoCapture(video_filename)
+    fps = vid.get(cv2.CAP_PROP_FPS) or 25.0
+    vid.release()
 
-    # Load the model, and get the normalization statistics from the human3.6m dataset
-    model, dataloader = load_model_and_dataset_h36m(file, hg_file, threed_baseline_file, args)
-    pose_2d_mean = dataloader.dataset.pose_2d_mean
-    pose_2d_std = dataloader.dataset.pose_2d_std
+    # Start the render and encode processes first (forking is only safe before cuda is initialized/threads are started)
+    render_queue = mp.Queue(queue_size)
+    encode_queue = mp.Queue(queue_size)
+    stats_queue = mp.Queue()
+    processes = [mp.Process(target=_render_worker, args=(render_queue, encode_queue))
+                 for _ in range(num_render_workers)]
+    processes.append(mp.Process(target=_encode_worker,
+                                args=(encode_queue, stats_queue, output_filename, fps, num_render_workers)))
+    for process in processes:
+        process.daemon = True
+        process.start()
 
-    # Load the video
-    vid = cv2.VideoCapture(video_filename)
+    # Load the model, and the normalization statistics from the human3.6m dataset (if the model uses them)
+    model = load_model_h36m(file, hg_file, threed_baseline_file, options)
+    device = module_device(model)
+    pose_2d_mean, pose_2d_std = load_2d_pose_normalization_stats(options)
+    preprocess = FramePreprocessor(model)
+
+    # Start decoding and preprocessing in background threads
+    frame_queue = queue.Queue(queue_size)
+    batch_queue = queue.Queue(max(queue_size // batch_size, 2))
+    decode_times = []
+    preprocess_times = []
+    stage_errors = []
+    decoder = threading.Thread(target=_run_stage, args=(_decode_frames, (video_filename, frame_queue, decode_times),
+                                                        frame_queue, stage_errors))
+    preprocessor = threading.Thread(target=_run_stage,
+                                    args=(_preprocess_frames,
+                                          (frame_queue, batch_queue, batch_size, device, preprocess, preprocess_times),
+                                          batch_queue, stage_errors))
+    decoder.daemon = True
+    preprocessor.daemon = True
+    start = time.time()
+    decoder.start()
+    preprocessor.start()
+
+    # Run the network on each batch (in this thread), and pass each frame on to be rendered
+    inference_times = []
+    num_frames = 0
+    try:
+        with torch.no_grad():
+            batch = batch_queue.get()
+            while batch is not None:
+                indices, frames, decode_stamps, inputs, centers, scales = batch
+                batch_start = time.time()
+                meta = {'center': centers, 'scale': scales}
+                if pose_2d_mean is not None:
+                    meta['2d_mean'] = torch.from_numpy(np.tile(pose_2d_mean, (len(indices), 1)))
+                    meta['2d_std'] = torch.from_numpy(np.tile(pose_2d_std, (len(indices), 1)))
+                _, twod_preds, threed_preds = model(inputs, meta)
+                twod_preds = twod_preds.cpu().numpy()
+                threed_preds = threed_preds.cpu().numpy()
+                inference_times.append((time.time() - batch_start, len(indices)))
+
+                for i in range(len(indices)):
+                    _put_checked(render_queue,
+                                 (indices[i], frames[i], twod_preds[i], threed_preds[i], decode_stamps[i]), processes)
+                num_frames += len(indices)
+                print("Visualized {n} frames".format(n=num_frames))
+                batch = batch_queue.get()
+
+        # (A failed decode/preprocess stage ends its output early, so the video stopped short)
+        if len(stage_errors) > 0:
+            raise stage_errors[0]
+
+    finally:
+        # Tell every renderer to finish (even if inference failed, so that they exit)
+        for _ in range(num_render_workers):
+            _put_checked(render_queue, None, processes)
+
+    # Wait for the encoder to finish writing the video
+    render_times, encode_times, latencies = _get_checked(stats_queue, processes)
+    for process in processes:
+        process.join()
+    decoder.join()
+    preprocessor.join()
+    total_time = time.time() - start
+
+    # Report
+    print("Wrote {n} frames to {f}".format(n=num_frames, f=output_filename))
+    _print_stage_latency("decode", [(t, 1) for t in decode_times])
+    _print_stage_latency("preprocess", preprocess_times)
+    _print_stage_latency("inference", inference_times)
+    _print_stage_latency("render", [(t, 1) for t in render_times])
+    _print_stage_latency("encode", [(t, 1) for t in encode_times])
+    if len(latencies) > 0:
+        print("end to end: {f:.1f} fps | frame latency p50: {p50:.1f}ms | p99: {p99:.1f}ms".format(
+            f=num_frames / total_time, p50=np.percentile(latencies, 50) * 1000.0,
+            p99=np.percentile(latencies, 99) * 1000.0))
+
+
+
+
+def _run_stage(stage, args, out_queue, errors):
+    """
+    Runs a decode/preprocess stage (in a thread). If the stage fails, its error is appended to 'errors' and the end of
+    its output is still marked with a None, so that the stages after it (and the main thread) don't wait forever.
+    """
+    try:
+        stage(*args)
+    except Exception as e:
+        errors.append(e)
+        out_queue.put(None)
+        raise
+
+
+
+
+def _put_checked(mp_queue, item, processes, timeout=1.0):
+    """
+    Put 'item' into a queue read by the render/encode 'processes', raising (rather than blocking forever) if any of
+    them died.
+    """
+    while True:
+        try:
+            mp_queue.put(item, timeout=timeout)
+            return
+        except queue.Full:
+            try:
+                _check_processes(processes)
+            except RuntimeError:
+                # (nothing will read the queue now, so don't wait to flush it into the pipe on exit)
+                mp_queue.cancel_join_thread()
+                raise
+
+
+
+
+def _get_checked(mp_queue, processes, timeout=1.0):
+    """
+    Get an item from a queue written by the render/encode 'processes', raising (rather than blocking forever) if any
+    of them died, or the encoder (the last process) exited without writing it.
+    """
+    while True:
+        try:
+            return mp_queue.get(timeout=timeout)
+        except queue.Empty:
+            _check_processes(processes)
+            if not processes[-1].is_alive():
+                # (the encoder may have put the item just after the timeout, before exiting)
+                try:
+                    return mp_queue.get(timeout=timeout)
+                except queue.Empty:
+                    raise RuntimeError("The encode process exited without finishing the video")
 
-    # Loop through all frames of the video, and run model one frame at a time...
+
+
+
+def _check_processes(processes):
+    """
+    Raise if any of the render/encode 'processes' died (exited with an error).
+    """
+    for process in processes:
+        if process.exitcode is not None and process.exitcode != 0:
+            raise RuntimeError("A render/encode process exited with code {c}".format(c=process.exitcode))
+
+
+
+
+def _decode_frames(video_filename, frame_queue, decode_times):
+    """
+    Decode stage. Reads the (RGB) frames of a video into 'frame_queue', as (index, frame, time decoded) tuples,
+    followed by None.
+    """
+    vid = cv2.VideoCapture(video_filename)
     i = 0
-    succ, img = vid.read()
-    while succ:
-        # Progress
-        if i % 100 == 0:
-            print(i)
-
-        # Get meta data
-        height, width, channels = img.shape
-        center = [height // 2, width // 2]
-        scale = max(*center) / 256.0
-
-        meta = {
-            'center': torch.Tensor(center),
-            'scale': torch.Tensor(scale),
-            '2d_mean': pose_2d_mean,
-            '2d_std': pose_2d_std,
-        }
-
-        # Forward pass
-        img = np.transpose(img, (2,0,1))
-        inputs = torch.Variable(torch.Tensor(img))
-
-        _, twod_preds, threed_preds = model(inputs, meta)
-
-        # Make visualization image
-        twod_preds = twod_preds.numpy()
-        threed_preds = threed_preds.numpy()
-        twod_overlay = viz_2d_overlay(img, twod_preds)
-        threed_viz = viz_3d_pose(threed_preds)
+    decode_start = time.time()
+    success, img = vid.read()
+    while success:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        decode_times.append(time.time() - decode_start)
+        frame_queue.put((i, img, time.time()))
+        i += 1
+        decode_start = time.time()
+        success, img = vid.read()
+    vid.release()
+    frame_queue.put(None)
+
+
+
+
+def _preprocess_frames(frame_queue, batch_queue, batch_size, device, preprocess, preprocess_times):
+    """
+    Batch preprocess stage. Collects frames from 'frame_queue' into batches, and crops (the whole frame), resizes and
+    color normalizes them (as Human36mDataset does) on the device, all at once, with 'preprocess' (a FramePreprocessor,
+    see realtime.py). Puts (indices, frames, times decoded, inputs, centers, scales) tuples into 'batch_queue',
+    followed by None.
+    """
+    done = False
+    while not done:
+        # Wait for a full batch (or the end of the video)
+        items = []
+        while len(items) < batch_size:
+            item = frame_queue.get()
+            if item is None:
+                done = True
+                break
+            items.append(item)
+        if len(items) == 0:
+            break
+
+        # Every frame in a video is the same size, so share the crop between the batch
+        batch_start = time.time()
+        indices, frames, decode_stamps = zip(*items)
+        imgs = torch.from_numpy(np.stack(frames)).permute(0, 3, 1, 2)
+        if device.type == "cuda":
+            imgs = imgs.pin_memory()
+        imgs = imgs.to(device, non_blocking=True)
+        with torch.no_grad():
+            inputs, center, scale = preprocess(imgs)
+        centers = torch.from_numpy(np.tile(center, (len(frames), 1)))
+        scales = torch.full((len(frames),), scale)
+        preprocess_times.append((time.time() - batch_start, len(frames)))
+        batch_queue.put((indices, frames, decode_stamps, inputs, centers, scales))
+    batch_queue.put(None)
+
+
+
+
+def _render_worker(render_queue, encode_queue):
+    """
+    Render stage (run in a process). Draws the 2D pose over each frame, and plots the 3D pose next to it, putting
+    (index, image, render time, time decoded) tuples into 'encode_queue'. Passes on the None at the end of the video.
+    """
+    item = render_queue.get()
+    while item is not None:
+        index, frame, twod_pred, threed_pred, decode_stamp = item
+        render_start = time.time()
+        twod_overlay = viz_2d_overlay(np.ascontiguousarray(frame), np.round(twod_pred).astype(np.int32))
+        threed_viz = viz_3d_pose(threed_pred)
         out_img = _pack_images([twod_overlay, threed_viz])
+        encode_queue.put((index, out_img, time.time() - render_start, decode_stamp))
+        item = render_queue.get()
+    encode_queue.put(None)
 
-        # Save the image
-        output_filename = os.path.joint(output_dir, str(i))
-        scipy.misc.imsave(output_filename, out_img)
 
-        # Next image
-        succ, img = vid.read()
-        i += 1
 
 
+def _encode_worker(encode_queue, stats_queue, output_filename, fps, num_render_workers):
+    """
+    Encode stage (run in a process). Writes the rendered frames into a single video, in order (the renderers finish
+    frames out of order, so frames are held until every frame before them has been written). Once every renderer has
+    finished, puts the render times, encode times and end to end latencies of each frame into 'stats_queue'.
+    """
+    writer = None
+    pending = {}
+    next_index = 0
+    render_times, encode_times, latencies = [], [], []
+    num_finished = 0
+    while num_finished < num_render_workers:
+        item = encode_queue.get()
+        if item is None:
+            num_finished += 1
+            continue
+        index, out_img, render_time, decode_stamp = item
+        render_times.append(render_time)
+        pending[index] = (out_img, decode_stamp)
+
+        # Write every frame that we can
+        while next_index in pending:
+            out_img, decode_stamp = pending.pop(next_index)
+            encode_start = time.time()
+            if writer is None:
+                height, width = out_img.shape[:2]
+                writer = cv2.VideoWriter(output_filename, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+            writer.write(cv2.cvtColor(out_img, cv2.COLOR_RGB2BGR))
+            encode_times.append(time.time() - encode_start)
+            latencies.append(time.time() - decode_stamp)
+            next_index += 1
+
+    if writer is not None:
+        writer.release()
+    stats_queue.put((render_times, encode_times, latencies))
 
 
 
 
+def _print_stage_latency(name, times):
+    """
+    Prints the average latency of a stage, per item (frame or batch) and per frame, given a list of (time taken, number
+    of frames) tuples.
+    """
+    if len(times) == 0:
+        return
+    seconds, frames = zip(*times)
+    print("{n:10s}: {i:8.2f}ms per item | {f:8.2f}ms per frame".format(
+        n=name, i=np.mean(seconds) * 1000.0, f=np.sum(seconds) * 1000.0 / np.sum(frames)))
+
+
 
 
 def _pack_images(img_list):
@@ -98,11 +373,11 @@ def _pack_images(img_list):
             y_max = height
 
     # Make a canvas and paste the image list into it
-    canvas = np.zeros((y_max, x_total, 3))
+    canvas = np.zeros((y_max, x_total, 3), dtype=img_list[0].dtype)
     x_running = 0
     for img in img_list:
         height, width, _ = img.shape
         canvas[:height, x_running:x_running + width, :] = img
         x_running += width
 
-    return canvas
\ No newline at end of file
+    return canvas
@@ -26,9 +26,11 @@ import twod_threed.src.misc as misc
 import twod_threed.src.log as log
 
 from twod_threed.src.model import LinearModel, weight_init, Discriminator, ProjectNet
-from twod_threed.src.datasets.human36m import Human36M
+from twod_threed.src.datasets.human36m import Human36M, ResidentHuman36M
+from utils.human36m_dataset import collate_batch
 
-from utils import data_utils
+from utils.eval_utils import PoseErrorAccumulator
+from utils.device import get_device, module_device, load_checkpoint
 from utils.plotting_utils import *
 from utils.osutils import mkdir_p, isdir
 
@@ -237,17 +239,18 @@ def _main_regression(opt):
 
     # create model
     print(">>> creating model")
+    device = get_device(opt)
     model = LinearModel(dataset_normalized_input=opt.dataset_normalization)
-    model = model.cuda()
+    model = model.to(device)
     model.apply(weight_init)
     print(">>> total params: {:.2f}M".format(sum(p.numel() for p in model.parameters()) / 1000000.0))
-    criterion = nn.MSELoss(size_average=True).cuda()
+    criterion = nn.MSELoss(size_average=True).to(device)
     optimizer = torch.optim.Adam(model.parameters(), lr=opt.lr)
 
     # load ckpt
     if opt.load:
         print(">>> loading ckpt from '{}'".format(opt.load))
-        ckpt = torch.load(opt.load)
+        ckpt = load_checkpoint(opt.load)
         start_epoch = ckpt['epoch']
         err_best = ckpt['err']
         glob_step = ckpt['step']
@@ -286,7 +289,8 @@ def _main_regression(opt):
             lr_init=opt.lr, lr_now=lr_now, glob_step=glob_step, lr_decay=opt.lr_decay, gamma=opt.lr_gamma,
             no_grad_clipping=opt.no_grad_clipping, grad_clip=opt.grad_clip, tb_log_freq=opt.tb_log_freq,
             use_horovod=opt.use_horovod)
-        loss_test, err_test = _test(test_loader, model, criterion, opt.dataset_normalization, procrustes=opt.procrustes)
+        loss_test, err_test = _test(test_loader, model, criterion, opt.dataset_normalization, procrustes=opt.procrustes,
+                                    use_horovod=opt.use_horovod)
 
         # Update tensorboard summaries
         writer.add_scalars('data/epoch/loss', {'train_loss': loss_train, 'test_loss': loss_test}, epoch)
@@ -328,7 +332,9 @@ def _main_regression(opt):
 
 def _make_torch_data_loaders(opt, actions):
     """
-    Load the PyTorch datasets and data loaders.
+    Load the PyTorch datasets and data loaders. Batches are fetched with a single (vectorized) call to the dataset
+    (see Human36mDataset.get_batch), and are already collated. If 'opt.resident_dataset' is set, then the whole
+    dataset is kept on the training device, and the "loaders" are ResidentHuman36M objects instead.
     """
     train_dataset = Human36M(actions=actions, data_path=opt.data_dir,
                              orthogonal_data_augmentation_prob=opt.orthogonal_data_augmentation_prob,
@@ -337,6 +343,16 @@ def _make_torch_data_loaders(opt, actions):
     test_dataset = Human36M(actions=actions, data_path=opt.data_dir,
                              dataset_normalization=opt.dataset_normalization, is_train=False)
 
+    if opt.resident_dataset:
+        num_replicas = hvd.size() if opt.use_horovod else 1
+        rank = hvd.rank() if opt.use_horovod else 0
+        device = get_device(opt)
+        train_loader = ResidentHuman36M(train_dataset, opt.train_batch_size, shuffle=True, device=device,
+                                        num_replicas=num_replicas, rank=rank)
+        test_loader = ResidentHuman36M(test_dataset, opt.test_batch_size, shuffle=False, device=device,
+                                       num_replicas=num_replicas, rank=rank)
+        return train_dataset, train_loader, test_loader
+
     if opt.use_horovod:
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset, num_replicas=hvd.size(),
                                                                         rank=hvd.rank())
@@ -345,6 +361,7 @@ def _make_torch_data_loaders(opt, actions):
             batch_size=opt.train_batch,
             sampler=train_sampler, # shuffle=True,#sampler=train_sampler,
             num_workers=args.workers,
+            collate_fn=collate_batch,
             pin_memory=True)
         test_sampler = torch.utils.data.distributed.DistributedSampler(test_dataset, num_replicas=hvd.size(),
                                                                       rank=hvd.rank())
@@ -353,6 +370,7 @@ def _make_torch_data_loaders(opt, actions):
             batch_size=opt.train_batch,
             sampler=test_sampler, # shuffle=True,#sampler=train_sampler,
             num_workers=args.workers,
+            collate_fn=collate_batch,
             pin_memory=True)
     else:
         train_loader = DataLoader(
@@ -360,12 +378,14 @@ def _make_torch_data_loaders(opt, actions):
             batch_size=opt.train_batch_size,
             shuffle=True,
             num_workers=opt.workers,
+            collate_fn=collate_batch,
             pin_memory=True)
         test_loader = DataLoader(
             dataset=test_dataset,
             batch_size=opt.test_batch_size,
             shuffle=False,
             num_workers=opt.workers,
+            collate_fn=collate_batch,
             pin_memory=True)
     return train_dataset, train_loader, test_loader
 
@@ -382,6 +402,7 @@ def _train(train_loader, model, criterion, optimizer, writer,
     losses = utils.AverageMeter()
 
     model.train()
+    device = module_device(model)
 
     start = time.time()
     batch_time = 0
@@ -392,8 +413,8 @@ def _train(train_loader, model, criterion, optimizer, writer,
         if glob_step % lr_decay == 0 or glob_step == 1:
             lr_now = utils.lr_decay(optimizer, glob_step, lr_init, lr_decay, gamma)
 
-        inputs = Variable(inps.cuda())
-        targets = Variable(tars.cuda(async=True))
+        inputs = Variable(inps.to(device))
+        targets = Variable(tars.to(device, non_blocking=True))
 
         outputs = model(inputs)
 
@@ -664,23 +685,28 @@ def _train_gan(train_loader, G, F, D_X, D_Y, unorm3d, renorm2d, criterion, gen_o
 
 
 
-def _test(test_loader, model, criterion, dataset_normalization, procrustes=False):
+def _test(test_loader, model, criterion, dataset_normalization, procrustes=False, use_horovod=False):
     """
     A validation epoch, to test the prediction of 3D poses from 2D poses, regardless of how the network has been trained.
     Because really, this is all that we care about.
+
+    The errors are streamed into a PoseErrorAccumulator (MPJPE, and PA-MPJPE if 'procrustes', per action and per
+    joint), which is summed over every rank when using horovod. The error returned is the PA-MPJPE if 'procrustes',
+    otherwise MPJPE.
     """
     losses = utils.AverageMeter()
 
     model.eval()
+    device = module_device(model)
 
-    all_dist = []
+    accumulator = PoseErrorAccumulator(procrustes=procrustes)
     start = time.time()
     batch_time = 0
     bar = Bar('>>>', fill='>', max=len(test_loader))
 
     for i, (inps, tars, meta) in enumerate(test_loader):
-        inputs = Variable(inps.cuda())
-        targets = Variable(tars.cuda(async=True))
+        inputs = Variable(inps.to(device))
+        targets = Variable(tars.to(device, non_blocking=True))
 
         outputs = model(inputs)
 
@@ -691,7 +717,7 @@ def _test(test_loader, model, criterion, dataset_normalization, procrustes=False
         losses.update(loss.data[0], inputs.size(0))
 
         # Calculate the errors in the unormalized space
-        all_dist.append(compute_3d_pose_error_distances(outputs, targets, meta, dataset_normalization, procrustes))
+        accumulator.add_batch(outputs, targets, meta, dataset_normalization)
 
         # update summary
         if (i + 1) % 100 == 0:
@@ -707,16 +733,28 @@ def _test(test_loader, model, criterion, dataset_normalization, procrustes=False
                     loss=losses.avg)
         bar.next()
 
-    all_dist = np.vstack(all_dist)
-    joint_err = np.mean(all_dist, axis=0)
-    ttl_err = np.mean(all_dist)
     bar.finish()
+    if use_horovod:
+        accumulator.reduce(_horovod_sum)
+    results = accumulator.results()
+    ttl_err = results['pa_mpjpe'] if procrustes else results['mpjpe']
+    if not use_horovod or hvd.rank() == 0:
+        print(accumulator.summary())
     print (">>> error: {} <<<".format(ttl_err))
     return losses.avg, ttl_err
 
 
 
 
+def _horovod_sum(array):
+    """
+    The sum of a numpy array over every (horovod) rank
+    """
+    return hvd.allreduce(torch.from_numpy(array), average=False).numpy()
+
+
+
+
 
 if __name__ == "__main__":
     option = Options().parse()
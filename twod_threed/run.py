@@ -11,6 +11,7 @@ import torch.optim
 from twod_threed.src.model import LinearModel, weight_init
 from twod_threed.src.datasets.human36m import Human36M
 
+from utils.device import get_device, module_device, load_checkpoint
 from utils.osutils import mkdir_p, isfile, isdir, join
 
 
@@ -24,6 +25,8 @@ def run(options):
     options.data_dir: The input directory for data (2D poses) to pass through the network
     options.output_dir: The directory to store output predictions
     options.process_as_video: Whether to process the data input as a video, and then output it as a video too
+    options.device: The device to run on (e.g. "cpu", see utils/device.py)
+    options.video_batch_size: The maximum number of frames (from one or more videos) to run the network on at once
 
     :param options: The options passed in by command line
     """
@@ -32,27 +35,31 @@ def run(options):
     data_input_dir = options.data_dir
     data_output_dir = options.output_dir
     process_as_video = options.process_as_video
+    max_batch_size = options.video_batch_size
+    if max_batch_size < 1:
+        raise ValueError("--video_batch_size must be at least 1, got {b}".format(b=max_batch_size))
 
     # Run
-    model = _load_model(model_file)
-    dataset = _run_model(model, data_input_dir, process_as_video)
+    model = _load_model(model_file, get_device(options))
+    dataset = _run_model(model, data_input_dir, process_as_video, max_batch_size)
     _save_preds(dataset, data_output_dir)
 
 
 
-def _load_model(model_file):
+def _load_model(model_file, device):
     """
     Load the PyTorch 2D to 3D pose model
 
     :param model_file: The file for the saved model
+    :param device: The device to put the model on
     :return: A PyTorch nn.Module object for the trained 2D pose to 3D pose network
     """
     # Make the model
     model = LinearModel()
-    model = model.cuda()
+    model = model.to(device)
 
     # Load weights + set in eval mode
-    checkpoint = torch.load(model_file)
+    checkpoint = load_checkpoint(model_file)
     model.load_state_dict(checkpoint['state_dict'])
     model.eval()
 
@@ -60,66 +67,103 @@ def _load_model(model_file):
 
 
 
-def _run_model(model, data_input_dir, process_as_video):
+def _run_model(model, data_input_dir, process_as_video, max_batch_size=4096):
     """
-    Run a trained model on an entire dataset
+    Run a trained model on an entire dataset. Frames are packed into batches of (at most) 'max_batch_size' frames,
+    so that several (short) videos are processed at once, and long videos are processed in chunks.
 
-    :param model: PyTorch nn.Module object for the trained Stacked Hourglass network
+    :param model: PyTorch nn.Module object for the trained 2D pose to 3D pose network
     :param data_input_dir: Directory for the dataset to run network on
     :param process_as_video: If the data input is a video, and should be output as a 'video' too
-    :return: PyTorch Dataset object of 2D pose predictions
+    :param max_batch_size: The maximum number of frames to run the network on at once
+    :return: A dict of 3D pose predictions, with the same keys as the dataset. Each value is a (T, 51) tensor for a
+        video of T frames, or a (51,) tensor for a single image
     """
-    # Load in the dictionary/dataset + make a blank dict for 3D pose predictions
+    # Load in the dictionary/dataset, and make (contiguous) outputs for each video/image (with a 'time' dimension)
     dataset = torch.load(data_input_dir)
-    predictions = {}
-
-    i = 0
-
-    # Loop through all keys in dataset. Handle single images by unsqeezing and squeezing to simulate a "batch"
-    for key in dataset:
-        # Progress
-        if i % 30 == 0:
-            print("At " + str(i) + " out of " + str(len(dataset)) + " videos.")
-        i += 1
-
+    keys = list(dataset.keys())
+    inputs = {}
+    outputs = {}
+    for key in keys:
         input_tensor = torch.Tensor(dataset[key])
+        num_frames = input_tensor.size(0) if process_as_video else 1
+        inputs[key] = input_tensor.view(num_frames, -1)
+        outputs[key] = torch.zeros(num_frames, model.advertised_output_size)
+
+    # Run the network on each batch, and copy the outputs back to their videos
+    start = time.time()
+    num_frames = 0
+    for i, batch in enumerate(_video_batches(keys, inputs, max_batch_size)):
+        # Progress
+        if i % 100 == 0:
+            print("At batch " + str(i) + ", " + str(num_frames) + " frames processed.")
+        num_frames += _run_model_batch(model, batch, inputs, outputs)
 
-        if process_as_video:
-            predictions[key] = _run_model_video(model, input_tensor)
-        else:
-            predictions[key] = _run_model_single_image(model, input_tensor)
+    # Report the throughput
+    elapsed = time.time() - start
+    print("Processed {n} frames from {v} {kind} in {t:.2f}s ({fps:.1f} frames/sec).".format(
+        n=num_frames, v=len(keys), kind="videos" if process_as_video else "images", t=elapsed,
+        fps=num_frames / max(elapsed, 1.0e-6)))
 
-    return predictions
+    # Remove the phantom 'time' dimension from single images
+    if not process_as_video:
+        for key in keys:
+            outputs[key] = outputs[key][0]
+    return outputs
 
 
 
-def _run_model_video(model, input_tensor):
+def _video_batches(keys, inputs, max_batch_size):
     """
-    If each input is a video (rather than a single frame), run the network on all of the frames
-    independently, and aggregate the result in a torch.Tensor.
+    Generator for batches to run the network on. Each batch is a list of (key, start, end) chunks, meaning frames
+    [start, end) of the video 'key', with at most 'max_batch_size' frames in total.
 
-    :param model: PyTorch nn.Module object for the trained Stacked Hourglass network
-    :param input_tensor: 4D tensor, (time, x, y, depth) indexed for a video
-    :return: 3D tensor (time, joints, coords) for 2D joint predictions
+    :param keys: The keys of the videos, in the order to process them
+    :param inputs: A dict from keys to the (T, input_size) inputs for each video
+    :param max_batch_size: The maximum number of frames in a batch
     """
-    frames = []
-    for i in range(input_tensor.size()[0]):
-        frames.append(_run_model_single_image(model, input_tensor[i]))
-    return frames
-
-
-
-def _run_model_single_image(model, input_tensor):
+    batch = []
+    batch_size = 0
+    for key in keys:
+        start = 0
+        video_len = inputs[key].size(0)
+        while start < video_len:
+            end = min(video_len, start + max_batch_size - batch_size)
+            batch.append((key, start, end))
+            batch_size += end - start
+            start = end
+            if batch_size == max_batch_size:
+                yield batch
+                batch = []
+                batch_size = 0
+    if batch_size > 0:
+        yield batch
+
+
+
+def _run_model_batch(model, batch, inputs, outputs):
     """
-    Takes a list of 2D joint coordinates for a single frame and runs the network to produce 3D joint coords
+    Run the network on a batch (from _video_batches), writing the predictions into 'outputs'
 
     :param model: The PyTorch model
-    :param input_tensor: The 2dim PyTorch tensor containing the input joint coords
-    :return: The 3D join coords predicted by the network
+    :param batch: A list of (key, start, end) chunks of videos
+    :param inputs: A dict from keys to the (T, input_size) inputs for each video
+    :param outputs: A dict from keys to the (T, output_size) outputs for each video, written to
+    :return: The number of frames in the batch
     """
-    input_var = torch.autograd.Variable(input_tensor.unsqueeze(0).cuda(), volatile=True)
-    output = model(input_var)
-    return output[-1].data.cpu()
+    device = module_device(model)
+    batch_input = torch.cat([inputs[key][start:end] for key, start, end in batch], dim=0)
+    if device.type == "cuda":
+        batch_input = batch_input.pin_memory()
+
+    with torch.no_grad():
+        batch_output = model(batch_input.to(device, non_blocking=True)).cpu()
+
+    offset = 0
+    for key, start, end in batch:
+        outputs[key][start:end] = batch_output[offset:offset + end - start]
+        offset += end - start
+    return offset
 
 
 
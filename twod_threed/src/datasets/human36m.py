@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, absolute_import
 
+import math
 import os
 import torch
 import numpy as np
 from torch.utils.data import Dataset
 
 from utils.human36m_dataset import Human36mDataset
+from utils import data_utils
 
 
 TRAIN_SUBJECTS = [1, 5, 6, 7, 8]
@@ -44,3 +46,172 @@ class Human36M(Human36mDataset):
     def __getitem__(self, index):
         _, _, pose_projected, pose_camera_coords, meta = super(Human36M, self).__getitem__(index)
         return pose_projected, pose_camera_coords, meta
+
+
+
+class ResidentHuman36M(object):
+    """
+    A replacement for a DataLoader over a Human36M dataset, which keeps all of the poses (and per-frame camera
+    indices) resident as tensors on the training device. The orthogonal augmentation, projection, normalization and
+    joint dropping (see Human36mDataset.__getitem__) are all performed as batched tensor ops, and shuffling is a
+    permutation of indices, so there are no worker processes or per-sample collation.
+
+    Iterating gives (inps, tars, meta) tuples, as the DataLoader would. Meta only contains the values needed to
+    "unnormalize" the poses, and the action ids (which are kept on the CPU, as in the collated meta from the
+    DataLoader).
+    """
+    def __init__(self, dataset, batch_size, shuffle=True, device="cuda", num_replicas=1, rank=0):
+        """
+        :param dataset: The Human36M dataset to make resident
+        :param batch_size: The batch size to use
+        :param shuffle: If we should shuffle the dataset each epoch
+        :param device: The device to keep the dataset on (the training device)
+        :param num_replicas: The number of processes training (with horovod), each gets a different shard per epoch
+        :param rank: The rank of this process (with horovod)
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = torch.device(device)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        # Copy the poses, cameras and per frame camera indices to the device (once)
+        subjects = dataset.pose_meta["subject_number"]
+        self.poses = self._to_device(np.asarray(dataset.pose, dtype=np.float32))
+        self.cam_params = self._to_device(dataset.cam_params.astype(np.float32))
+        self.frame_cam_indices = self._to_device(dataset.subject_cam_indices[subjects])
+        self.action_ids = self._to_device(dataset.pose_meta["action_id"].astype(np.int64))
+
+        # Dimensions to use and normalization stats
+        self.pose_2d_indx_to_use = self._to_device(dataset.pose_2d_indx_to_use)
+        self.pose_3d_indx_to_use = self._to_device(dataset.pose_3d_indx_to_use)
+        self.pose_2d_mean = self._to_device(dataset.pose_2d_mean.astype(np.float32))
+        self.pose_2d_std = self._to_device(dataset.pose_2d_std.astype(np.float32))
+        self.pose_3d_mean = self._to_device(dataset.pose_3d_mean.astype(np.float32))
+        self.pose_3d_std = self._to_device(dataset.pose_3d_std.astype(np.float32))
+
+        self.num_samples = len(dataset) // num_replicas
+
+
+
+    def _to_device(self, array):
+        return torch.from_numpy(np.array(array)).to(self.device)
+
+
+
+    def __len__(self):
+        """
+        The number of batches per epoch
+        """
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+
+    def __iter__(self):
+        """
+        Iterate through one epoch of batches. If using multiple replicas, the permutation is seeded by the epoch so
+        that all replicas agree on the shards.
+        """
+        if self.shuffle and self.num_replicas > 1:
+            generator = torch.Generator()
+            generator.manual_seed(self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=generator).to(self.device)
+        elif self.shuffle:
+            indices = torch.randperm(len(self.dataset)).to(self.device)
+        else:
+            indices = torch.arange(len(self.dataset), device=self.device)
+        indices = indices[self.rank:self.num_replicas * self.num_samples:self.num_replicas]
+        self.epoch += 1
+
+        for beg in range(0, self.num_samples, self.batch_size):
+            yield self.get_batch(indices[beg:beg + self.batch_size])
+
+
+
+    def _rand_orthogonal_transform_matrices(self, n):
+        """
+        Torch (on device) version of Human36mDataset.rand_orthogonal_transform_matrices
+        """
+        angles = 2.0 * math.pi * torch.rand(n, device=self.device)
+        if self.dataset.z_rotations_only:
+            normals = torch.tensor([[0.0, 0.0, 1.0]], device=self.device).expand(n, 3)
+        else:
+            theta = torch.acos(2.0 * torch.rand(n, device=self.device) - 1.0)
+            phi = 2.0 * math.pi * torch.rand(n, device=self.device)
+            normals = torch.stack([torch.sin(theta) * torch.cos(phi),
+                                   torch.sin(theta) * torch.sin(phi),
+                                   torch.cos(theta)], 1)
+        Qs = data_utils.rotation_matrices_torch(normals, angles)
+
+        # Randomly flip (in the x axis)
+        flips = torch.rand(n, device=self.device) < self.dataset.flip_prob
+        flip_signs = torch.ones(n, 1, 3, device=self.device)
+        flip_signs[:, 0, 0] = 1.0 - 2.0 * flips.float()
+        return Qs * flip_signs
+
+
+
+    def get_batch(self, indices):
+        """
+        Compute a batch, as Human36mDataset.get_batch, but with tensor ops on the device
+
+        :param indices: A 1D LongTensor of indices into the dataset (on the device)
+        :return: (inps, tars, meta), normalized 2D poses, normalized 3D poses and meta data to unnormalize
+        """
+        batch_size = indices.size(0)
+        cams_per_frame = self.dataset.cams_per_frame
+        frame_numbers = indices // cams_per_frame
+        camera_numbers = indices % cams_per_frame
+
+        # Index into the resident tensors
+        poses = self.poses[frame_numbers]
+        cam_params = self.cam_params[self.frame_cam_indices[frame_numbers, camera_numbers]]
+
+        # Apply the (random) orthogonal transforms, around the hip
+        if self.dataset.orthogonal_data_augmentation_prob > 0.0:
+            augment = torch.rand(batch_size, device=self.device) < self.dataset.orthogonal_data_augmentation_prob
+            eye = torch.eye(3, device=self.device).expand(batch_size, 3, 3)
+            Qs = torch.where(augment.view(-1, 1, 1), self._rand_orthogonal_transform_matrices(batch_size), eye)
+            poses_centered, hip_positions = data_utils.zero_hip_joints_torch(poses, self.dataset.num_joints)
+            poses_centered = poses_centered.view(batch_size, -1, 3)
+            poses = torch.matmul(poses_centered, Qs.transpose(1, 2)) + hip_positions.view(batch_size, 1, 3)
+            poses = poses.view(batch_size, -1)
+
+        # Project, and transform to camera coordinates, sub sample the joints that move, and then normalize
+        poses_2d, poses_cam = data_utils.project_to_cameras_batch(poses, cam_params.unsqueeze(1))
+        poses_2d = poses_2d[:, 0][:, self.pose_2d_indx_to_use]
+        poses_cam = poses_cam[:, 0][:, self.pose_3d_indx_to_use]
+
+        inps, hip_pos_2d, scale_2d = data_utils.normalize_poses(poses_2d, self.dataset.num_joints_pred_2d,
+                                                                self.dataset.dataset_normalization, self.pose_2d_mean,
+                                                                self.pose_2d_std, is_2d=True)
+        tars, hip_pos, scale_3d = data_utils.normalize_poses(poses_cam, self.dataset.num_joints_pred_3d,
+                                                             self.dataset.dataset_normalization, self.pose_3d_mean,
+                                                             self.pose_3d_std, is_2d=False)
+
+        # Randomly drop some joints (only on the input/2D pose)
+        if self.dataset.drop_joint_prob > 0.0:
+            joint_mask = (torch.rand(batch_size, self.dataset.num_joints, 1, device=self.device) >
+                          self.dataset.drop_joint_prob).float()
+            inps = (inps.view(batch_size, self.dataset.num_joints, -1) * joint_mask).view(batch_size, -1)
+
+        # Meta data, to "unNormalize" (and the actions, for per action evaluation)
+        if self.dataset.dataset_normalization:
+            meta = {
+                '2d_mean': self.pose_2d_mean.cpu().expand(batch_size, -1),
+                '3d_mean': self.pose_3d_mean.cpu().expand(batch_size, -1),
+                '2d_std': self.pose_2d_std.cpu().expand(batch_size, -1),
+                '3d_std': self.pose_3d_std.cpu().expand(batch_size, -1),
+            }
+        else:
+            meta = {
+                '2d_hip_pos': hip_pos_2d.cpu(),
+                '3d_hip_pos': hip_pos.cpu(),
+                '2d_scale': scale_2d.cpu(),
+                '3d_scale': scale_3d.cpu(),
+            }
+        meta['action_id'] = self.action_ids[frame_numbers].cpu()
+
+        return inps, tars, meta
@@ -127,7 +127,7 @@ class LinearModel(nn.Module):
         # If instance normalized, re-introduce the zeroed hip joint
         # Also help the network out by renormalizing std dev of joint distances to 1, as we know the targets have this
         if self.instance_normalized_input:
-            new_y = torch.zeros(batch_size, self.advertised_output_size).cuda()
+            new_y = y.new_zeros(batch_size, self.advertised_output_size)
             new_y[:,3:] = y
             std = data_utils.std_distance_torch_3d(new_y)
             y = new_y / std.view(-1,1)
@@ -1,5 +1,6 @@
 
 import numpy as np
+import torch
 
 
 def get_transformation(X, Y, compute_optimal_scale=False):
@@ -49,3 +50,120 @@ def get_transformation(X, Y, compute_optimal_scale=False):
     c = muX - b * np.dot(muY, T)
 
     return d, Z, T, b, c
+
+
+
+def batch_get_transformation(X, Y, compute_optimal_scale=False):
+    """
+    Batched version of 'get_transformation', aligning each pose in Y to the corresponding pose in X at once (with a
+    batched SVD), rather than looping over the batch. Works on numpy arrays, or torch tensors (on any device).
+
+    :param X: The (B, J, 3) target poses
+    :param Y: The (B, J, 3) poses to align to X
+    :param compute_optimal_scale: If the alignment should also scale Y
+    :return: d, Z, T, b, c. As 'get_transformation', but batched: the (B,) residuals, the (B, J, 3) aligned poses Y,
+        the (B, 3, 3) rotations (applied as Y.dot(T)), the (B,) scales and the (B, 3) translations
+    """
+    if torch.is_tensor(X):
+        return _batch_get_transformation_torch(X, Y, compute_optimal_scale)
+    return _batch_get_transformation_numpy(np.asarray(X), np.asarray(Y), compute_optimal_scale)
+
+
+
+def _batch_get_transformation_numpy(X, Y, compute_optimal_scale):
+    """
+    batch_get_transformation, for numpy arrays
+    """
+    muX = X.mean(1, keepdims=True)
+    muY = Y.mean(1, keepdims=True)
+
+    X0 = X - muX
+    Y0 = Y - muY
+
+    ssX = (X0 ** 2.).sum(axis=(1, 2))
+    ssY = (Y0 ** 2.).sum(axis=(1, 2))
+
+    # centred Frobenius norm
+    normX = np.sqrt(ssX)
+    normY = np.sqrt(ssY)
+
+    # scale to equal (unit) norm
+    X0 = X0 / normX[:, None, None]
+    Y0 = Y0 / normY[:, None, None]
+
+    # optimum rotation matrix of Y
+    A = np.matmul(X0.transpose(0, 2, 1), Y0)
+    U, s, Vt = np.linalg.svd(A, full_matrices=False)
+    V = Vt.transpose(0, 2, 1)
+    T = np.matmul(V, U.transpose(0, 2, 1))
+
+    # Make sure we have a rotation (flip the last singular vector/value if T is a reflection)
+    signT = np.sign(np.linalg.det(T))
+    V[:, :, -1] *= signT[:, None]
+    s[:, -1] *= signT
+    T = np.matmul(V, U.transpose(0, 2, 1))
+
+    traceTA = s.sum(1)
+
+    if compute_optimal_scale:  # Compute optimum scaling of Y.
+        b = traceTA * normX / normY
+        d = 1 - traceTA ** 2
+        Z = (normX * traceTA)[:, None, None] * np.matmul(Y0, T) + muX
+    else:  # If no scaling allowed
+        b = np.ones_like(traceTA)
+        d = 1 + ssY / ssX - 2 * traceTA * normY / normX
+        Z = normY[:, None, None] * np.matmul(Y0, T) + muX
+
+    c = muX[:, 0] - b[:, None] * np.matmul(muY, T)[:, 0]
+
+    return d, Z, T, b, c
+
+
+
+def _batch_get_transformation_torch(X, Y, compute_optimal_scale):
+    """
+    batch_get_transformation, for torch tensors (differentiable, as the reflection is fixed without in place ops)
+    """
+    muX = X.mean(1, keepdim=True)
+    muY = Y.mean(1, keepdim=True)
+
+    X0 = X - muX
+    Y0 = Y - muY
+
+    ssX = (X0 ** 2.).sum(2).sum(1)
+    ssY = (Y0 ** 2.).sum(2).sum(1)
+
+    # centred Frobenius norm
+    normX = torch.sqrt(ssX)
+    normY = torch.sqrt(ssY)
+
+    # scale to equal (unit) norm
+    X0 = X0 / normX.view(-1, 1, 1)
+    Y0 = Y0 / normY.view(-1, 1, 1)
+
+    # optimum rotation matrix of Y
+    A = torch.matmul(X0.transpose(1, 2), Y0)
+    U, s, V = torch.svd(A)
+    T = torch.matmul(V, U.transpose(1, 2))
+
+    # Make sure we have a rotation (flip the last singular vector/value if T is a reflection)
+    signT = torch.sign(torch.det(T))
+    flip = torch.cat([torch.ones_like(s[:, :-1]), signT.unsqueeze(1)], dim=1)
+    V = V * flip.unsqueeze(1)
+    s = s * flip
+    T = torch.matmul(V, U.transpose(1, 2))
+
+    traceTA = s.sum(1)
+
+    if compute_optimal_scale:  # Compute optimum scaling of Y.
+        b = traceTA * normX / normY
+        d = 1 - traceTA ** 2
+        Z = (normX * traceTA).view(-1, 1, 1) * torch.matmul(Y0, T) + muX
+    else:  # If no scaling allowed
+        b = torch.ones_like(traceTA)
+        d = 1 + ssY / ssX - 2 * traceTA * normY / normX
+        Z = normY.view(-1, 1, 1) * torch.matmul(Y0, T) + muX
+
+    c = muX[:, 0] - b.unsqueeze(1) * torch.matmul(muY, T)[:, 0]
+
+    return d, Z, T, b, c
@@ -0,0 +1,255 @@
+from __future__ import print_function, absolute_import
+
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from utils.osutils import *
+
+
+"""
+A small content addressed cache for (slow to compute) artifacts such as dataset statistics.
+
+Each artifact is keyed by a hash of everything that it was computed from (e.g. subjects, actions, file lists and their
+mtimes, and a version number for the code computing it), so that stale values are never reused. Artifacts are written
+atomically (to a temporary file which is renamed into place) and computed under a file lock, so that concurrent
+DataLoader workers or Horovod ranks don't all recompute the same artifact. The least recently used artifacts are
+evicted when the cache grows beyond a maximum size.
+"""
+
+
+CACHE_DIR = ".cache/artifacts"
+MAX_CACHE_BYTES = 2 ** 30
+
+# Bump to invalidate every artifact (e.g. if the serialization changes)
+CACHE_VERSION = 1
+
+_MISSING = object()
+
+
+
+def file_fingerprints(filenames):
+    """
+    Fingerprints for a list of files (or directories), to be used as inputs to 'cache_key', so that an artifact is
+    invalidated when any of them change.
+
+    :param filenames: A list of filenames
+    :return: A list of (absolute filename, mtime, size) tuples. Missing files have mtime and size of None
+    """
+    fingerprints = []
+    for filename in filenames:
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            fingerprints.append((os.path.abspath(filename), stat.st_mtime, stat.st_size))
+        else:
+            fingerprints.append((os.path.abspath(filename), None, None))
+    return fingerprints
+
+
+
+def cache_key(name, inputs, version=0):
+    """
+    Computes the key for an artifact.
+
+    :param name: A human readable name for the artifact (e.g. "h36m_pose_stats"), used as a prefix of the key
+    :param inputs: Everything that the artifact depends on. Must be JSON serializable (lists, dicts, strings, numbers)
+    :param version: A version for the code computing the artifact, bump it when the computation changes
+    :return: The key for the artifact, of the form <name>-<hash of the inputs>
+    """
+    description = json.dumps([CACHE_VERSION, version, inputs], sort_keys=True, default=str)
+    return "{name}-{hash}".format(name=name, hash=hashlib.sha1(description.encode("utf-8")).hexdigest()[:20])
+
+
+
+def _artifact_filename(key, cache_dir):
+    return join(cache_dir, key + ".pkl")
+
+
+
+def load(key, default=None, cache_dir=CACHE_DIR):
+    """
+    Load an artifact from the cache, marking it as recently used.
+
+    :param key: The key of the artifact (from 'cache_key')
+    :param default: The value to return if the artifact isn't in the cache
+    :param cache_dir: The directory of the cache
+    :return: The artifact, or 'default'
+    """
+    filename = _artifact_filename(key, cache_dir)
+    if not isfile(filename):
+        return default
+    try:
+        with open(filename, "rb") as f:
+            value = pickle.load(f)
+    except (EOFError, pickle.UnpicklingError):
+        return default
+    os.utime(filename, None)
+    return value
+
+
+
+def store(key, value, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """
+    Atomically store an artifact in the cache, and then evict least recently used artifacts if the cache is too big.
+
+    :param key: The key of the artifact (from 'cache_key')
+    :param value: The (picklable) artifact
+    :param cache_dir: The directory of the cache
+    :param max_bytes: The maximum size of the cache
+    """
+    if not isdir(cache_dir):
+        mkdir_p(cache_dir)
+    fd, tmp_filename = tempfile.mkstemp(dir=cache_dir, prefix=key, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, protocol=2)
+        os.rename(tmp_filename, _artifact_filename(key, cache_dir))
+    except:
+        if isfile(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    evict(max_bytes, cache_dir=cache_dir, keep=[key])
+
+
+
+def evict(max_bytes, cache_dir=CACHE_DIR, keep=()):
+    """
+    Remove the least recently used artifacts until the cache is at most 'max_bytes' in size. Lock files are never
+    removed, as another process may be holding (or waiting on) them, and a new lock file would be a different lock.
+
+    :param max_bytes: The maximum size of the cache
+    :param cache_dir: The directory of the cache
+    :param keep: Keys of artifacts that shouldn't be evicted
+    """
+    if not isdir(cache_dir):
+        return
+    artifacts = []
+    for filename in os.listdir(cache_dir):
+        if not filename.endswith(".pkl") or filename[:-len(".pkl")] in keep:
+            continue
+        stat = os.stat(join(cache_dir, filename))
+        artifacts.append((stat.st_mtime, stat.st_size, filename))
+
+    total_bytes = sum(size for _, size, _ in artifacts)
+    total_bytes += sum(os.path.getsize(_artifact_filename(key, cache_dir)) for key in keep
+                       if isfile(_artifact_filename(key, cache_dir)))
+    for _, size, filename in sorted(artifacts):
+        if total_bytes <= max_bytes:
+            break
+        print("evicting cached artifact: " + filename)
+        os.remove(join(cache_dir, filename))
+        total_bytes -= size
+
+
+
+@contextlib.contextmanager
+def lock(key, cache_dir=CACHE_DIR, blocking=True):
+    """
+    Context manager holding an (exclusive, inter process) lock for an artifact, whilst it's being computed. (If fcntl
+    isn't available, then there is no locking).
+
+    :param key: The key of the artifact (from 'cache_key')
+    :param cache_dir: The directory of the cache
+    :param blocking: If we should wait for the lock, otherwise give up straight away if another process holds it
+    :return: (As the context) True if the lock is held, False if not blocking and another process holds it
+    """
+    if not isdir(cache_dir):
+        mkdir_p(cache_dir)
+    with open(join(cache_dir, key + ".lock"), "a") as lock_file:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                if blocking:
+                    raise
+                yield False
+                return
+        try:
+            yield True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+
+def evict_directories(max_bytes, cache_dir, keep=()):
+    """
+    Like 'evict', for artifacts that are directories (e.g. of memory mapped arrays) named by their key. The least
+    recently used (by the directory's mtime, see 'touch') are removed until 'cache_dir' is at most 'max_bytes' in size.
+    Directories whose lock is held by another process (being made or loaded), and temporary (.tmp) directories, are
+    skipped.
+
+    :param max_bytes: The maximum size of the cache
+    :param cache_dir: The directory of the cache
+    :param keep: Keys of artifacts that shouldn't be evicted
+    """
+    if not isdir(cache_dir):
+        return
+    artifacts = []
+    for key in os.listdir(cache_dir):
+        path = join(cache_dir, key)
+        if not isdir(path) or key.endswith(".tmp"):
+            continue
+        size = sum(os.path.getsize(join(root, filename)) for root, _, filenames in os.walk(path)
+                   for filename in filenames)
+        artifacts.append((os.stat(path).st_mtime, size, key))
+
+    total_bytes = sum(size for _, size, _ in artifacts)
+    for _, size, key in sorted(artifacts):
+        if total_bytes <= max_bytes:
+            break
+        if key in keep:
+            continue
+        with lock(key, cache_dir=cache_dir, blocking=False) as locked:
+            if not locked:
+                continue
+            print("evicting cached artifact: " + key)
+            shutil.rmtree(join(cache_dir, key))
+        total_bytes -= size
+
+
+
+def touch(path):
+    """
+    Mark a (directory) artifact as recently used, for 'evict_directories'
+    """
+    os.utime(path, None)
+
+
+
+def cached(name, inputs, compute_fn, version=0, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """
+    Get an artifact from the cache, or compute (and store) it if it isn't there. Only one process computes the
+    artifact at a time, any others wait for it and then load it from the cache.
+
+    :param name: A human readable name for the artifact (see 'cache_key')
+    :param inputs: Everything that the artifact depends on (see 'cache_key')
+    :param compute_fn: A function with no arguments that computes the artifact
+    :param version: A version for the code computing the artifact (see 'cache_key')
+    :param cache_dir: The directory of the cache
+    :param max_bytes: The maximum size of the cache
+    :return: The artifact
+    """
+    key = cache_key(name, inputs, version)
+    value = load(key, default=_MISSING, cache_dir=cache_dir)
+    if value is not _MISSING:
+        print("loaded {name} from cache: {key}".format(name=name, key=key))
+        return value
+
+    with lock(key, cache_dir=cache_dir):
+        # Another process may have computed the artifact whilst we were waiting for the lock
+        value = load(key, default=_MISSING, cache_dir=cache_dir)
+        if value is _MISSING:
+            value = compute_fn()
+            print("caching {name} to: {key}".format(name=name, key=key))
+            store(key, value, cache_dir=cache_dir, max_bytes=max_bytes)
+    return value
@@ -2,6 +2,7 @@ from __future__ import division
 
 import h5py
 import numpy as np
+import torch
 
 
 """
@@ -9,6 +10,10 @@ FILE ORIGINALLY PART OF THE 3D BASELINE CODE (twod_threed library)
 """
 
 
+# Number of floats needed to store one camera as a row of a packed camera parameter array (R, T, f, c, k, p)
+CAMERA_PARAM_SIZE = 9 + 3 + 2 + 2 + 3 + 2
+
+
 def project_point_radial(P, R, T, f, c, k, p):
     """
     Args
@@ -51,6 +56,100 @@ def project_point_radial(P, R, T, f, c, k, p):
     return Proj, D, radial, tan, r2
 
 
+def _array_module(x):
+    """
+    Returns the module (numpy or torch) that should be used to operate on 'x', so that the batch functions below can
+    be shared between Numpy arrays and PyTorch tensors (on any device).
+    """
+    return torch if torch.is_tensor(x) else np
+
+
+def pack_camera_params(cams):
+    """
+    Packs a list of cameras (tuples (R, T, f, c, k, p, name) as loaded by 'load_camera_params') into a single array, so
+    that they can be indexed, broadcast and moved to a device as one tensor. The name of the camera is dropped.
+
+    :param cams: A list of C camera tuples
+    :return: A Numpy array of shape (C, CAMERA_PARAM_SIZE), with rows [R.flatten(), T, f, c, k, p]
+    """
+    packed = np.zeros((len(cams), CAMERA_PARAM_SIZE))
+    for i, (R, T, f, c, k, p, _) in enumerate(cams):
+        packed[i] = np.concatenate([np.reshape(R, [-1]), np.reshape(T, [-1]), np.reshape(f, [-1]),
+                                    np.reshape(c, [-1]), np.reshape(k, [-1]), np.reshape(p, [-1])])
+    return packed
+
+
+def unpack_camera_params(params):
+    """
+    Inverse of pack_camera_params, returning views into 'params'. Works for Numpy arrays and PyTorch tensors, with any
+    number of leading (batch) dimensions.
+
+    :param params: Packed camera parameters, of shape (..., CAMERA_PARAM_SIZE)
+    :return: R, T, f, c, k, p with shapes (..., 3, 3), (..., 3), (..., 2), (..., 2), (..., 3), (..., 2)
+    """
+    R = params[..., 0:9].reshape(tuple(params.shape[:-1]) + (3, 3))
+    T = params[..., 9:12]
+    f = params[..., 12:14]
+    c = params[..., 14:16]
+    k = params[..., 16:19]
+    p = params[..., 19:21]
+    return R, T, f, c, k, p
+
+
+def world_to_camera_frame_batch(P, R, T):
+    """
+    Batch version of world_to_camera_frame. Works for Numpy arrays and PyTorch tensors, all leading dimensions are
+    broadcast against each other.
+
+    :param P: (..., N, 3) points in world coords
+    :param R: (..., 3, 3) camera rotation matrices
+    :param T: (..., 3) camera translation params
+    :return: X_cam: (..., N, 3) points in camera coords
+    """
+    xp = _array_module(P)
+    return xp.einsum('...ij,...nj->...ni', R, P - T[..., None, :])
+
+
+def project_point_radial_batch(P, R, T, f, c, k, p):
+    """
+    Batch version of project_point_radial. Works for Numpy arrays and PyTorch tensors, all leading dimensions are
+    broadcast against each other, so for example, (B, 1, N, 3) points can be projected into (B, M, ...) cameras.
+
+    Args
+    P: (..., N, 3) points in world coordinates
+    R: (..., 3, 3) Camera rotation matrices
+    T: (..., 3) Camera translation parameters
+    f: (..., 2) Camera focal lengths
+    c: (..., 2) Camera centers
+    k: (..., 3) Camera radial distortion coefficients
+    p: (..., 2) Camera tangential distortion coefficients
+    Returns
+    Proj: (..., N, 2) points in pixel space
+    D: (..., N) depth of each point in camera space
+    radial: (..., N) radial distortion per point
+    tan: (..., N) tangential distortion per point
+    r2: (..., N) squared radius of the projected points before distortion
+    """
+    xp = _array_module(P)
+
+    X = world_to_camera_frame_batch(P, R, T)  # (..., N, 3)
+    XX = X[..., :2] / X[..., 2:3]  # (..., N, 2)
+    r2 = XX[..., 0] ** 2 + XX[..., 1] ** 2  # (..., N)
+
+    radial = 1 + k[..., 0:1] * r2 + k[..., 1:2] * r2 ** 2 + k[..., 2:3] * r2 ** 3  # (..., N)
+    tan = p[..., 0:1] * XX[..., 1] + p[..., 1:2] * XX[..., 0]  # (..., N)
+
+    tm = xp.stack([p[..., 1:2] * r2, p[..., 0:1] * r2], -1)  # (..., N, 2)
+
+    XXX = XX * (radial + tan)[..., None] + tm  # (..., N, 2)
+
+    Proj = f[..., None, :] * XXX + c[..., None, :]  # (..., N, 2)
+
+    D = X[..., 2]
+
+    return Proj, D, radial, tan, r2
+
+
 def world_to_camera_frame(P, R, T):
     """
     :param P: Nx3 points in world coords
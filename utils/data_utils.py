@@ -13,6 +13,8 @@ import glob
 import copy
 import torch
 
+from twod_threed.src.procrustes import batch_get_transformation
+
 """
 FILE ORIGINALLY PART OF THE 3D BASELINE CODE (twod_threed library)
 """
@@ -67,6 +69,52 @@ SH_NAMES[13] = 'LShoulder'
 SH_NAMES[14] = 'LElbow'
 SH_NAMES[15] = 'LWrist'
 
+# The meta data stored per frame in a compiled pose store (see compile_pose_store)
+POSE_META_DTYPE = np.dtype([('subject_number', np.int32),
+                            ('action_id', np.int32),
+                            ('sequence_id', np.int32),
+                            ('frame_index', np.int32)])
+
+
+def sequence_files(bpath, subj, action, dim=3):
+    """
+    The .h5 files of the sequences for a subject and action (the files that load_data reads)
+
+    Args
+      bpath: String. Path where to load the data from
+      subj: Integer. The subject
+      action: String. The action
+      dim: Integer={2,3}. 2 or 3-dimensional data
+    Returns
+      fnames: List of filenames, sorted
+    """
+    dpath = os.path.join(bpath, 'S{0}'.format(subj), 'MyPoses/{0}D_positions'.format(dim), '{0}*.h5'.format(action))
+
+    fnames = []
+    for fname in sorted(glob.glob(dpath)):
+        seqname = os.path.basename(fname)
+
+        # This rule makes sure SittingDown is not loaded when Sitting is requested
+        if action == "Sitting" and seqname.startswith("SittingDown"):
+            continue
+
+        # This rule makes sure that WalkDog and WalkTogeter are not loaded when
+        # Walking is requested.
+        if seqname.startswith(action):
+            fnames.append(fname)
+
+    return fnames
+
+
+
+def source_files(bpath, subjects, actions, dim=3):
+    """
+    All of the .h5 files that load_data (and so compile_pose_store) reads for some subjects and actions. Fingerprint
+    these (see cache_utils.file_fingerprints) to invalidate anything computed from them when the data changes.
+    """
+    return [fname for subj in subjects for action in actions for fname in sequence_files(bpath, subj, action, dim)]
+
+
 
 def load_data(bpath, subjects, actions, dim=3):
     """
@@ -93,32 +141,18 @@ def load_data(bpath, subjects, actions, dim=3):
         for action in actions:
             print('Reading subject {0}, action {1}'.format(subj, action))
 
-            dpath = os.path.join(bpath, 'S{0}'.format(subj), 'MyPoses/{0}D_positions'.format(dim),
-                                 '{0}*.h5'.format(action))
-            print(dpath)
-
-            fnames = glob.glob(dpath)
-
-            loaded_seqs = 0
+            fnames = sequence_files(bpath, subj, action, dim)
             for fname in fnames:
+                print(fname)
                 seqname = os.path.basename(fname)
 
-                # This rule makes sure SittingDown is not loaded when Sitting is requested
-                if action == "Sitting" and seqname.startswith("SittingDown"):
-                    continue
+                with h5py.File(fname, 'r') as h5f:
+                    poses = h5f['{0}D_positions'.format(dim)][:]
 
-                # This rule makes sure that WalkDog and WalkTogeter are not loaded when
-                # Walking is requested.
-                if seqname.startswith(action):
-                    print(fname)
-                    loaded_seqs = loaded_seqs + 1
-
-                    with h5py.File(fname, 'r') as h5f:
-                        poses = h5f['{0}D_positions'.format(dim)][:]
-
-                    poses = poses.T
-                    data[(subj, action, seqname)] = poses
+                poses = poses.T
+                data[(subj, action, seqname)] = poses
 
+            loaded_seqs = len(fnames)
             if dim == 2:
                 assert loaded_seqs == 8, "Expecting 8 sequences, found {0} instead".format(loaded_seqs)
             else:
@@ -127,6 +161,92 @@ def load_data(bpath, subjects, actions, dim=3):
     return data
 
 
+def compile_pose_store(bpath, subjects, actions, store_dir, dim=3):
+    """
+    One-time "compile" of the poses for some subjects and actions into a pose store, so that they can be memory mapped
+    by 'load_pose_store' rather than re-reading every .h5 file. The store is a directory containing the following:
+      poses.npy: A contiguous float32 array of shape (total frames, 32*dim), with all of the poses (from all sequences)
+      meta.npy: A structured array (with dtype POSE_META_DTYPE) of length (total frames), the ith entry being the
+        subject number, action id (index into define_actions("All")), sequence id (index into sequences.npy) and
+        frame index (in the sequence) of the ith pose.
+      sequences.npy: An array of sequence names (e.g. 'Directions 1.h5'), indexed by sequence id.
+
+    Files are written to temporary names and renamed into place, so an interrupted compile never leaves a partial store.
+
+    Args
+      bpath: String. Path where to load the data from
+      subjects: List of integers. Subjects whose data will be loaded
+      actions: List of strings. The actions to load
+      store_dir: String. Directory to write the pose store to
+      dim: Integer={2,3}. Load 2 or 3-dimensional data
+    """
+    data = load_data(bpath, subjects, actions, dim)
+    all_actions = define_actions("All")
+
+    # Preallocate the store, and copy each sequence into it
+    total_frames = sum(len(data[key]) for key in data)
+    pose_dims = len(H36M_NAMES) * dim
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    tmp_poses_file = os.path.join(store_dir, 'poses.tmp.npy')
+    poses = np.lib.format.open_memmap(tmp_poses_file, mode='w+', dtype=np.float32, shape=(total_frames, pose_dims))
+    meta = np.zeros(total_frames, dtype=POSE_META_DTYPE)
+    sequence_names = []
+
+    offset = 0
+    for (subject, action, sequence_name) in data:
+        sequence = data[(subject, action, sequence_name)]
+        num_frames = len(sequence)
+        poses[offset:offset + num_frames] = sequence
+        meta['subject_number'][offset:offset + num_frames] = subject
+        meta['action_id'][offset:offset + num_frames] = all_actions.index(action)
+        meta['sequence_id'][offset:offset + num_frames] = len(sequence_names)
+        meta['frame_index'][offset:offset + num_frames] = np.arange(num_frames)
+        sequence_names.append(sequence_name)
+        offset += num_frames
+    poses.flush()
+    del poses
+
+    # Write the meta data, and move everything into place
+    tmp_meta_file = os.path.join(store_dir, 'meta.tmp.npy')
+    tmp_sequences_file = os.path.join(store_dir, 'sequences.tmp.npy')
+    np.save(tmp_meta_file, meta)
+    np.save(tmp_sequences_file, np.array(sequence_names))
+    os.rename(tmp_sequences_file, os.path.join(store_dir, 'sequences.npy'))
+    os.rename(tmp_meta_file, os.path.join(store_dir, 'meta.npy'))
+    os.rename(tmp_poses_file, os.path.join(store_dir, 'poses.npy'))
+
+
+
+def pose_store_exists(store_dir):
+    """
+    Check if a (complete) pose store, as written by 'compile_pose_store', exists in 'store_dir'
+    """
+    return all(os.path.isfile(os.path.join(store_dir, filename))
+               for filename in ['poses.npy', 'meta.npy', 'sequences.npy'])
+
+
+
+def load_pose_store(store_dir):
+    """
+    Memory maps a pose store written by 'compile_pose_store'. Nothing is read from disk until it's indexed, and the
+    pages are shared between processes (e.g. DataLoader workers), rather than each process having it's own copy.
+
+    Args
+      store_dir: String. The directory containing the pose store
+    Returns
+      poses: read only, memory mapped float32 array of shape (total frames, 32*dim)
+      meta: read only, memory mapped structured array (dtype POSE_META_DTYPE) of length (total frames)
+      sequence_names: list of sequence names, indexed by meta['sequence_id']
+    """
+    poses = np.load(os.path.join(store_dir, 'poses.npy'), mmap_mode='r')
+    meta = np.load(os.path.join(store_dir, 'meta.npy'), mmap_mode='r')
+    sequence_names = [str(name) for name in np.load(os.path.join(store_dir, 'sequences.npy'))]
+    return poses, meta, sequence_names
+
+
+
 def load_stacked_hourglass(data_dir, subjects, actions):
     """
     Load 2d detections from disk, and put it in an easy-to-acess dictionary.
@@ -249,25 +369,20 @@ def dimensions_to_use(is_2d):
 
 def transform_world_to_camera(poses_3d, cams):
     """
-    Project 3d poses from world coordinate to camera coordinate system
+    Project 3d poses from world coordinate to camera coordinate system. Thin wrapper around
+    'project_to_cameras_batch', which does all of the work in a few vectorized operations.
+
     Args
-      poses_3d: list with 3d poses
-      cams: list of lists with cameras (cams[i] is the list of camers for poses_3d[i])
+      poses_3d: list (or array) with 3d poses
+      cams: list of lists with cameras (cams[i] is the list of camers for poses_3d[i]), each list must be the same length
     Return:
-      camera_poses_set: list with 3d poses in camera coordinate (of length equal to flattened cams array)
+      camera_poses_set: array of 3d poses in camera coordinate (of length equal to flattened cams array)
     """
-    poses_cam_coords = []
-    for i in range(len(poses_3d)):
-        if (i+2) % 1000 == 0:
-            print(str(i) + "/" + str(len(poses_3d)))
-        pose_world_coords = poses_3d[i]
-        for j in range(len(cams[i])):
-            R, T, f, c, k, p, name = cams[i][j]
-            pose_cam_coords = cameras.world_to_camera_frame(np.reshape(pose_world_coords, [-1, 3]), R, T)
-            pose_cam_coords = np.reshape(pose_cam_coords, [-1])
-            pose_cam_coords = np.reshape(pose_cam_coords, [-1])
-            poses_cam_coords.append(pose_cam_coords)
-    return poses_cam_coords
+    if len(poses_3d) == 0:
+        return []
+    cam_params, cam_indices = _pack_camera_lists(cams)
+    _, poses_cam_coords = project_to_cameras_batch(np.asarray(poses_3d), cam_params, cam_indices)
+    return np.reshape(poses_cam_coords, (-1, poses_cam_coords.shape[-1]))
 
 
 def normalize_data(data, data_mean, data_std):
@@ -334,27 +449,93 @@ def define_actions(action):
 
 def project_to_cameras(poses_3d, cams):
     """
-    Project 3d poses using camera parameters
+    Project 3d poses using camera parameters. Thin wrapper around 'project_to_cameras_batch', which does all of the
+    work in a few vectorized operations.
 
     Args
       poses_3d: array of poses, shape of (num_poses, 3*num_joints)
-      cams: list of lists with cameras (cams[i] is the list of camers for poses_3d[i])
+      cams: list of lists with cameras (cams[i] is the list of camers for poses_3d[i]), each list must be the same length
     Returns
-      t2d: dictionary with 2d poses (If cams has "shape" (m), then this returns a list of length (num_poses*m) 2d poses)
+      t2d: array of 2d poses (If cams has "shape" (m), then this returns an array of length (num_poses*m) 2d poses)
     """
-    poses_2d = []
+    if len(poses_3d) == 0:
+        return []
+    cam_params, cam_indices = _pack_camera_lists(cams)
+    poses_2d, _ = project_to_cameras_batch(np.asarray(poses_3d), cam_params, cam_indices)
+    return np.reshape(poses_2d, (-1, poses_2d.shape[-1]))
+
 
-    for i in range(len(poses_3d)):
-        if (i+2) % 1000 == 0:
-            print(str(i) + "/" + str(len(poses_3d)))
-        pose_3d = poses_3d[i]
+
+def _pack_camera_lists(cams):
+    """
+    Converts a list of lists of cameras (as used by 'project_to_cameras') into a table of packed camera parameters and
+    an array of indices into that table. Cameras are de-duplicated by identity, as the same camera tuple is typically
+    shared by every pose of a subject.
+
+    :param cams: list of lists with cameras (cams[i] is the list of cameras for the ith pose)
+    :return: cam_params, cam_indices
+        cam_params = Numpy array of shape (C, camera_utils.CAMERA_PARAM_SIZE) of packed (unique) cameras
+        cam_indices = Numpy int array of shape (num_poses, m), indices into cam_params
+    """
+    table = []
+    table_indices = {}
+    cam_indices = np.zeros((len(cams), len(cams[0])), dtype=np.int64)
+    for i in range(len(cams)):
         for j in range(len(cams[i])):
-            R, T, f, c, k, p, name = cams[i][j]
-            pose_2d, _, _, _, _ = cameras.project_point_radial(np.reshape(pose_3d, [-1, 3]), R, T, f, c, k, p)
-            pose_2d = np.reshape(pose_2d, [-1])
-            poses_2d.append(pose_2d)
+            key = id(cams[i][j])
+            if key not in table_indices:
+                table_indices[key] = len(table)
+                table.append(cams[i][j])
+            cam_indices[i, j] = table_indices[key]
+    return cameras.pack_camera_params(table), cam_indices
+
+
+
+def project_to_cameras_batch(poses_3d, cam_params, cam_indices=None, chunk_size=65536):
+    """
+    Project a batch of 3d poses (in world coordinates) into a set of cameras per pose, computing both the 2d
+    projections and the 3d poses in camera coordinates. Works on Numpy arrays or PyTorch tensors (on any device).
+
+    Poses are processed in chunks of 'chunk_size', to bound the size of intermediate arrays when projecting the entire
+    dataset at once.
+
+    :param poses_3d: Poses in world coordinates, of shape (N, J*3) or (N, J, 3)
+    :param cam_params: Packed camera parameters (see camera_utils.pack_camera_params). If 'cam_indices' is None, then
+        this should have shape (N, M, CAMERA_PARAM_SIZE) (M cameras per pose), or (M, CAMERA_PARAM_SIZE) to use the
+        same M cameras for every pose. Otherwise it is a table of cameras, of shape (C, CAMERA_PARAM_SIZE).
+    :param cam_indices: Optional integer array of shape (N, M), indexing into the camera table 'cam_params'
+    :param chunk_size: The number of poses to process at once
+    :return: poses_2d, poses_cam
+        poses_2d = projected poses, of shape (N, M, J*2)
+        poses_cam = poses in camera coordinates, of shape (N, M, J*3)
+    """
+    xp = cameras._array_module(poses_3d)
+    num_poses = poses_3d.shape[0]
+    poses_3d = poses_3d.reshape((num_poses, -1, 3))
+
+    poses_2d = []
+    poses_cam = []
+    for beg in range(0, num_poses, chunk_size):
+        end = min(beg + chunk_size, num_poses)
+        if cam_indices is not None:
+            params = cam_params[cam_indices[beg:end]]
+        elif cam_params.ndim == 3:
+            params = cam_params[beg:end]
+        else:
+            params = cam_params[None]
+
+        # Broadcast the (n, 1, J, 3) poses against (n, M) cameras
+        R, T, f, c, k, p = cameras.unpack_camera_params(params)
+        P = poses_3d[beg:end, None]
+        proj, _, _, _, _ = cameras.project_point_radial_batch(P, R, T, f, c, k, p)
+        cam_coords = cameras.world_to_camera_frame_batch(P, R, T)
 
-    return poses_2d
+        poses_2d.append(proj.reshape(proj.shape[:2] + (-1,)))
+        poses_cam.append(cam_coords.reshape(cam_coords.shape[:2] + (-1,)))
+
+    if xp is torch:
+        return torch.cat(poses_2d), torch.cat(poses_cam)
+    return np.concatenate(poses_2d), np.concatenate(poses_cam)
 
 
 def read_2d_predictions(actions, data_dir):
@@ -507,7 +688,7 @@ def zero_hip_joints(poses, num_joints):
 
     # Subtract + remember the root positions
     root_potisions = poses[:, 0]
-    poses = poses - root_potisions
+    poses = poses - root_potisions[:, None]
 
     # reshape and return
     return np.reshape(poses, (batch_size, -1)), root_potisions
@@ -529,7 +710,7 @@ def zero_hip_joints_torch(poses, num_joints):
     poses = poses.view(batch_size, num_joints, -1)
 
     root_positions = poses[:, 0]
-    poses = poses - root_positions
+    poses = poses - root_positions[:, None]
 
     return poses.view(batch_size, -1), root_positions
 
@@ -553,6 +734,21 @@ def std_distance(pose, num_joints):
 
 
 
+def std_distances(poses, num_joints):
+    """
+    Batch version of "std_distance" (in numpy)
+
+    :param poses: A Numpy tensor of shape (n, k*d), representing a batch of n poses with k joints.
+    :param num_joints: The number of joints in the poses
+    :return: A Numpy tensor of shape (n,) representing the std dev of each poses joint distances
+    """
+    batch_size = poses.shape[0]
+    poses = np.reshape(poses, (batch_size, num_joints, -1))
+    norms = np.sqrt(np.sum(poses ** 2, axis=2))
+    return np.std(norms, axis=1)
+
+
+
 def std_distance_torch(poses, num_joints):
     """
     Same as "std_distance", but implemented in torch, and for a batch
@@ -560,7 +756,7 @@ def std_distance_torch(poses, num_joints):
     batch_size = poses.size(0)
     poses = poses.view(batch_size, num_joints, -1)
     norms = torch.sqrt(torch.sum(poses ** 2, 2))
-    return torch.std(norms, 1)
+    return torch.std(norms, 1, unbiased=False)
 
 
 
@@ -632,6 +828,29 @@ def rotation_matrices(normals, angles):
     return cos * eye + sin * normals_cross + (1.0-cos) * normals_outer
 
 
+def rotation_matrices_torch(normals, angles):
+    """
+    Torch version of rotation_matrices.
+
+    :param normals: A PyTorch tensor of shape (n,3) of normals for the rotation matrices
+    :param angles: A PyTorch tensor of shape (n,) of angles in the range [0,2pi) for the angles to rotate
+    :return: A PyTorch tensor of shape (n,3,3) of rotation matrices
+    """
+    # Compute the component parts
+    batch_size = normals.size(0)
+    eye = torch.eye(3, dtype=normals.dtype, device=normals.device).expand(batch_size, 3, 3)
+    zeros = torch.zeros_like(normals[:, 0])
+    normals_cross = torch.stack([zeros, -normals[:, 2], normals[:, 1],
+                                 normals[:, 2], zeros, -normals[:, 0],
+                                 -normals[:, 1], normals[:, 0], zeros], 1).view(batch_size, 3, 3)
+    normals_outer = normals.view(batch_size, 3, 1) * normals.view(batch_size, 1, 3)
+    sin = torch.sin(angles).view(batch_size, 1, 1)
+    cos = torch.cos(angles).view(batch_size, 1, 1)
+
+    # Compute the matrices
+    return cos * eye + sin * normals_cross + (1.0-cos) * normals_outer
+
+
 def reflection_matrices(normals):
     """
     Compute matrices that reflect points about plane with normals 'normals'. Point a, can be reflected about the
@@ -714,18 +933,37 @@ def normalize_single_pose(pose_camera_coords, num_joints, dataset_normalization,
 
 
 
+def normalize_poses_numpy(poses, num_joints, dataset_normalization, pose_mean=None, pose_std=None, is_2d=False):
+    """
+    Batch version of normalize_single_pose, implemented in numpy (and computing exactly the same thing)
+
+    :param poses: A Numpy tensor of shape (n, k*d)
+    :return: (normalized_poses, hip_root_positions, joint_dist_stds), of shapes (n, k*d), (n, d) and (n,). The last two
+        are None if using dataset normalization
+    """
+    if not dataset_normalization:
+        poses_zeroed_hip, hip_root_positions = zero_hip_joints(poses, num_joints)
+        joint_dist_stds = std_distances(poses_zeroed_hip, num_joints)
+        return poses_zeroed_hip / joint_dist_stds[:, None], hip_root_positions, joint_dist_stds
+    else:
+        if not is_2d:
+            poses, _ = zero_hip_joints(poses, num_joints)
+        return normalize(poses, pose_mean, pose_std), None, None
+
+
+
 def normalize_poses(poses, num_joints, dataset_normalization, pose_mean=None, pose_std=None, is_2d=False):
     """
     Batch version of normalize_single_pose, implemented in torch
     """
     if not dataset_normalization:
-        poses_zeroed_hip, hip_root_positions = zero_hip_joints(poses, num_joints)
+        poses_zeroed_hip, hip_root_positions = zero_hip_joints_torch(poses, num_joints)
         joint_dist_stds = std_distance_torch(poses_zeroed_hip, num_joints)
         return poses_zeroed_hip / joint_dist_stds.view(-1,1), hip_root_positions, joint_dist_stds
 
     else:
         if not is_2d:
-            poses, _ = zero_hip_joints_torch(poses)
+            poses, _ = zero_hip_joints_torch(poses, num_joints)
         return (poses - pose_mean) / pose_std, None, None
 
 
@@ -734,30 +972,36 @@ def compute_3d_pose_error_distances(outputs, tars, meta, dataset_normalization=F
     Given PyTorch variables, outputs and tars, the outputs and targets for the 3D baseline network respectively.
     Compute the distances between all of them, in the unormalized space
 
+    With procrustes, every output is aligned to its target (with a rotation, translation and scale) before the
+    distances are computed, for the whole batch at once (see batch_get_transformation).
+
     :param outputs: Output variable from the network
     :param tars: Target variable for the network
     :param meta: Meta data, containing the statistics information required to "unnormalize"
     :param dataset_normalization: If we are using istance or dataset statistics to normalize
     :param procrustes: If we allow for a procrustes transform in the error analysis
-    :return: A PyTorch tensor of shape (batch_size, num_joints) of distances between the outputs and targets
+    :return: A numpy array of shape (batch_size, num_joints) of distances between the outputs and targets
     """
-    # calculate erruracy
-    targets_unnorm = data_utils.unNormalizeData(tars.data.cpu().numpy(), meta, dataset_normalization)
-    outputs_unnorm = data_utils.unNormalizeData(outputs.data.cpu().numpy(), meta, dataset_normalization)
+    # calculate erruracy (meta usually contains PyTorch tensors, so unnormalize with numpy copies of the statistics)
+    stats = {key: _as_numpy(meta[key]) for key in ['3d_mean', '3d_std', '3d_scale', '3d_hip_pos'] if key in meta}
+    targets_unnorm = unNormalizeData(_as_numpy(tars.data.cpu()), stats, dataset_normalization)
+    outputs_unnorm = unNormalizeData(_as_numpy(outputs.data.cpu()), stats, dataset_normalization)
 
-    # Meta contains PyTorch tensors, so targets_unnorm and outputs_unnorm are PyTorch tensors
-    targets_use = targets_unnorm.numpy()
-    outputs_use = outputs_unnorm.numpy()
+    batch_size = targets_unnorm.shape[0]
+    targets_use = np.reshape(targets_unnorm, (batch_size, -1, 3))
+    outputs_use = np.reshape(outputs_unnorm, (batch_size, -1, 3))
 
     if procrustes:
-        for ba in range(inps.size(0)):
-            gt = targets_use[ba].reshape(-1, 3)
-            out = outputs_use[ba].reshape(-1, 3)
-            _, Z, T, b, c = get_transformation(gt, out, True)
-            out = (b * out.dot(T)) + c
-            outputs_use[ba, :] = out.reshape(1, 51)
+        _, outputs_use, _, _, _ = batch_get_transformation(targets_use, outputs_use, True)
 
     sqerr = (outputs_use - targets_use) ** 2
-    sqerr = np.reshape(sqerr, (sqerr.shape[0], 17, 3))
     distance = np.sqrt(np.sum(sqerr, axis=2))
-    return distance
\ No newline at end of file
+    return distance
+
+
+
+def _as_numpy(x):
+    """
+    A numpy array of 'x', a numpy array or a PyTorch tensor
+    """
+    return x.detach().cpu().numpy() if torch.is_tensor(x) else np.asarray(x)
@@ -0,0 +1,52 @@
+from __future__ import absolute_import
+
+import torch
+
+
+"""
+The (single) place that decides which device models and tensors live on. Scripts call 'get_device(options)' once, and
+move their models there with '.to(device)'. Everything else (models, losses, helpers) allocates on the device of its
+inputs, so the same code runs on the cpu or gpu.
+"""
+
+
+
+def get_device(args=None):
+    """
+    The device to run on, given by the '--device' option ("cpu", "cuda" or "cuda:<n>"). If it isn't specified, then
+    cuda is used if it's available, and the cpu otherwise. On the cpu, '--num_threads' (if set) limits the number of
+    threads torch uses, so that several inference replicas can share a node.
+
+    :param args: The options passed in by command line (or None to use the default)
+    :return: A torch.device
+    """
+    name = getattr(args, 'device', None)
+    if name is None:
+        name = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(name)
+
+    num_threads = getattr(args, 'num_threads', None)
+    if device.type == "cpu" and num_threads is not None and num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+    return device
+
+
+
+def module_device(module):
+    """
+    The device that the parameters of an nn.Module are on (the device to put its inputs on)
+    """
+    return next(module.parameters()).device
+
+
+
+def load_checkpoint(filename):
+    """
+    torch.load, but with every tensor loaded onto the cpu, so that checkpoints saved from a gpu can be loaded on a
+    machine without one. (load_state_dict copies the weights onto the device of the model anyway.)
+
+    :param filename: The checkpoint file
+    :return: The loaded checkpoint
+    """
+    return torch.load(filename, map_location=lambda storage, loc: storage)
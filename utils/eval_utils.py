@@ -6,32 +6,252 @@ from utils import data_utils
 
 
 
+class PoseErrorAccumulator(object):
+    """
+    Streams the 3D pose errors of batches of predictions, keeping only running sums (so constant memory, however big
+    the test set): per action and per joint sums of the joint errors (MPJPE), and of the joint errors after procrustes
+    alignment (PA-MPJPE), and per action histograms of the per pose errors (for percentiles).
+
+    Batches are assigned to actions with the 'action_id' in their meta data (an index into
+    data_utils.define_actions("All")); poses without one are counted under "Unknown".
+
+    With multiple workers, or ranks, each can accumulate its own part of the test set, and then 'merge' them (or
+    'reduce' them with an all-reduce) before computing the results.
+    """
+    def __init__(self, num_joints=17, action_names=None, procrustes=True, max_error=2000.0, bin_width=1.0,
+                 percentiles=(50, 90, 99)):
+        """
+        :param num_joints: The number of joints in each pose
+        :param action_names: The names of the actions that the 'action_id's index (defaults to all of Human3.6m's)
+        :param procrustes: If PA-MPJPE should also be computed
+        :param max_error: The largest (per pose) error that the histograms resolve (larger errors share the last bin)
+        :param bin_width: The width of the histogram bins (the resolution of the percentiles)
+        :param percentiles: The percentiles of the per pose errors to report
+        """
+        if action_names is None:
+            action_names = data_utils.define_actions("All")
+        self.action_names = list(action_names) + ["Unknown"]
+        self.num_joints = num_joints
+        self.procrustes = procrustes
+        self.bin_width = bin_width
+        self.percentiles = percentiles
+
+        num_actions = len(self.action_names)
+        num_bins = int(np.ceil(max_error / bin_width)) + 1
+        self.counts = np.zeros(num_actions, dtype=np.int64)
+        self.sums = np.zeros((num_actions, num_joints), dtype=np.float64)
+        self.hist = np.zeros((num_actions, num_bins), dtype=np.int64)
+        self.pa_sums = np.zeros((num_actions, num_joints), dtype=np.float64)
+        self.pa_hist = np.zeros((num_actions, num_bins), dtype=np.int64)
+
+
+
+    def add_batch(self, outputs, targets, meta, dataset_normalization=False):
+        """
+        Add the errors of a batch of predictions.
+
+        :param outputs: The (normalized) 3D pose predictions, (batch_size, num_joints*3)
+        :param targets: The (normalized) 3D pose ground truths, (batch_size, num_joints*3)
+        :param meta: The (collated) meta data of the batch, to unnormalize with (and with the 'action_id's)
+        :param dataset_normalization: If the poses use dataset (rather than instance) normalization
+        :return: The (batch_size, num_joints) joint errors of the batch
+        """
+        dists = data_utils.compute_3d_pose_error_distances(outputs, targets, meta, dataset_normalization)
+        pa_dists = None
+        if self.procrustes:
+            pa_dists = data_utils.compute_3d_pose_error_distances(outputs, targets, meta, dataset_normalization,
+                                                                  procrustes=True)
+        self.add_distances(dists, self._action_ids(meta, dists.shape[0]), pa_dists)
+        return dists
+
+
+
+    def add_distances(self, dists, action_ids, pa_dists=None):
+        """
+        Add (precomputed) joint errors.
+
+        :param dists: The (batch_size, num_joints) joint errors
+        :param action_ids: The (batch_size,) action ids of each pose
+        :param pa_dists: The (batch_size, num_joints) joint errors after procrustes alignment (if computing PA-MPJPE)
+        """
+        np.add.at(self.counts, action_ids, 1)
+        np.add.at(self.sums, action_ids, dists)
+        np.add.at(self.hist, (action_ids, self._bins(dists.mean(1))), 1)
+        if pa_dists is not None:
+            np.add.at(self.pa_sums, action_ids, pa_dists)
+            np.add.at(self.pa_hist, (action_ids, self._bins(pa_dists.mean(1))), 1)
+
+
+
+    def merge(self, other):
+        """
+        Add the sums of another accumulator (e.g. from another worker) into this one
+        """
+        for mine, theirs in zip(self._state(), other._state()):
+            mine += theirs
+
+
+
+    def reduce(self, sum_fn):
+        """
+        Sum the running sums across processes, e.g. with an all-reduce, so that every rank has the results for the
+        whole test set.
+
+        :param sum_fn: A function taking a numpy array, and returning the sum of that array over every process
+        """
+        for state in self._state():
+            state[...] = np.asarray(sum_fn(state)).reshape(state.shape)
+
+
+
+    def results(self):
+        """
+        :return: A dictionary of the results. 'actions' (the names of the actions that have any poses), and for both
+            'mpjpe' and 'pa_mpjpe' (if using procrustes):
+                '<metric>': The mean joint error over every pose
+                '<metric>_per_action': A dictionary of the mean joint error of each action
+                '<metric>_per_joint': The (num_joints,) mean error of each joint
+                '<metric>_grid': The (num actions, num_joints) mean error of each joint, for each action
+                '<metric>_percentiles': A dictionary of percentiles of the (per pose) errors
+        """
+        present = self.counts > 0
+        results = {'actions': [name for name, count in zip(self.action_names, self.counts) if count > 0],
+                   'count': int(self.counts.sum())}
+        metrics = [('mpjpe', self.sums, self.hist)]
+        if self.procrustes:
+            metrics.append(('pa_mpjpe', self.pa_sums, self.pa_hist))
+
+        total = max(self.counts.sum(), 1)
+        for metric, sums, hist in metrics:
+            grid = sums[present] / self.counts[present, None]
+            results[metric] = sums.sum() / (total * self.num_joints)
+            results[metric + '_per_action'] = dict(zip(results['actions'], grid.mean(1)))
+            results[metric + '_per_joint'] = sums.sum(0) / total
+            results[metric + '_grid'] = grid
+            results[metric + '_percentiles'] = dict((p, self._percentile(hist.sum(0), p)) for p in self.percentiles)
+            results[metric + '_percentiles_per_action'] = dict(
+                (name, dict((p, self._percentile(hist[i], p)) for p in self.percentiles))
+                for i, name in enumerate(self.action_names) if self.counts[i] > 0)
+        return results
+
+
+
+    def summary(self):
+        """
+        :return: A printable table of the results, with a row per action, and a grid of the per joint errors
+        """
+        results = self.results()
+        metrics = ['mpjpe', 'pa_mpjpe'] if self.procrustes else ['mpjpe']
+
+        # Per action table
+        header = "{a:>14s} {n:>8s}".format(a="action", n="poses")
+        for metric in metrics:
+            header += " {m:>9s}".format(m=metric.upper().replace("_", "-"))
+            header += "".join(" {p:>7s}".format(p="p{p}".format(p=p)) for p in self.percentiles)
+        lines = [header]
+        for i, name in enumerate(results['actions'] + ["All"]):
+            row = "{a:>14s} {n:8d}".format(a=name, n=results['count'] if name == "All" else
+                                            int(self.counts[self.action_names.index(name)]))
+            for metric in metrics:
+                mean = results[metric] if name == "All" else results[metric + '_per_action'][name]
+                percentiles = results[metric + '_percentiles'] if name == "All" else \
+                    results[metric + '_percentiles_per_action'][name]
+                row += " {m:9.2f}".format(m=mean)
+                row += "".join(" {p:7.1f}".format(p=percentiles[p]) for p in self.percentiles)
+            lines.append(row)
+
+        # Per joint grid (for each metric)
+        for metric in metrics:
+            lines.append("")
+            lines.append("{m} per joint:".format(m=metric.upper().replace("_", "-")))
+            lines.append("{a:>14s}".format(a="action") + "".join(" {j:>6s}".format(j="j{j}".format(j=j))
+                                                                   for j in range(self.num_joints)))
+            rows = list(zip(results['actions'], results[metric + '_grid']))
+            rows.append(("All", results[metric + '_per_joint']))
+            for name, errs in rows:
+                lines.append("{a:>14s}".format(a=name) + "".join(" {e:6.1f}".format(e=e) for e in errs))
+        return "\n".join(lines)
+
+
+
+    def _state(self):
+        return [self.counts, self.sums, self.hist, self.pa_sums, self.pa_hist]
+
+
+
+    def _action_ids(self, meta, batch_size):
+        """
+        The action ids of a batch, from its meta data (or the "Unknown" action if it doesn't have them)
+        """
+        unknown = len(self.action_names) - 1
+        if 'action_id' not in meta:
+            return np.full(batch_size, unknown, dtype=np.int64)
+        action_ids = meta['action_id']
+        action_ids = np.asarray(action_ids.cpu().numpy() if torch.is_tensor(action_ids) else action_ids, dtype=np.int64)
+        return np.where((action_ids >= 0) & (action_ids < unknown), action_ids, unknown)
+
+
+
+    def _bins(self, errs):
+        """
+        The histogram bin of each of the (per pose) errors 'errs'
+        """
+        return np.clip((errs / self.bin_width).astype(np.int64), 0, self.hist.shape[1] - 1)
+
+
+
+    def _percentile(self, hist, p):
+        """
+        The p'th percentile of the errors in the histogram 'hist' (interpolated within a bin)
+        """
+        total = hist.sum()
+        if total == 0:
+            return 0.0
+        cumulative = np.cumsum(hist)
+        target = total * p / 100.0
+        i = int(np.searchsorted(cumulative, target))
+        i = min(i, len(hist) - 1)
+        before = cumulative[i - 1] if i > 0 else 0
+        fraction = (target - before) / max(hist[i], 1)
+        return (i + fraction) * self.bin_width
+
+
+
+
 def print_avg_joint_err(options):
     """
     Given 3D ground truth predictions and 3D predictions, in dictionaries where the keys correspond,
-    compute the average joint error.
+    compute the average joint error, per joint and per action (and with procrustes alignment).
 
     Options:
     options.threed_pose_ground_truths: a PyTorch file containing 3D pose ground truths.
     options.threed_pose_estimations: a PyTorch file containing 3D pose estimations.
     options.metas: a PyTorch file containing all of the meta data for each example
 
+    The metas are saved (by stitched/run.py) as the collated meta data of the batch that each example was in, so the
+    errors are computed a batch at a time, in the order of the batch's 'img_filename's.
+
     :param options:
-    :return:
     """
-    # TODO: compute this PER JOINT and PER ACTION. And compute a nice lil grid...
     # Load values
     preds = torch.load(options.threed_pose_estimations)
     gts = torch.load(options.threed_pose_ground_truths)
     metas = torch.load(options.metas)
     dataset_normalization = options.dataset_normalization
 
-    # For each prediction, add an error
-    errs = []
-    for filename in pred:
-        errs.append(data_utils.compute_3d_pose_error_distances(preds[filename], gts[filename], meta[filename],
-                                                               dataset_normalization=dataset_normalization,
-                                                               procrustes=False))
+    # Stream each batch of predictions into the accumulator (filenames in the same batch share the same meta object)
+    accumulator = PoseErrorAccumulator()
+    seen = set()
+    for filename in preds:
+        meta = metas[filename]
+        if id(meta) in seen:
+            continue
+        seen.add(id(meta))
+        filenames = list(meta['img_filename'])
+        outputs = torch.stack([torch.as_tensor(preds[f]) for f in filenames]).float()
+        targets = torch.stack([torch.as_tensor(gts[f]) for f in filenames]).float()
+        accumulator.add_batch(outputs, targets, meta, dataset_normalization=dataset_normalization)
 
-    # Print the mean value
-    print("Mean joint error of these predictions is: {avg_err}".format(avg_err=np.mean(errs)))
\ No newline at end of file
+    # Print the results
+    print("Mean joint error of these predictions is: {avg_err}".format(avg_err=accumulator.results()['mpjpe']))
+    print(accumulator.summary())
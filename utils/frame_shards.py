@@ -0,0 +1,205 @@
+from __future__ import print_function, absolute_import
+
+import glob
+import os
+
+import numpy as np
+
+from utils.osutils import *
+
+
+"""
+A sharded binary format for (pre-decoded, pre-cropped) video frames, so that a frame can be read with a single slice of
+a memory mapped file, rather than decoding a JPEG and resizing it per sample.
+
+A shard directory contains any number of "shard groups". A group named <name> consists of:
+  <name>.<k>.bin: Raw uint8 RGB frames of shape (height, width, 3), back to back, at most 'frames_per_shard' per file.
+      Frames are usually pre-cropped to (FRAME_RES, FRAME_RES), but can be stored at their original size
+  <name>.index.npy: A structured array (dtype FRAME_INDEX_DTYPE), with one entry per frame, holding the frames key
+      (subject, action, camera, frame), the shard file and offset (in frames) it's stored at, and the center and scale
+      used to crop it from the original image (see 'img_crop_params')
+
+The index of a group is only written (atomically) once the group is complete, so incomplete groups are never read.
+"""
+
+
+FRAME_RES = 256
+FRAMES_PER_SHARD = 4096
+
+FRAME_INDEX_DTYPE = np.dtype([('subject', np.int32),
+                              ('action', 'S64'),
+                              ('camera', 'S32'),
+                              ('frame', np.int32),
+                              ('shard', 'S128'),
+                              ('offset', np.int64),
+                              ('height', np.int32),
+                              ('width', np.int32),
+                              ('center', np.float32, (2,)),
+                              ('scale', np.float32)])
+
+
+
+def img_crop_params(height, width):
+    """
+    The center and scale to crop a (whole) Human3.6m frame with (see stacked_hourglass transforms.crop_numpy, where the
+    cropped box has side length scale * 200 pixels).
+
+    :param height: The height of the image
+    :param width: The width of the image
+    :return: center, scale. Center is (x, y)
+    """
+    center = np.array([width // 2, height // 2], dtype=np.float32)
+    scale = max(height, width) / 200.0
+    return center, scale
+
+
+
+class FrameShardWriter(object):
+    """
+    Writes a shard group (see above) to 'shard_dir'. Frames are appended to the current shard file as they're added,
+    so memory use is constant.
+    """
+    def __init__(self, shard_dir, name, res=FRAME_RES, frames_per_shard=FRAMES_PER_SHARD):
+        """
+        :param shard_dir: The shard directory
+        :param name: The name of the shard group (must be unique in the shard directory)
+        :param res: The resolution of the (square) frames, or a (height, width) tuple, or None to use the shape of the
+            first frame added
+        :param frames_per_shard: The maximum number of frames in a single shard file
+        """
+        self.shard_dir = shard_dir
+        self.name = name
+        self.frame_shape = (res, res) if isinstance(res, int) else res
+        self.frames_per_shard = frames_per_shard
+        self._index = []
+        self._shard_file = None
+        self._shard_filename = None
+        self._shard_count = 0
+        self._frames_in_shard = 0
+
+        if not isdir(shard_dir):
+            mkdir_p(shard_dir)
+
+
+
+    def _next_shard(self):
+        if self._shard_file is not None:
+            self._shard_file.close()
+        self._shard_filename = "{name}.{k}.bin".format(name=self.name, k=self._shard_count)
+        self._shard_file = open(join(self.shard_dir, self._shard_filename), "wb")
+        self._shard_count += 1
+        self._frames_in_shard = 0
+
+
+
+    def add(self, subject, action, camera, frame, img, center, scale):
+        """
+        Append a (cropped) frame.
+
+        :param subject: The subject number
+        :param action: The action (sequence) name, e.g. 'Directions 1'
+        :param camera: The camera name
+        :param frame: The frame number
+        :param img: A uint8 (RGB) Numpy array of shape (height, width, 3)
+        :param center: The center used to crop the frame (or to use to crop it, if it's stored at its original size)
+        :param scale: The scale used to crop the frame (or to use to crop it)
+        """
+        if self.frame_shape is None:
+            self.frame_shape = tuple(img.shape[:2])
+        if img.shape != tuple(self.frame_shape) + (3,):
+            raise ValueError("Expected a frame of shape {s}, got {t}".format(s=tuple(self.frame_shape) + (3,),
+                                                                             t=img.shape))
+        if self._shard_file is None or self._frames_in_shard == self.frames_per_shard:
+            self._next_shard()
+
+        self._shard_file.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+        self._index.append((subject, action, camera, frame, self._shard_filename, self._frames_in_shard,
+                            self.frame_shape[0], self.frame_shape[1], center, scale))
+        self._frames_in_shard += 1
+
+
+
+    def close(self):
+        """
+        Finish the shard group, writing its index.
+        """
+        if self._shard_file is not None:
+            self._shard_file.close()
+            self._shard_file = None
+
+        index = np.array(self._index, dtype=FRAME_INDEX_DTYPE)
+        tmp_index_filename = join(self.shard_dir, "{name}.index.tmp.npy".format(name=self.name))
+        np.save(tmp_index_filename, index)
+        os.rename(tmp_index_filename, join(self.shard_dir, "{name}.index.npy".format(name=self.name)))
+
+
+
+def shard_group_complete(shard_dir, name):
+    """
+    Check if a shard group has been completely written
+    """
+    return isfile(join(shard_dir, "{name}.index.npy".format(name=name)))
+
+
+
+class FrameShardReader(object):
+    """
+    Reads frames from a shard directory (see above). Shard files are memory mapped lazily (and re-mapped after
+    unpickling, so that DataLoader workers share pages).
+    """
+    def __init__(self, shard_dir):
+        """
+        :param shard_dir: The shard directory
+        """
+        self.shard_dir = shard_dir
+
+        index_filenames = sorted(glob.glob(join(shard_dir, "*.index.npy")))
+        if len(index_filenames) == 0:
+            raise Exception("No (complete) frame shards found in: " + shard_dir)
+        self.index = np.concatenate([np.load(filename) for filename in index_filenames])
+        self._lookup = {(int(entry['subject']), entry['action'].decode("utf-8"), entry['camera'].decode("utf-8"),
+                         int(entry['frame'])): i for i, entry in enumerate(self.index)}
+        self._shards = {}
+
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+
+
+    def _shard(self, shard_filename, height, width):
+        if shard_filename not in self._shards:
+            shard = np.memmap(join(self.shard_dir, shard_filename.decode("utf-8")), dtype=np.uint8, mode='r')
+            self._shards[shard_filename] = shard.reshape((-1, height, width, 3))
+        return self._shards[shard_filename]
+
+
+
+    def contains(self, subject, action, camera, frame):
+        return (int(subject), action, camera, int(frame)) in self._lookup
+
+
+
+    def get_frame(self, subject, action, camera, frame):
+        """
+        Read a frame.
+
+        :param subject: The subject number
+        :param action: The action (sequence) name, e.g. 'Directions 1'
+        :param camera: The camera name
+        :param frame: The frame number
+        :return: img, center, scale
+            img = a (read only) uint8 RGB Numpy array of shape (height, width, 3)
+            center, scale = the center and scale that the frame was (or should be) cropped with
+        """
+        entry = self.index[self._lookup[(int(subject), action, camera, int(frame))]]
+        img = self._shard(entry['shard'], entry['height'], entry['width'])[entry['offset']]
+        return img, entry['center'], float(entry['scale'])
@@ -1,19 +1,22 @@
 from __future__ import print_function, absolute_import
 
-import copy
 import math
+import multiprocessing
 import os
-import pickle
 import random
 import scipy
-from collections import defaultdict
 
 import torch
 import numpy as np
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 
+import utils.cache_utils as cache_utils
 import utils.camera_utils as camera_utils
 import utils.data_utils as data_utils
+import utils.frame_shards as frame_shards
+import stacked_hourglass.pose.utils.imutils as hg_imutils
+import stacked_hourglass.pose.utils.transforms as hg_transforms
 from utils.osutils import *
 
 
@@ -24,6 +27,70 @@ ALL_ACTIONS = ["Directions", "Discussion", "Eating", "Greeting",
                "Sitting", "SittingDown", "Smoking", "Waiting",
                "WalkDog", "Walking", "WalkTogether"]
 
+# Versions of the code computing cached stats, bump to invalidate the cached values (see cache_utils)
+POSE_STATS_VERSION = 1
+IMG_STATS_VERSION = 1
+
+# Directory (and version) of the compiled pose stores (see data_utils.compile_pose_store)
+POSE_STORE_DIR = ".cache/h36m_pose_store"
+POSE_STORE_VERSION = 1
+
+def collate_batch(batch):
+    """
+    The collate_fn to use with a DataLoader on a Human36mDataset (or subclass). Batches fetched through __getitems__
+    are already collated (and are a tuple), so they're passed straight through. Otherwise 'batch' is a list of
+    examples and the default collate is used.
+    """
+    if isinstance(batch, tuple):
+        return batch
+    return default_collate(batch)
+
+
+
+def _merge_color_stats(stats_a, stats_b):
+    """
+    Merge two sets of color statistics, each a tuple (count, mean, sum of squared differences from the mean), using the
+    (numerically stable, and exact) parallel variance formula from Chan et al.:
+
+    mean_ab = mean_a + delta * n_b / n_ab
+    M2_ab = M2_a + M2_b + delta^2 * n_a * n_b / n_ab, where delta = mean_b - mean_a
+
+    :param stats_a: Tuple (n_a, mean_a, M2_a), mean_a and M2_a are numpy arrays of size 3
+    :param stats_b: Tuple (n_b, mean_b, M2_b)
+    :return: The statistics (n_ab, mean_ab, M2_ab) of the union of the two sets of pixels
+    """
+    n_a, mean_a, m2_a = stats_a
+    n_b, mean_b, m2_b = stats_b
+    n_ab = n_a + n_b
+    if n_ab == 0:
+        return stats_a
+    delta = mean_b - mean_a
+    mean_ab = mean_a + delta * (float(n_b) / n_ab)
+    m2_ab = m2_a + m2_b + delta ** 2 * (float(n_a) * n_b / n_ab)
+    return n_ab, mean_ab, m2_ab
+
+
+
+def _compute_dir_color_stats(args):
+    """
+    Computes the color statistics (count, mean, sum of squared differences from the mean) for (every k-th) image in a
+    directory. Module level so that it can be used in a process pool.
+
+    :param args: Tuple (directory, k), the directory of images, and to only use every k-th image
+    :return: The statistics (n, mean, M2), see _merge_color_stats
+    """
+    img_dir, sample_every = args
+    stats = (0, np.zeros(3), np.zeros(3))
+    for img_filename in sorted(os.listdir(img_dir))[::sample_every]:
+        img = scipy.misc.imread(os.path.join(img_dir, img_filename), mode='RGB').astype(np.float64)
+        img = np.reshape(img, (-1, 3))
+        img_mean = np.mean(img, axis=0)
+        img_stats = (img.shape[0], img_mean, np.sum((img - img_mean) ** 2, axis=0))
+        stats = _merge_color_stats(stats, img_stats)
+    return stats
+
+
+
 class Human36mDataset(Dataset):
     """
     A class containing all of the dataset logic for (image, 2D_out, 2D_normalized_in, 3D_out) tuples. Where the first
@@ -44,7 +111,8 @@ class Human36mDataset(Dataset):
 
     def __init__(self, camera_file=CAMERA_FILE, dataset_path=DATASET_PATH, dataset_img_path=None, cams_per_frame=4, is_train=True,
                  orthogonal_data_augmentation_prob=0.0, z_rotations_only=False, dataset_normalization=False, num_joints=32,
-                 num_joints_pred_2d=16, num_joints_pred_3d=17, flip_prob=0.5, drop_joint_prob=0.0, load_image_data=False):
+                 num_joints_pred_2d=16, num_joints_pred_3d=17, flip_prob=0.5, drop_joint_prob=0.0, load_image_data=False,
+                 img_stats_sample_every=1, img_stats_workers=None, img_shard_dir=None):
         # TODO: DONT COMMIT THIS
         dataset_img_path = "/data/h36m_vid_frame/newvidframes"
 
@@ -63,6 +131,9 @@ class Human36mDataset(Dataset):
         self.flip_prob = flip_prob
         self.drop_joint_prob = drop_joint_prob
         self.load_image_data = load_image_data
+        self.img_stats_sample_every = img_stats_sample_every
+        self.img_stats_workers = img_stats_workers
+        self.img_shard_dir = img_shard_dir
 
         self.actions = ALL_ACTIONS
         
@@ -75,6 +146,11 @@ class Human36mDataset(Dataset):
         self.hg_in_res = 256
         self.hg_out_res = 64
 
+        # Pre-cropped frames (see utils.frame_shards), if we have them
+        self.img_shards = None
+        if load_image_data and img_shard_dir is not None:
+            self.img_shards = frame_shards.FrameShardReader(img_shard_dir)
+
         # The Human3.6m subjects to use for training/validation
         self.subjects = data_utils.TRAIN_SUBJECTS if is_train else data_utils.TEST_SUBJECTS
 
@@ -88,8 +164,10 @@ class Human36mDataset(Dataset):
         self.val_cams = self._load_cams(camera_file, data_utils.TEST_SUBJECTS)
 
         self.cams = self.train_cams if is_train else self.val_cams
+        self.cam_params, self.subject_cam_indices = self._camera_param_lookup(self.cams)
         self.pose = self.train_pose if is_train else self.val_pose
         self.pose_meta = self.train_pose_meta if is_train else self.val_pose_meta
+        self.sequence_names = self.train_sequence_names if is_train else self.val_sequence_names
 
         # Get the video data from the pose data
         self.video_sequences = self._compute_video_frame_sets()
@@ -160,113 +238,150 @@ class Human36mDataset(Dataset):
     def _compute_img_color_norm_stats(self):
         """
         Computes the image color normalization statistics. Numpy image will be of dimesnions H,W,C
-        We compute a mean of m+n examples using the following formulae, parentheses indicating the order of computation,
-        so that the computation is numerically stable over large sample sizes. (Number of pixels in the entire dataset
-        is vast). x_{m+n} is the vector containing all of the elements from x_m and x_n
 
-        mean(x_{m+n}) = (n/(n+m)) * mean(x_n) + (m/(n+m)) * mean(x_m)
-        var(x_{m+n}) = ((n-1)/(n+m-1)) * var(x_n) + ((m-1)/(n+m-1)) * var(x_m)
+        Statistics are computed per camera directory (subject/action/camera) in a process pool, as (pixel count, mean,
+        sum of squared differences from the mean). These are merged exactly using the parallel variance formula (see
+        _merge_color_stats), so the result doesn't depend on the order or grouping of images.
+
+        The per directory statistics are cached (see cache_utils), keyed by the directory and its mtime (which changes
+        when files are added or removed), so that adding a subject only processes the new frames. If
+        self.img_stats_sample_every > 1 then only every k-th frame in each directory is used, for a fast estimate
+        (cached separately).
 
         :return: mean, std. Two 1D numpy arrays (of size 3)
         """
-        # Read from the cache if it exists
-        cache_dir = ".cache/"
-        cache_file = join(cache_dir, "h36m_img_stats")
-        if isfile(cache_file):
-            print("loading h36m image color stats from cache file: " + cache_file)
-            return pickle.load(open(cache_file, "rb"))
-
-        # Stats to keep track of
-        mean = np.zeros(3)
-        var = np.zeros(3)
-        total_pix = 0
-
-        # Iterate through every image, adding to the stats
-        file_num = 0
-        tot_files = len(os.listdir(self.dataset_img_path))
-        for subject_dir in os.listdir(self.dataset_img_path):
+        # Find all of the camera directories
+        cam_dirs = []
+        for subject_dir in sorted(os.listdir(self.dataset_img_path)):
             abs_subject_dir = os.path.join(self.dataset_img_path, subject_dir)
-            for action_dir in os.listdir(abs_subject_dir):
+            for action_dir in sorted(os.listdir(abs_subject_dir)):
                 abs_action_dir = os.path.join(abs_subject_dir, action_dir)
-                for cam_dir in os.listdir(abs_action_dir):
-                    abs_cam_dir = os.path.join(abs_action_dir, cam_dir)
-                    for img_filename in os.listdir(abs_cam_dir):
-
-                        # Image stats
-                        abs_img_filename = os.path.join(abs_cam_dir, img_filename)
-                        img = scipy.misc.imread(abs_img_filename, mode='RGB')
-                        img_mean = np.mean(img, axis=(0,1))
-                        img_var = np.std(img, axis=(0,1)) ** 2
-                        img_pixels = img.shape[0] * img.shape[1]
-
-                        # Running stats
-                        new_total_pix = total_pix + img_pixels
-                        mean = (img_pixels/new_total_pix) * img_mean + (total_pix/new_total_pix) * mean
-                        var = ((img_pixels-1)/(new_total_pix-1)) * img_var + ((total_pix-1)/(new_total_pix-1)) * var
-
-                        # Print out something just to let ourselves know how far we are
-                        file_num += 1
-                        if file_num % 100 == 0:
-                            print("{a}/{b}".format(a=file_num, b=tot_files))
-
-        # Compute std from var
-        std = np.sqrt(var)
-
-        # Cache the results and return them
-        print("finished computing h36m image color stats, caching to file: " + cache_file)
-        if not isdir(cache_dir):
-            mkdir_p(cache_dir)
-        stats = (mean, std)
-        pickle.dump(stats, open(cache_file, "wb"))
-
-        return stats
+                for cam_dir in sorted(os.listdir(abs_action_dir)):
+                    cam_dirs.append(os.path.join(abs_action_dir, cam_dir))
+
+        dir_keys = {cam_dir: (cam_dir, os.path.getmtime(cam_dir)) for cam_dir in cam_dirs}
+
+        # Read the cache of per directory stats (holding the lock, so only one process computes new stats)
+        inputs = {"img_path": os.path.abspath(self.dataset_img_path), "sample_every": self.img_stats_sample_every}
+        cache_key = cache_utils.cache_key("h36m_img_stats", inputs, version=IMG_STATS_VERSION)
+        with cache_utils.lock(cache_key):
+            dir_stats_cache = cache_utils.load(cache_key, default={})
+            dirs_to_compute = [cam_dir for cam_dir in cam_dirs if dir_keys[cam_dir] not in dir_stats_cache]
+
+            # Compute the stats for any new/changed directories in parallel
+            if len(dirs_to_compute) > 0:
+                print("computing h36m image color stats for {n}/{m} directories".format(n=len(dirs_to_compute),
+                                                                                      m=len(cam_dirs)))
+                pool = multiprocessing.Pool(self.img_stats_workers)
+                try:
+                    args = [(cam_dir, self.img_stats_sample_every) for cam_dir in dirs_to_compute]
+                    for i, dir_stats in enumerate(pool.imap(_compute_dir_color_stats, args)):
+                        dir_stats_cache[dir_keys[dirs_to_compute[i]]] = dir_stats
+                        if (i+1) % 10 == 0:
+                            print("{a}/{b}".format(a=i+1, b=len(dirs_to_compute)))
+                finally:
+                    pool.close()
+                    pool.join()
+
+                # Cache the per directory stats (only keeping directories that are still current)
+                print("finished computing h36m image color stats, caching to: " + cache_key)
+                current_keys = set(dir_keys.values())
+                dir_stats_cache = {key: val for key, val in dir_stats_cache.items() if key in current_keys}
+                cache_utils.store(cache_key, dir_stats_cache)
+
+        # Merge the stats from every directory
+        stats = (0, np.zeros(3), np.zeros(3))
+        for cam_dir in cam_dirs:
+            stats = _merge_color_stats(stats, dir_stats_cache[dir_keys[cam_dir]])
+        total_pix, mean, sum_sq_diff = stats
+        std = np.sqrt(sum_sq_diff / total_pix)
+
+        return mean, std
 
 
 
     def _load_pose(self, dataset_path):
         """
         Uses the data_utils to load all of the 3D poses in Human3.6m, in 'world coordinates'. We also keep around the
-        meta data for each of the poses, which are tuples (subject, action, sequence_id).
+        meta data for each of the poses.
 
-        We flatten all of the poses to be a 2D array with shape (total frames, 96).
-        Meta data contains the subject number, action, sequence id and frame index (of the video) to recover all
-        necessary information.
+        The poses are "compiled" (once) into a pose store in the .cache directory (see data_utils.compile_pose_store),
+        which is then memory mapped, so that creating the dataset doesn't need to read and flatten every .h5 file.
+        The poses are a 2D float32 array with shape (total frames, 96).
+        Meta data is a structured array containing the subject number, action id, sequence id and frame index (of the
+        video) to recover all necessary information. Sequence ids index into self.train_sequence_names and
+        self.val_sequence_names.
 
         :param dataset_path: The directory for which the dataset is stored.
         :return: train_poses, train_meta, val_poses, val_meta
         """
-        # Load 3d data
-        rtrain_set = data_utils.load_data(dataset_path, data_utils.TRAIN_SUBJECTS, self.actions, dim=3)
-        rval_set = data_utils.load_data(dataset_path, data_utils.TEST_SUBJECTS, self.actions, dim=3)
-
-        # Convert into friendly indexed training and test set
-        train_set, train_set_meta = self._flatten_poses_set(rtrain_set)
-        val_set, val_set_meta = self._flatten_poses_set(rval_set)
+        # The source .h5 files, whose fingerprints key the pose stores (and anything computed from them)
+        self.train_pose_files = cache_utils.file_fingerprints(
+            data_utils.source_files(dataset_path, data_utils.TRAIN_SUBJECTS, self.actions, dim=3))
+        self.val_pose_files = cache_utils.file_fingerprints(
+            data_utils.source_files(dataset_path, data_utils.TEST_SUBJECTS, self.actions, dim=3))
+        self.train_pose_store = self._pose_store_dir(dataset_path, data_utils.TRAIN_SUBJECTS, self.train_pose_files)
+        self.val_pose_store = self._pose_store_dir(dataset_path, data_utils.TEST_SUBJECTS, self.val_pose_files)
+
+        # Compile the pose stores if they don't exist yet (only one process compiles each, others wait for it)
+        for store_dir, subjects in [(self.train_pose_store, data_utils.TRAIN_SUBJECTS),
+                                    (self.val_pose_store, data_utils.TEST_SUBJECTS)]:
+            with cache_utils.lock(os.path.basename(store_dir), cache_dir=POSE_STORE_DIR):
+                if not data_utils.pose_store_exists(store_dir):
+                    print("compiling h36m pose store to: " + store_dir)
+                    data_utils.compile_pose_store(dataset_path, subjects, self.actions, store_dir, dim=3)
+
+        # Memory map the pose stores
+        train_set, train_set_meta, self.train_sequence_names = data_utils.load_pose_store(self.train_pose_store)
+        val_set, val_set_meta, self.val_sequence_names = data_utils.load_pose_store(self.val_pose_store)
 
         return train_set, train_set_meta, val_set, val_set_meta
 
 
 
-    def _flatten_poses_set(self, dict):
+    def _pose_store_dir(self, dataset_path, subjects, files):
         """
-        Given a dict, where each item has a key of format (subject, action, sequence_id), and value is a
-        2D array (indexed by frame and then joint indices) corresponding to video data of poses.
+        The directory of the pose store for some subjects (and self.actions). It's keyed by the dataset path and the
+        fingerprints of the .h5 files the poses are read from, so a store is never reused if the data changes.
 
-        :param dict: A dictionary to convert.
-        :return: list of poses, meta data about those poses
+        :param dataset_path: The directory for which the dataset is stored
+        :param subjects: The list of subjects in the pose store
+        :param files: The fingerprints of the .h5 files for the subjects (see cache_utils.file_fingerprints)
+        :return: The directory to use for the pose store
         """
-        poses = []
-        meta = []
-        for key in dict:
-            for frame_indx in range(len(dict[key])):
-                poses.append(dict[key][frame_indx])
-                subject_no, action, sequence_id = key
-                meta_dict = {"subject_number": subject_no,
-                             "action": action,
-                             "sequence_id": sequence_id,
-                             "frame_index": frame_indx}
-                meta.append(meta_dict)
-        return poses, meta
+        inputs = {
+            "dataset_path": os.path.abspath(dataset_path),
+            "subjects": subjects,
+            "actions": self.actions,
+            "files": files,
+        }
+        subjects_str = "_".join(str(subject) for subject in subjects)
+        key = cache_utils.cache_key("S{s}".format(s=subjects_str), inputs, version=POSE_STORE_VERSION)
+        return join(POSE_STORE_DIR, key)
+
+
+
+    def __getstate__(self):
+        """
+        When pickled (e.g. sent to DataLoader worker processes) don't copy the memory mapped poses, they're re-mapped
+        in __setstate__, so that all processes share the same pages.
+        """
+        state = self.__dict__.copy()
+        for key in ["train_pose", "train_pose_meta", "val_pose", "val_pose_meta", "pose", "pose_meta"]:
+            state.pop(key, None)
+        return state
+
+
+
+    def __setstate__(self, state):
+        """
+        Re-map the pose stores dropped by __getstate__
+        """
+        self.__dict__.update(state)
+        self.train_pose, self.train_pose_meta, _ = data_utils.load_pose_store(self.train_pose_store)
+        self.val_pose, self.val_pose_meta, _ = data_utils.load_pose_store(self.val_pose_store)
+        self.pose = self.train_pose if self.is_train else self.val_pose
+        self.pose_meta = self.train_pose_meta if self.is_train else self.val_pose_meta
 
 
 
@@ -278,19 +393,20 @@ class Human36mDataset(Dataset):
 
         :return: video info, a list of 1D numpy arrays, each a sequence of indices (into the dataset) for a single video
         """
-        # First use a map and the meta data to compute sequences of poses that constitute a video
-        # video_id is the same for all frames in a video and unique per video
-        pose_sequences = defaultdict(list)
-        for i in range(len(self.pose)):
-            video_id = (self.pose_meta[i]["subject_number"], self.pose_meta[i]["sequence_id"])
-            pose_sequences[video_id].append(i)
+        # First use the meta data to compute sequences of poses that constitute a video
+        # video_id is the same for all frames in a video and unique per video, and we order videos by first appearance
+        video_keys = np.stack([self.pose_meta["subject_number"], self.pose_meta["sequence_id"]], axis=1)
+        _, first_indices, video_ids = np.unique(video_keys, axis=0, return_index=True, return_inverse=True)
+        video_ids = np.argsort(np.argsort(first_indices))[video_ids.reshape(-1)]
+        pose_indices = np.argsort(video_ids, kind="stable")
+        split_points = np.cumsum(np.bincount(video_ids))[:-1]
+        pose_sequences = np.split(pose_indices, split_points)
 
         # Now convert the sequences in poses to sequences in the dataset (4 consecutive items from the dataset is the
-        # same frame from multiple angles). (Note we don't care about the keys really, they were just for collating)
+        # same frame from multiple angles).
         video_sequences = []
-        for key in pose_sequences:
-            pose_seq = pose_sequences[key]
-            pose_seq = np.array(pose_seq) * 4.0
+        for pose_seq in pose_sequences:
+            pose_seq = pose_seq * 4.0
             video_sequences.append(pose_seq)
             video_sequences.append(pose_seq + 1.0)
             video_sequences.append(pose_seq + 2.0)
@@ -308,7 +424,7 @@ class Human36mDataset(Dataset):
         camss = []
         for frame in range(len(self.train_pose)):
             cams = []
-            subject = self.train_pose_meta[frame]["subject_number"]
+            subject = int(self.train_pose_meta[frame]["subject_number"])
             for cam_indx in range(1,5):
                 cams.append(self.train_cams[(subject, cam_indx)])
             camss.append(cams)
@@ -316,6 +432,44 @@ class Human36mDataset(Dataset):
 
 
 
+    def _camera_param_lookup(self, cams):
+        """
+        Packs a dictionary of cameras (indexed by (subject number, cam number)) into a table of packed camera
+        parameters (see camera_utils.pack_camera_params), and a lookup table from subject number and cam number to
+        the row of the table to use.
+
+        :param cams: A dictionary of cameras, such as self.train_cams
+        :return: cam_params, subject_cam_indices
+            cam_params = Numpy array of shape (num_cams, camera_utils.CAMERA_PARAM_SIZE)
+            subject_cam_indices = Numpy int array of shape (max subject + 1, 4), where subject_cam_indices[s, c-1] is
+                the row of cam_params for the camera (s, c)
+        """
+        cam_keys = sorted(cams.keys())
+        cam_params = camera_utils.pack_camera_params([cams[key] for key in cam_keys])
+
+        subject_cam_indices = np.zeros((max(key[0] for key in cam_keys) + 1, 4), dtype=np.int64)
+        for i, (subject, cam_indx) in enumerate(cam_keys):
+            subject_cam_indices[subject, cam_indx-1] = i
+        return cam_params, subject_cam_indices
+
+
+
+    def _flattened_train_camera_params(self):
+        """
+        Batch friendly version of _flattened_train_cameras. Rather than a list of lists of cameras, returns a table of
+        packed camera parameters (see camera_utils.pack_camera_params) and indices into it.
+
+        :return: cam_params, cam_indices
+            cam_params = Numpy array of shape (num_cams, camera_utils.CAMERA_PARAM_SIZE)
+            cam_indices = Numpy int array of shape (len(self.train_pose), 4), the cameras to use with self.train_pose[i]
+        """
+        # Index the lookup table with the subject column of the meta
+        cam_params, subject_cam_indices = self._camera_param_lookup(self.train_cams)
+        cam_indices = subject_cam_indices[self.train_pose_meta["subject_number"]]
+        return cam_params, cam_indices
+
+
+
     def _compute_norm_stats_poses(self):
         """
         Computes the mean and std dev of the poses in the *training* dataset. EVEN if this is a validation dataset.
@@ -332,30 +486,37 @@ class Human36mDataset(Dataset):
             dims_to_ignore = unused indices from the h36m data (some joints don't move)
             dims_to_use = used indices from the h36m data (joints indices that do move from the data)
         """
-        # Load from cache if it exists
-        cache_dir = ".cache/"
-        cache_file = join(cache_dir, "h36m_pose_stats")
-        if isfile(cache_file):
-            print("loading h36m pose stats from cache file: " + cache_file)
-            return pickle.load(open(cache_file, "rb"))
-
-        # Transform all of the coords to camera space, and compute stats
-        poses_camera_coords = self.world_to_camera_3d(self.train_pose, self._flattened_train_cameras())
-        poses_transformed, _ = data_utils.postprocess_3d(poses_camera_coords)
-        poses_transformed_np = copy.deepcopy(np.vstack(poses_transformed))
-        mean_3d, std_3d = data_utils.normalization_stats(poses_transformed_np, dim=3)
-
-        # Project all of the the points, and compute the stats for 2d coords
-        poses_projected = self.project_poses(self.train_pose, self._flattened_train_cameras())
-        poses_projected_np = copy.deepcopy(np.vstack(poses_projected))
-        mean_2d, std_2d = data_utils.normalization_stats(poses_projected_np, dim=2)
-
-        # Cache the stats (as they're slow to compute)
-        print("finished computing h36m pose stats, caching to file: " + cache_file)
-        if not isdir(cache_dir):
-            mkdir_p(cache_dir)
-        stats = (mean_3d, std_3d, mean_2d, std_2d)
-        pickle.dump(stats, open(cache_file, "wb"))
+        # The stats depend on the training poses (and so subjects, actions and the source .h5 files) and the cameras
+        inputs = {
+            "subjects": data_utils.TRAIN_SUBJECTS,
+            "actions": self.actions,
+            "num_joints": self.num_joints,
+            "files": cache_utils.file_fingerprints([self.camera_file]) + self.train_pose_files,
+        }
+        return cache_utils.cached("h36m_pose_stats", inputs, self._compute_norm_stats_poses_uncached,
+                                  version=POSE_STATS_VERSION)
+
+
+
+    def _compute_norm_stats_poses_uncached(self):
+        """
+        Computes the stats for _compute_norm_stats_poses (which caches them, as they're slow to compute)
+
+        :return: mean_3d, std_3d, mean_2d, std_2d
+        """
+        # Transform all of the coords to camera space and project them, in a single batched pass
+        cam_params, cam_indices = self._flattened_train_camera_params()
+        train_pose = np.asarray(self.train_pose, dtype=np.float64)
+        poses_projected, poses_camera_coords = data_utils.project_to_cameras_batch(train_pose, cam_params, cam_indices)
+
+        # Compute the stats for the 3d coords (centered around the hip)
+        poses_camera_coords = np.reshape(poses_camera_coords, (-1, poses_camera_coords.shape[-1]))
+        poses_transformed, _ = data_utils.zero_hip_joints(poses_camera_coords, self.num_joints)
+        mean_3d, std_3d = data_utils.normalization_stats(poses_transformed, dim=3)
+
+        # Compute the stats for 2d coords
+        poses_projected = np.reshape(poses_projected, (-1, poses_projected.shape[-1]))
+        mean_2d, std_2d = data_utils.normalization_stats(poses_projected, dim=2)
 
         return mean_3d, std_3d, mean_2d, std_2d
 
@@ -432,6 +593,26 @@ class Human36mDataset(Dataset):
 
 
 
+    def rand_orthogonal_transform_matrices(self, n):
+        """
+        Batch version of rand_orthogonal_transform_matrix.
+
+        :param n: The number of random orthogonal matrices to compute
+        :return: A Numpy tensor of shape (n,3,3) representing random rotations and flips.
+        """
+        # Compute random rotation matrices, from random normals and random numbers in the rand [0,2pi)
+        angles = 2.0 * np.random.uniform(size=n) * math.pi
+        normals = np.tile([[0.0, 0.0, 1.0]], (n, 1)) if self.z_rotations_only else self._rand_normals_3d(n)
+        Qs = data_utils.rotation_matrices(normals, np.reshape(angles, (n, 1, 1)))
+
+        # Decide if we are flipping randomly (in the xaxis)
+        flips = np.random.uniform(size=n) < self.flip_prob
+        Qs[flips] = np.matmul(Qs[flips], np.diag([-1,1,1]))
+
+        return Qs
+
+
+
     def apply_orthogonal_transform_3d(self, pose, Q):
         """
         Given a 3D pose 'pose', apply the orthongonal transform represented by 'Q' on it
@@ -450,6 +631,23 @@ class Human36mDataset(Dataset):
 
 
 
+    def apply_orthogonal_transform_3d_batch(self, poses, Qs):
+        """
+        Batch version of apply_orthogonal_transform_3d.
+
+        :param poses: Numpy tensor of shape (n, k*3)
+        :param Qs: Numpy tensor of shape (n,3,3), the orthogonal transform to apply to each pose
+        :return: Returns Qs[i] applied to each poses[i], with shape (n, k*3)
+        """
+        batch_size = poses.shape[0]
+        poses_centered, hip_positions = data_utils.zero_hip_joints(poses, self.num_joints)
+        poses_centered = np.reshape(poses_centered, (batch_size, -1, 3))
+        poses_transformed_centered = np.matmul(poses_centered, np.transpose(Qs, (0, 2, 1)))
+        poses_transformed = poses_transformed_centered + hip_positions[:, None]
+        return np.reshape(poses_transformed, (batch_size, -1))
+
+
+
     def project_poses(self, poses, cams):
         """
         Project poses[i] onto all cameras in cams[i]. Returning a big array of all of the projections
@@ -516,15 +714,19 @@ class Human36mDataset(Dataset):
             3d_pose = the 3D pose that we wish to predict
             meta = a dictionary of information that could be useful (defined above).
         """
+        # A list of indices is fetched as a batch
+        if not np.isscalar(index):
+            return self.get_batch(index)
+
         # Get the indices into the imgs/cams/pose
         frame_number = index // self.cams_per_frame
         camera_number = (index % self.cams_per_frame) + 1
 
         # Step 1, index into arrays
         # Get the image, camera and pose (in camera coordinates)
-        subject = self.pose_meta[frame_number]["subject_number"]
+        subject = int(self.pose_meta[frame_number]["subject_number"])
         cam = self.cams[(subject,camera_number)]
-        pose = self.pose[frame_number]
+        pose = np.array(self.pose[frame_number], dtype=np.float64)
         
         # Step 2, apply the (random) orthogonal transform
         Q = np.eye(3)
@@ -556,41 +758,46 @@ class Human36mDataset(Dataset):
         img_for_hg_input, target_heatmap = None, None
         if self.load_image_data:
             # Step 7, load the correct image from the dataset
-            # pose_meta[i]["sequence_id"] is something like 'smoking 1.h5', and we want 'smoking 1'
+            # The sequence name of pose_meta[i]["sequence_id"] is something like 'smoking 1.h5', and we want 'smoking 1'
             # The camera name is the 7th parameter in cam, out of 7
-            action = self.pose_meta[frame_number]["sequence_id"].split(".")[0]
+            action = self.sequence_names[self.pose_meta[frame_number]["sequence_id"]].split(".")[0]
             camera_name = cam[6]
             filename = "{s}/{a}/{c}/{f}.jpg".format(s=subject, a=action, c=camera_name, f=frame_number)
             full_filename = os.path.join(self.dataset_img_path, filename)
-            numpy_img = scipy.misc.imread(full_filename, mode='RGB').astype(np.float)
 
             # Step 8, color normalize, and squeeze the image into something to be used by the stacked hourglass
             # The cropping subroutines allow us to specify a center and scale (so pick those to keep the whole image)
-            height, width, channels = numpy_img.shape
-            center = [height // 2, width // 2]
-            scale = max(*center) / self.hg_resolution
+            # If we have frame shards, then the frame has already been cropped, and is a single slice of a mmap
             in_res = [self.hg_in_res, self.hg_in_res]
-            img_for_hg_input = hg_transforms.crop_numpy(numpy_img, center, scale, in_res, rot=0)
+            if self.img_shards is not None:
+                img_for_hg_input, center, scale = self.img_shards.get_frame(subject, action, camera_name, frame_number)
+                if img_for_hg_input.shape[:2] != tuple(in_res):
+                    img_for_hg_input = hg_transforms.crop_numpy(img_for_hg_input, center, scale, in_res, rot=0)
+                img_for_hg_input = img_for_hg_input.astype(np.float64)
+            else:
+                numpy_img = scipy.misc.imread(full_filename, mode='RGB').astype(np.float)
+                height, width, channels = numpy_img.shape
+                center, scale = frame_shards.img_crop_params(height, width)
+                img_for_hg_input = hg_transforms.crop_numpy(numpy_img, center, scale, in_res, rot=0)
             img_for_hg_input = data_utils.normalize(img_for_hg_input, self.img_mean, self.img_std)
 
             # Convert the image to a PyTorch tensor, and transpose shape from (H,W,C) to (C,H,W)
             img_for_hg_input = torch.from_numpy(np.transpose(img_for_hg_input, (2, 0, 1))).float()
 
             # Step 9, compute the 2D pose ground truth in the normalized image, and, compute the target heatmap
-            target_2d_pts = np.reshape(augmented_pose_2d.clone(), [-1,2])
+            # (The image isn't rotated, so neither are the points)
+            target_2d_pts = np.reshape(augmented_pose_2d.copy(), [-1,2])
             out_res = [self.hg_out_res, self.hg_out_res]
-            target_heatmap = torch.zeros(self.num_joints_pred_2d, self.hg_out_res, self.hg_out_res)
-            for i in range(self.num_joints_pred_2d):
-                target_2d_pts[i] = hg_transforms.transform(target_2d_pts[i] + 1, center, scale, out_res, rot=r)
-                target_2d_pt = torch.from_numpy(target_2d_pts[i])
-                target_heatmap[i] = draw_labelmap(target[i], target_2d_pt - 1, 1.0, type="Gaussian")
-            target_2d_pts = torch.from_numpy(target_2d_pts)
+            target_2d_pts = hg_transforms.transform_batch(target_2d_pts + 1, center, scale, out_res, rot=0)
+            target_2d_pts = torch.from_numpy(target_2d_pts.astype(np.float64))
+            target_heatmap = hg_imutils.draw_labelmaps(target_2d_pts - 1, out_res, 1.0, type="Gaussian")
 
         # Step 10, store any meta data
         meta = {
             'index': index,
             'frame_number': frame_number,
             'cam_number': camera_number,
+            'action_id': int(self.pose_meta[frame_number]["action_id"]),
             'cam': cam,
             'Q': Q,
             'joint_mask': joint_mask,
@@ -631,6 +838,113 @@ class Human36mDataset(Dataset):
 
 
 
+    def get_batch(self, indices):
+        """
+        Batched version of __getitem__, for the pose data only (i.e. when not loading image data). Steps 1 to 6 (and
+        10) from __getitem__ are performed for a whole batch at once using array operations, and the result is
+        returned already collated, as the DataLoader's default collate would (so images and heatmaps are None, and
+        every value in meta has a leading batch dimension).
+
+        The per-sample random numbers (augmentation, joint dropping) are drawn per batch, so a batch won't be
+        identical to the same indices from __getitem__ for a given seed, but they're identically distributed.
+
+        :param indices: A list (or 1D array) of indices into the dataset
+        :return: Returns the tuple (None, None, 2d_poses, 3d_poses, meta), see __getitem__
+        """
+        if self.load_image_data:
+            raise Exception("Batched loading is only supported for pose data, set load_image_data to False.")
+
+        # Get the indices into the cams/pose
+        indices = np.asarray(indices, dtype=np.int64)
+        batch_size = indices.shape[0]
+        frame_numbers = indices // self.cams_per_frame
+        camera_numbers = (indices % self.cams_per_frame) + 1
+
+        # Step 1, index into arrays
+        subjects = self.pose_meta["subject_number"][frame_numbers]
+        cam_params = self.cam_params[self.subject_cam_indices[subjects, camera_numbers - 1]]
+        poses = np.asarray(self.pose[frame_numbers], dtype=np.float64)
+
+        # Step 2, apply the (random) orthogonal transforms
+        Qs = np.tile(np.eye(3), (batch_size, 1, 1))
+        augment = np.random.uniform(size=batch_size) < self.orthogonal_data_augmentation_prob
+        if np.any(augment):
+            Qs[augment] = self.rand_orthogonal_transform_matrices(np.sum(augment))
+        augmented_poses = self.apply_orthogonal_transform_3d_batch(poses, Qs)
+
+        # Step 3, project the poses, and transform them into camera coords, in one pass
+        augmented_poses_2d, augmented_poses_cam = data_utils.project_to_cameras_batch(augmented_poses,
+                                                                                      cam_params[:, None])
+        augmented_poses_2d = augmented_poses_2d[:, 0]
+        augmented_poses_cam = augmented_poses_cam[:, 0]
+
+        # Step 4, sub sample the joints, so that we only give the network the ones that move
+        augmented_poses_2d = augmented_poses_2d[:, self.pose_2d_indx_to_use]
+        augmented_poses_cam = augmented_poses_cam[:, self.pose_3d_indx_to_use]
+
+        # Step 5, normalize the 2D and 3D poses
+        normalized_poses_2d, hip_pos_2d, scale_2d = data_utils.normalize_poses_numpy(
+            augmented_poses_2d, self.num_joints_pred_2d, self.dataset_normalization, self.pose_2d_mean,
+            self.pose_2d_std, is_2d=True)
+        normalized_poses, hip_pos, scale_3d = data_utils.normalize_poses_numpy(
+            augmented_poses_cam, self.num_joints_pred_3d, self.dataset_normalization, self.pose_3d_mean,
+            self.pose_3d_std, is_2d=False)
+
+        # Step 6, randomly drop some joints (only on the input/2D pose)
+        joint_masks = np.array(np.random.uniform(size=(batch_size, self.num_joints)) > self.drop_joint_prob, dtype=int)
+        if self.drop_joint_prob > 0.0:
+            normalized_poses_2d = np.reshape(normalized_poses_2d, (batch_size, self.num_joints, -1))
+            normalized_poses_2d = normalized_poses_2d * np.expand_dims(joint_masks, axis=2)
+            normalized_poses_2d = np.reshape(normalized_poses_2d, (batch_size, -1))
+
+        # Step 10, store any meta data (collated)
+        cams = [self.cams[(subject, camera_number)] for subject, camera_number in zip(subjects, camera_numbers)]
+        meta = {
+            'index': torch.from_numpy(indices),
+            'frame_number': torch.from_numpy(frame_numbers),
+            'cam_number': torch.from_numpy(camera_numbers),
+            'action_id': torch.from_numpy(self.pose_meta["action_id"][frame_numbers].astype(np.int64)),
+            'cam': [torch.from_numpy(np.stack([cam[param] for cam in cams])) for param in range(6)] +
+                   [[cam[6] for cam in cams]],
+            'Q': torch.from_numpy(Qs),
+            'joint_mask': torch.from_numpy(joint_masks),
+            '3d_pose_camera_coords': torch.from_numpy(augmented_poses_cam),
+            '2d_indx_used': torch.from_numpy(np.tile(self.pose_2d_indx_to_use, (batch_size, 1))),
+            '3d_indx_used': torch.from_numpy(np.tile(self.pose_3d_indx_to_use, (batch_size, 1))),
+            '2d_indx_ignored': torch.from_numpy(np.tile(self.pose_2d_indx_to_ignore, (batch_size, 1))),
+            '3d_indx_ignored': torch.from_numpy(np.tile(self.pose_3d_indx_to_ignore, (batch_size, 1))),
+        }
+        if self.dataset_normalization:
+            # to "unNormalize" in datasrt normalization
+            meta.update({
+                '2d_mean': torch.from_numpy(np.tile(self.pose_2d_mean, (batch_size, 1))),
+                '3d_mean': torch.from_numpy(np.tile(self.pose_3d_mean, (batch_size, 1))),
+                '2d_std': torch.from_numpy(np.tile(self.pose_2d_std, (batch_size, 1))),
+                '3d_std': torch.from_numpy(np.tile(self.pose_3d_std, (batch_size, 1))),
+            })
+        else:
+            # to "unNormalize" in instance normalization
+            meta.update({
+                '2d_hip_pos': torch.from_numpy(hip_pos_2d),
+                '3d_hip_pos': torch.from_numpy(hip_pos),
+                '2d_scale': torch.from_numpy(scale_2d),
+                '3d_scale': torch.from_numpy(scale_3d),
+            })
+
+        # Return the tuple
+        return (None, None, torch.Tensor(normalized_poses_2d), torch.Tensor(normalized_poses), meta)
+
+
+
+    def __getitems__(self, indices):
+        """
+        Used by the DataLoader (when available) to fetch a whole batch at once. Use 'collate_batch' as the collate_fn
+        of the DataLoader, as the batch returned is already collated.
+        """
+        return self[indices]
+
+
+
     def get_video_frames(self, index):
         """
         Gets the 'index'th video, as a set of indices into the dataset
@@ -646,7 +960,7 @@ class Human36mDataset(Dataset):
         """ 
         There are 4 cameras for each pose
         """
-        return len(self.pose) * 4.0
+        return len(self.pose) * 4
 
 
 
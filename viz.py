@@ -10,9 +10,10 @@ import matplotlib.pyplot as plt
 # Relative imports
 from stacked_hourglass.evaluation.utils import visualize as viz_2d_overlay
 from stacked_hourglass.pose.utils.evaluation import final_preds
-from stacked_hourglass.pose.utils.run import _load_model_and_dataset
+from stacked_hourglass.pose.utils.run import _load_model_and_dataset, load_preds
 from utils import data_utils
 from utils.human36m_dataset import Human36mDataset
+from utils.device import get_device, module_device, load_checkpoint
 from utils.osutils import mkdir_p, isdir
 from stacked_hourglass.pose.utils.transforms import color_denormalize
 from twod_threed.src.viz import viz_2d_pose, viz_3d_pose
@@ -33,6 +34,18 @@ import sys
 
 
 
+def _load_2d_pose_estimations(path):
+    """
+    Load 2D pose estimations as a dict keyed by filenames. Either a PyTorch file (containing such a dict), or the output
+    directory of the hourglass run.py (see stacked_hourglass/pose/utils/run.py)
+    """
+    if isdir(path):
+        predictions, _ = load_preds(path)
+        return predictions
+    return torch.load(path)
+
+
+
 def visualize_2d_overlay_3d_pred(options):
     """
     Unpacks options and makes visualizations for 2d and 3d predictions.
@@ -43,7 +56,7 @@ def visualize_2d_overlay_3d_pred(options):
 
     Options that should be included:
     options.img_dir: the directory for the image
-    options.twod_pose_estimations: a PyTorch file containing 2D pose estimations. Assumed to be a dict keyed by filenames
+    options.twod_pose_estimations: a PyTorch file containing 2D pose estimations (or a hourglass run.py output directory). Assumed to be a dict keyed by filenames
     options.threed_pose_estimations: a PyTorch file containing the 3D pose estimations. Assumed to be a dict keyed by filenames
     options.output_dir: a directory to output each visualization to
 
@@ -51,7 +64,7 @@ def visualize_2d_overlay_3d_pred(options):
     """
     # Load the predictions and unpack options
     img_dir = options.img_dir
-    twod_pose_preds = torch.load(options.twod_pose_estimations)
+    twod_pose_preds = _load_2d_pose_estimations(options.twod_pose_estimations)
     threed_pose_preds = torch.load(options.threed_pose_estimations)
     output_dir = options.output_dir
 
@@ -91,14 +104,14 @@ def visualize_2d_overlay(options):
 
     Options that should be included:
     options.img_dir: the directory for the image
-    options.twod_pose_estimations: a PyTorch file containing 2D pose estimations. Assumed to be a dict keyed by filenames
+    options.twod_pose_estimations: a PyTorch file containing 2D pose estimations (or a hourglass run.py output directory). Assumed to be a dict keyed by filenames
     options.output_dir: a directory to output each visualization to
 
     :param options: Options for the visualizations, defined in options.py. (Including defaults).
     """
     # Load the predictions and unpack options
     img_dir = options.img_dir
-    twod_pose_preds = torch.load(options.twod_pose_estimations)
+    twod_pose_preds = _load_2d_pose_estimations(options.twod_pose_estimations)
     output_dir = options.output_dir
 
     # Make dir for output if it doesnt exist
@@ -153,8 +166,9 @@ def viz_orthog_transform(options):
     # Make the dataset object, and load the model, and put it in eval mode
     dataset = Human36mDataset(dataset_path=data_dir, orthogonal_data_augmentation_prob=0.0,
                               z_rotations_only=options.z_rotations_only, dataset_normalization=dataset_normalize)
-    model = LinearModel(dataset_normalized_input=dataset_normalize).cuda()
-    ckpt = torch.load(model_checkpoint_file)
+    device = get_device(options)
+    model = LinearModel(dataset_normalized_input=dataset_normalize).to(device)
+    ckpt = load_checkpoint(model_checkpoint_file)
     model.load_state_dict(ckpt['state_dict'])
     model.eval()
 
@@ -165,7 +179,7 @@ def viz_orthog_transform(options):
         _, _, pose_2d_gt, pose_3d_gt, meta = dataset[index]
 
         # Run the model to get the prediction (put it in a 'psuedo batch' of size 1)
-        pose_3d_pred = model(torch.Tensor(pose_2d_gt).view((1,-1)).cuda()).cpu().detach().numpy()
+        pose_3d_pred = model(torch.Tensor(pose_2d_gt).view((1,-1)).to(device)).cpu().detach().numpy()
 
         # Unnormalized poses (adding and remove the phantom batching as needed)
         pose_2d_gt = np.expand_dims(pose_2d_gt, axis=0)
@@ -217,7 +231,7 @@ def visualize_2d_overlay_3d_gt_3d_pred(options):
     """
     # Load the predictions and unpack options
     img_dir = options.img_dir
-    twod_pose_preds = torch.load(options.twod_pose_estimations)
+    twod_pose_preds = _load_2d_pose_estimations(options.twod_pose_estimations)
     threed_pose_ground_truths = torch.load(options.threed_pose_ground_truths)
     threed_pose_preds = torch.load(options.threed_pose_estimations)
     output_dir = options.output_dir
@@ -335,7 +349,7 @@ def visualize_saliency_and_prob_maps(options, skeleton_overlay=False):
         inputs_var.requires_grad_()
 
         # Run the model to get the output predictions
-        output = model(inputs_var.cuda())
+        output = model(inputs_var.to(module_device(model)))
         score_map = output[-1].cpu().data
         joint_preds = final_preds(score_map, [meta['center']], [meta['scale']], [64, 64]).squeeze()
 
@@ -351,7 +365,7 @@ def visualize_saliency_and_prob_maps(options, skeleton_overlay=False):
         twod_overlay = viz_2d_overlay(img, joint_preds)
 
         # Compute the output from the network (which is a list and we only want the last, final set of scores). Output is of shape [1,num_joints,64,64] so squeeze and upsample
-        scores = model(inputs_var.cuda())[-1].cpu().squeeze()
+        scores = model(inputs_var.to(module_device(model)))[-1].cpu().squeeze()
         scores_upsampled = upasample_4x4(scores.unsqueeze(0)).squeeze()
 
         # Saliency map is the gradient of the scores with respect to the scores. We want to do this one joint at a time